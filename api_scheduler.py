@@ -0,0 +1,257 @@
+import asyncio
+import heapq
+import logging
+import time
+
+import metrics
+
+# priority classes of outbound calls, lower runs first
+PRIORITY_USER = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HOUSEKEEPING = 2
+priorityNames = ['user', 'normal', 'housekeeping']
+
+# route kind->(calls per second, burst), the route key is '<kind>:<major id>' so every channel or guild gets its own bucket.
+# discord limits routes per fixed window, so burst + rate * window is kept within each window's limit
+routeLimits = {
+    # 5 per 5 seconds per channel
+    'send': (0.6, 2),
+    # 1 per 0.25 seconds per channel
+    'reaction': (3.9, 1),
+    'pin': (0.6, 2),
+    # 10 per 10 seconds
+    'permissions': (0.5, 5),
+    'create_channel': (0.5, 5),
+    'role': (0.5, 5),
+    'delete_channel': (0.6, 2),
+    # topic and name edits are limited to 2 per 10 minutes per channel
+    'edit_channel': (1 / 600.0, 1),
+    'dm': (0.6, 2),
+}
+defaultRouteLimit = (0.6, 2)
+# all routes share discord's global limit of 50 per second
+globalLimit = (40.0, 10)
+
+
+class RouteBucket:
+    # token bucket pacing the calls of one route
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # set when the api answered with 429, no calls are made until then
+        self.blockedUntil = 0.0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        # returns how long to wait before the bucket allows another call
+        self.refill(now)
+        waitTime = max(0.0, self.blockedUntil - now)
+        if self.tokens < 1:
+            waitTime = max(waitTime, (1 - self.tokens) / self.rate)
+        return waitTime
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+    def is_idle(self, now):
+        # a refilled bucket that is not blocked behaves like a new one, so it can be dropped and made again when needed
+        self.refill(now)
+        return self.tokens >= self.capacity and self.blockedUntil <= now
+
+    def block(self, until):
+        self.blockedUntil = max(self.blockedUntil, until)
+        self.tokens = 0
+
+
+class ApiCall:
+    def __init__(self, route, priority, func, args, kwargs, future):
+        self.route = route
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+        self.submitted = time.monotonic()
+
+
+class ApiScheduler:
+    # runs outbound discord api calls with per-route pacing, bounded concurrency and priority classes
+
+    def __init__(self, concurrency=8, maxRetries=3, timeScale=1.0, globalShare=1.0, sweepInterval=60.0):
+        self.concurrency = concurrency
+        self.maxRetries = maxRetries
+        # every rate is multiplied by timeScale, the load simulation uses it to run discord's limits faster
+        self.timeScale = timeScale
+        # dict storing route->bucket, routes name channels that come and go so idle buckets are swept every sweepInterval seconds
+        self.buckets = dict()
+        self.sweepInterval = sweepInterval
+        self.nextSweep = time.monotonic() + sweepInterval
+        # the global limit is per bot, processes running the same bot each get their share of it
+        self.globalBucket = RouteBucket(globalLimit[0] * timeScale * globalShare, max(1, int(globalLimit[1] * globalShare)))
+        # heap of (priority, sequence, call) ready to run once their bucket allows
+        self.pending = list()
+        # heap of (ready time, priority, sequence, call) waiting for their bucket to refill
+        self.deferred = list()
+        self.sequence = 0
+        self.wakeup = None
+        self.slots = None
+        self.dispatcherTask = None
+        # counters
+        self.calls = dict()
+        self.rateLimitHits = 0
+        self.retries = 0
+        self.failures = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+        self.totalWait = [0.0, 0.0, 0.0]
+        self.completed = [0, 0, 0]
+        # dict storing route kind->histogram of call seconds
+        self.routeLatency = dict()
+        # dict storing route kind->number of 429 answers
+        self.routeRateLimitHits = dict()
+
+    def start(self, loop):
+        if self.dispatcherTask == None:
+            self.wakeup = asyncio.Event()
+            self.slots = asyncio.Semaphore(self.concurrency)
+            self.dispatcherTask = loop.create_task(self.dispatch())
+
+    def stop(self):
+        if self.dispatcherTask != None:
+            self.dispatcherTask.cancel()
+            self.dispatcherTask = None
+
+    def bucket(self, route):
+        bucket = self.buckets.get(route)
+        if bucket == None:
+            rate, capacity = routeLimits.get(route.split(':', 1)[0], defaultRouteLimit)
+            bucket = RouteBucket(rate * self.timeScale, capacity)
+            self.buckets[route] = bucket
+        return bucket
+
+    def sweep(self, now):
+        for route in [route for route, bucket in self.buckets.items() if bucket.is_idle(now)]:
+            del self.buckets[route]
+        self.nextSweep = now + self.sweepInterval
+
+    def submit(self, route, func, *args, priority=PRIORITY_NORMAL, **kwargs):
+        # queues the call and returns a future with its result
+        loop = asyncio.get_running_loop()
+        self.start(loop)
+        call = ApiCall(route, priority, func, args, kwargs, loop.create_future())
+        self.enqueue(call)
+        return call.future
+
+    async def call(self, route, func, *args, priority=PRIORITY_NORMAL, **kwargs):
+        return await self.submit(route, func, *args, priority=priority, **kwargs)
+
+    def post(self, route, func, *args, priority=PRIORITY_HOUSEKEEPING, **kwargs):
+        # fire and forget, failures are logged instead of raised
+        future = self.submit(route, func, *args, priority=priority, **kwargs)
+        future.add_done_callback(self.log_failure)
+        return future
+
+    def log_failure(self, future):
+        if not future.cancelled() and future.exception() != None:
+            logging.error("api call failed: %s" % (future.exception()))
+
+    def enqueue(self, call):
+        heapq.heappush(self.pending, (call.priority, self.sequence, call))
+        self.sequence += 1
+        self.wakeup.set()
+
+    def queued(self):
+        return len(self.pending) + len(self.deferred)
+
+    async def next_call(self):
+        while True:
+            now = time.monotonic()
+            if now >= self.nextSweep:
+                self.sweep(now)
+            # calls whose bucket has refilled compete on priority again
+            while self.deferred and self.deferred[0][0] <= now:
+                readyTime, priority, sequence, call = heapq.heappop(self.deferred)
+                heapq.heappush(self.pending, (priority, sequence, call))
+            while self.pending:
+                priority, sequence, call = heapq.heappop(self.pending)
+                bucket = self.bucket(call.route)
+                waitTime = max(bucket.delay(now), self.globalBucket.delay(now))
+                if waitTime <= 0:
+                    bucket.take(now)
+                    self.globalBucket.take(now)
+                    return call
+                heapq.heappush(self.deferred, (now + waitTime, priority, sequence, call))
+            # sleep until a call is submitted or the next bucket refills
+            self.wakeup.clear()
+            timeout = self.deferred[0][0] - now if self.deferred else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.slots.acquire()
+            try:
+                call = await self.next_call()
+            except asyncio.CancelledError:
+                self.slots.release()
+                raise
+            loop.create_task(self.execute(call))
+
+    async def execute(self, call):
+        start = time.monotonic()
+        kind = call.route.split(':', 1)[0]
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        try:
+            result = await call.func(*call.args, **call.kwargs)
+        except Exception as error:
+            rateLimited = getattr(error, 'status', None) == 429
+            if rateLimited:
+                self.rateLimitHits += 1
+                self.routeRateLimitHits[kind] = self.routeRateLimitHits.get(kind, 0) + 1
+            if rateLimited and call.attempts < self.maxRetries:
+                # back off the route and try the call again
+                self.retries += 1
+                call.attempts += 1
+                retryAfter = getattr(error, 'retry_after', None) or 1.0
+                self.bucket(call.route).block(time.monotonic() + retryAfter)
+                if getattr(error, 'is_global', False):
+                    self.globalBucket.block(time.monotonic() + retryAfter)
+                self.enqueue(call)
+            else:
+                self.failures += 1
+                if not call.future.done():
+                    call.future.set_exception(error)
+        else:
+            self.completed[call.priority] += 1
+            self.totalWait[call.priority] += start - call.submitted
+            if not call.future.done():
+                call.future.set_result(result)
+        finally:
+            latency = time.monotonic() - start
+            if kind not in self.routeLatency:
+                self.routeLatency[kind] = metrics.Histogram()
+            self.routeLatency[kind].observe(latency)
+            self.totalLatency += latency
+            self.maxLatency = max(self.maxLatency, latency)
+            self.slots.release()
+
+    def stats(self):
+        averageWait = dict()
+        for priority in range(len(priorityNames)):
+            completed = self.completed[priority]
+            averageWait[priorityNames[priority]] = self.totalWait[priority] / completed * 1000 if completed else 0.0
+        totalCalls = sum(self.calls.values())
+        return {'calls': dict(self.calls), 'queued': self.queued(), 'buckets': len(self.buckets), 'rateLimitHits': self.rateLimitHits, 'retries': self.retries,
+                'failures': self.failures, 'averageLatencyMs': self.totalLatency / totalCalls * 1000 if totalCalls else 0.0,
+                'maxLatencyMs': self.maxLatency * 1000, 'averageWaitMs': averageWait}
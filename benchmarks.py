@@ -0,0 +1,245 @@
+import asyncio
+import os
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import api_scheduler
+import fake_discord
+import load_simulation
+import tutor_bot
+import tutor_store
+import user_repository
+
+# run with: python benchmarks.py [benchmark name ...]
+
+
+def make_tutor_manager(tutorCount):
+    # builds a tutor manager where every tutor teaches math and has answered a question at a different time
+    tutorManager = tutor_bot.TutorManager()
+    start = datetime.now() - timedelta(days=1)
+    for i in range(tutorCount):
+        tutor = tutor_bot.Tutor()
+        tutor.id = i
+        tutor.subjects = ['math']
+        tutor.lastQuestion = start + timedelta(seconds=(i * 7919) % tutorCount)
+        tutorManager.add_tutor(tutor)
+    return tutorManager
+
+
+def scan_request_tutor(tutorManager, subject):
+    # the linear scan request_tutor used before the idle index
+    assignedTutor = None
+    for tutor in tutorManager.subjectTutors[subject]:
+        tutor = tutorManager.tutorList[tutor]
+        if tutor.busy:
+            continue
+        if assignedTutor == None:
+            assignedTutor = tutor
+        elif assignedTutor.lastQuestion > tutor.lastQuestion:
+            assignedTutor = tutor
+    if assignedTutor != None:
+        assignedTutor.busy = True
+    return assignedTutor
+
+
+def scan_mark_done(tutorManager, tutorId):
+    tutor = tutorManager.tutorList[tutorId]
+    tutor.busy = False
+    tutor.lastQuestion = datetime.now()
+
+
+def time_request_cycle(tutorManager, requestTutor, markDone, iterations):
+    # keeps half of the tutors busy and times request + done cycles
+    busyTutors = [requestTutor(tutorManager, 'math').id for i in range(len(tutorManager.tutorList) // 2)]
+    start = time.perf_counter()
+    for i in range(iterations):
+        tutor = requestTutor(tutorManager, 'math')
+        busyTutors.append(tutor.id)
+        markDone(tutorManager, busyTutors.pop(0))
+    return (time.perf_counter() - start) / iterations
+
+
+def bench_tutor_pool():
+    print('tutors    scan request+done    indexed request+done')
+    for tutorCount in (10, 1000, 10000):
+        iterations = max(200, 200000 // tutorCount)
+        scanTime = time_request_cycle(make_tutor_manager(tutorCount), scan_request_tutor, scan_mark_done, iterations)
+        indexedTime = time_request_cycle(make_tutor_manager(tutorCount),
+                                         lambda manager, subject: manager.request_tutor(subject),
+                                         lambda manager, tutorId: manager.mark_done(tutorId),
+                                         iterations)
+        print('%-9d %14.2f us %19.2f us' % (tutorCount, scanTime * 1e6, indexedTime * 1e6))
+
+
+def make_user_list(userCount):
+    userList = dict()
+    for i in range(userCount):
+        user = tutor_bot.TutorUser()
+        user.privateChannelId = 700000000000000000 + i
+        user.helpMessageId = 800000000000000000 + i
+        user.email = 'student%s@example.com' % (i)
+        userList[100000000000000000 + i] = user
+    return userList
+
+
+def bench_state_store(userCount=100000):
+    userList = make_user_list(userCount)
+    guildId = 600000000000000000
+    with tempfile.TemporaryDirectory() as directory:
+        # whole-file pickle: everything is written at shutdown and read back at startup
+        pickleFilePath = os.path.join(directory, 'user_list')
+        start = time.perf_counter()
+        with open(pickleFilePath, 'wb') as pickleFile:
+            pickle.dump(userList, pickleFile)
+        pickleShutdown = time.perf_counter() - start
+        start = time.perf_counter()
+        with open(pickleFilePath, 'rb') as pickleFile:
+            pickle.load(pickleFile)
+        pickleStartup = time.perf_counter() - start
+        # state store: each change is written as it happens, shutdown only checkpoints
+        store = tutor_store.StateStore(os.path.join(directory, 'tutor_state.db'))
+        store.put_users(guildId, (user.to_row(userId) for userId, user in userList.items()))
+        # users spread over the table like the ones active on a day
+        userIds = list(userList)[::max(1, userCount // 1000)][:1000]
+        start = time.perf_counter()
+        for userId in userIds:
+            store.put_user(guildId, userList[userId].to_row(userId))
+        storeWrite = (time.perf_counter() - start) / len(userIds)
+        start = time.perf_counter()
+        store.close()
+        storeShutdown = time.perf_counter() - start
+        # users are read when first used, startup only opens the store
+        start = time.perf_counter()
+        store = tutor_store.StateStore(os.path.join(directory, 'tutor_state.db'))
+        users = user_repository.UserRepository(store, guildId, tutor_bot.TutorUser)
+        storeStartup = time.perf_counter() - start
+        start = time.perf_counter()
+        for userId in userIds:
+            users[userId]
+        storeLoad = (time.perf_counter() - start) / len(userIds)
+        # changes are written back in batches, which are timed by the event loop
+        loop = asyncio.new_event_loop()
+        users.start(loop)
+        start = time.perf_counter()
+        for userId in userIds:
+            users.mark_dirty(userId)
+        users.stop()
+        repositoryWrite = (time.perf_counter() - start) / len(userIds)
+        loop.close()
+        store.close()
+    print('%s users' % (userCount))
+    print('pickle   startup %8.3f s   shutdown %8.3f s' % (pickleStartup, pickleShutdown))
+    print('store    startup %8.3f s   shutdown %8.3f s   per change %8.2f us' % (storeStartup, storeShutdown, storeWrite * 1e6))
+    print('lazy     first use %6.2f us per user   batched change %8.2f us' % (storeLoad * 1e6, repositoryWrite * 1e6))
+
+
+class LegacyTutorUser:
+    # TutorUser as it was before __slots__, with an instance dict and its own copy of the subject table
+    def __init__(self):
+        self.__subscribedSubjects = 0
+        self.helpMessageId = None
+        self.privateChannelId = None
+        self.assignedTutors = list()
+        self.email = None
+
+        self.subjects = {'math': 0x1, 'hist': 0x2, 'geo': 0x4, 'bio': 0x8, 'chem': 0x10, 'physics': 0x20, 'comp sci': 0x40}
+
+
+def measure_users(userClass, userCount):
+    # returns the bytes allocated per user and the pickled bytes per user of a user list built from userClass
+    tracemalloc.start()
+    userList = dict()
+    for i in range(userCount):
+        user = userClass()
+        user.privateChannelId = 700000000000000000 + i
+        user.helpMessageId = 800000000000000000 + i
+        user.email = 'student%s@example.com' % (i)
+        userList[100000000000000000 + i] = user
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return allocated / userCount, len(pickle.dumps(userList)) / userCount
+
+
+def bench_user_memory(userCount=100000):
+    # ids and emails are allocated the same way for both, so the difference is the record itself
+    print('%s users' % (userCount))
+    for name, userClass in (('dict', LegacyTutorUser), ('slots', tutor_bot.TutorUser)):
+        allocated, pickled = measure_users(userClass, userCount)
+        print('%-6s %7.1f bytes per user in memory   %7.1f bytes per user pickled' % (name, allocated, pickled))
+
+
+async def provision_channel(request, channelId):
+    # the calls create_private_channel makes for one member
+    await request('create_channel:1', channelId, priority=api_scheduler.PRIORITY_HOUSEKEEPING)
+    for i in range(2):
+        await request('permissions:%s' % (channelId), priority=api_scheduler.PRIORITY_HOUSEKEEPING)
+    for i in range(3):
+        await request('send:%s' % (channelId), priority=api_scheduler.PRIORITY_HOUSEKEEPING)
+    for i in range(8):
+        await request('reaction:%s' % (channelId), priority=api_scheduler.PRIORITY_HOUSEKEEPING)
+    await request('pin:%s' % (channelId), priority=api_scheduler.PRIORITY_HOUSEKEEPING)
+
+
+async def assign_tutor_calls(request, channelId, latencies):
+    # the calls assign_tutor makes once a tutor is found
+    start = time.perf_counter()
+    await request('permissions:%s' % (channelId), priority=api_scheduler.PRIORITY_USER)
+    await request('send:%s' % (channelId), priority=api_scheduler.PRIORITY_USER)
+    latencies.append(time.perf_counter() - start)
+
+
+async def run_startup_burst(useScheduler, memberCount, assignCount):
+    fakeHttp = fake_discord.FakeHttp()
+    scheduler = api_scheduler.ApiScheduler()
+    failures = list()
+
+    async def request(route, result=None, priority=api_scheduler.PRIORITY_NORMAL):
+        if useScheduler:
+            return await scheduler.call(route, fakeHttp.request, route, result, priority=priority)
+        try:
+            return await fakeHttp.request(route, result)
+        except fake_discord.FakeHTTPException as error:
+            failures.append(error)
+
+    async def students(latencies):
+        # students ask for tutors while on_ready provisions channels
+        for i in range(assignCount):
+            await asyncio.sleep(0.1)
+            await assign_tutor_calls(request, 900000 + i, latencies)
+
+    latencies = list()
+    start = time.perf_counter()
+    await asyncio.gather(students(latencies), *[provision_channel(request, 100000 + i) for i in range(memberCount)])
+    elapsed = time.perf_counter() - start
+    scheduler.stop()
+    return elapsed, fakeHttp, len(failures), latencies
+
+
+def bench_api_scheduler(memberCount=10, assignCount=20):
+    print('%s members provisioned at startup while %s tutors are assigned' % (memberCount, assignCount))
+    for useScheduler in (False, True):
+        elapsed, fakeHttp, failures, latencies = asyncio.run(run_startup_burst(useScheduler, memberCount, assignCount))
+        latencies.sort()
+        print('%-10s %6.2f s  %4d requests  %4d answered 429  %4d failed calls  assign p50 %7.1f ms  max %7.1f ms' % (
+              'scheduled' if useScheduler else 'direct', elapsed, fakeHttp.requests, fakeHttp.rateLimited, failures,
+              latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000))
+
+
+benchmarks = {
+    'tutor_pool': bench_tutor_pool,
+    'state_store': bench_state_store,
+    'api_scheduler': bench_api_scheduler,
+    'user_memory': bench_user_memory,
+    'load': load_simulation.bench_load,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(benchmarks)
+    for name in names:
+        print('== %s' % (name))
+        benchmarks[name]()
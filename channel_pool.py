@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from collections import deque
+
+# topic of pooled channels that are not bound to a user yet
+POOL_TOPIC = 'pool'
+
+
+class ChannelPool:
+    # keeps a number of private channels per guild built ahead of time, so a joining member only has to be bound to one
+
+    def __init__(self, buildChannel, store, lowWatermark=5, highWatermark=20):
+        # coroutine function(guild) building a pool channel and returning (channel id, help message id)
+        self.buildChannel = buildChannel
+        self.store = store
+        # refilling starts once a guild has fewer than lowWatermark channels and stops at highWatermark
+        self.lowWatermark = lowWatermark
+        self.highWatermark = highWatermark
+        # dict storing guild id->deque of (channel id, help message id), oldest first
+        self.channels = dict()
+        # set of the ids of all pooled channels
+        self.channelIds = set()
+        # dict storing guild id->refill task
+        self.refillTasks = dict()
+        self.acquired = 0
+        self.misses = 0
+        self.built = 0
+        self.failures = 0
+
+    def load(self, guild):
+        # restore the guild's pool from the store, dropping channels that were deleted while the bot was down
+        pool = self.channels.setdefault(guild.id, deque())
+        for channelId, helpMessageId in self.store.load_pool_channels(guild.id):
+            if channelId in self.channelIds:
+                continue
+            if guild.get_channel(channelId) == None:
+                self.store.delete_pool_channel(channelId)
+                continue
+            pool.append((channelId, helpMessageId))
+            self.channelIds.add(channelId)
+
+    def size(self, guild):
+        return len(self.channels.get(guild.id, ()))
+
+    def is_pool_channel(self, channelId):
+        return channelId in self.channelIds
+
+    def acquire(self, guild):
+        # takes a built channel out of the pool, returns (channel, help message id) or None if the pool is empty
+        pool = self.channels.get(guild.id)
+        found = None
+        while pool and found == None:
+            channelId, helpMessageId = pool.popleft()
+            self.channelIds.discard(channelId)
+            self.store.delete_pool_channel(channelId)
+            channel = guild.get_channel(channelId)
+            if channel != None:
+                found = (channel, helpMessageId)
+        if found == None:
+            self.misses += 1
+        else:
+            self.acquired += 1
+        self.refill(guild)
+        return found
+
+    def discard(self, channelId):
+        # forget a pooled channel that was deleted
+        if channelId not in self.channelIds:
+            return
+        self.channelIds.discard(channelId)
+        self.store.delete_pool_channel(channelId)
+        for pool in self.channels.values():
+            for entry in pool:
+                if entry[0] == channelId:
+                    pool.remove(entry)
+                    return
+
+    def refill(self, guild):
+        # start refilling the guild's pool in the background once it drops below the low watermark
+        if self.size(guild) >= self.lowWatermark:
+            return
+        task = self.refillTasks.get(guild.id)
+        if task != None and not task.done():
+            return
+        self.refillTasks[guild.id] = asyncio.get_running_loop().create_task(self.fill(guild))
+
+    async def fill(self, guild):
+        pool = self.channels.setdefault(guild.id, deque())
+        while len(pool) < self.highWatermark:
+            try:
+                channelId, helpMessageId = await self.buildChannel(guild)
+            except Exception:
+                self.failures += 1
+                logging.exception("could not build a pool channel for guild %s" % (guild.id))
+                return
+            pool.append((channelId, helpMessageId))
+            self.channelIds.add(channelId)
+            self.store.put_pool_channel(channelId, guild.id, helpMessageId)
+            self.built += 1
+
+    def stop(self):
+        for task in self.refillTasks.values():
+            task.cancel()
+        self.refillTasks = dict()
+
+    def stats(self):
+        return {'pooled': len(self.channelIds), 'acquired': self.acquired, 'misses': self.misses, 'built': self.built, 'failures': self.failures}
@@ -0,0 +1,174 @@
+import asyncio
+import random
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import load_simulation
+import tutor_bot
+
+# randomized checks of the indexes that replaced simple scans against naive models of them, and checks of
+# behaviour that has broken before against a simulated guild
+# run with: python checks.py [check name ...]
+
+
+class NaiveTutors:
+    # the tutor pool as plain flags, request_tutor picks an idle tutor of the subject with the oldest last question
+    def __init__(self):
+        self.subjects = dict()
+        self.lastQuestion = dict()
+        # tutors assigned to a student, busy until marked done whatever their status
+        self.helping = set()
+        # tutors who are offline, busy until they come back whether or not they are helping
+        self.offline = set()
+
+    def is_busy(self, tutorId):
+        return tutorId in self.helping or tutorId in self.offline
+
+    def idle_keys(self, subject):
+        return [tutor_bot.last_question_key(self.lastQuestion[tutorId]) for tutorId, tutorSubjects in self.subjects.items()
+                if subject in tutorSubjects and not self.is_busy(tutorId)]
+
+
+def check_tutor_index(steps=20000, seed=1):
+    randomizer = random.Random(seed)
+    tutorManager = tutor_bot.TutorManager()
+    model = NaiveTutors()
+    start = datetime.now() - timedelta(days=1)
+    for step in range(steps):
+        action = randomizer.random()
+        tutorId = randomizer.randrange(40)
+        if action < 0.15 or tutorId not in model.subjects:
+            # a new tutor or changed tutor roles
+            tutor = tutorManager.get_tutor_by_id(tutorId) or tutor_bot.Tutor()
+            tutor.id = tutorId
+            tutor.subjects = randomizer.sample(tutor_bot.subjects, randomizer.randrange(4))
+            if tutorId not in model.subjects:
+                tutor.lastQuestion = randomizer.choice([0, start + timedelta(seconds=randomizer.randrange(1000))])
+            tutorManager.add_tutor(tutor)
+            model.subjects[tutorId] = list(tutor.subjects)
+            model.lastQuestion[tutorId] = tutor.lastQuestion
+        elif action < 0.5:
+            subject = randomizer.choice(tutor_bot.subjects)
+            keys = model.idle_keys(subject)
+            tutor = tutorManager.request_tutor(subject)
+            if not keys:
+                assert tutor == None, 'step %s: got tutor %s for %s with none idle' % (step, tutor.id, subject)
+                continue
+            assert tutor != None, 'step %s: no tutor for %s with %s idle' % (step, subject, len(keys))
+            assert subject in model.subjects[tutor.id] and not model.is_busy(tutor.id), 'step %s: tutor %s is not idle in %s' % (step, tutor.id, subject)
+            assert tutor_bot.last_question_key(tutor.lastQuestion) == min(keys), 'step %s: tutor %s is not the least recently used' % (step, tutor.id)
+            model.helping.add(tutor.id)
+        elif action < 0.7:
+            if tutorId in model.helping:
+                # finishing does not make an offline tutor idle
+                tutorManager.mark_done(tutorId)
+                model.helping.discard(tutorId)
+                model.lastQuestion[tutorId] = tutorManager.tutorList[tutorId].lastQuestion
+                assert tutorManager.is_busy(tutorId) == (tutorId in model.offline), 'step %s: tutor %s done while %s' % (
+                       step, tutorId, 'offline' if tutorId in model.offline else 'online')
+        elif action < 0.8:
+            if tutorManager.request_tutor_by_id(tutorId) != None:
+                assert not model.is_busy(tutorId), 'step %s: busy tutor %s was handed out' % (step, tutorId)
+                model.helping.add(tutorId)
+        elif action < 0.9:
+            # tutors going offline
+            tutorManager.set_busy(tutorId)
+            model.offline.add(tutorId)
+        else:
+            # and coming back, which does not free the ones helping a student
+            idle = tutorManager.set_unbusy(tutorId)
+            assert idle == (tutorId not in model.helping), 'step %s: tutor %s came back %s' % (step, tutorId, 'idle' if idle else 'busy')
+            model.offline.discard(tutorId)
+        for subject in tutor_bot.subjects:
+            assert len(tutorManager.idleTutors[subject]) <= 2 * len(tutorManager.subjectTutors[subject]) + 16, 'step %s: stale entries pile up' % (step)
+
+
+def check_queue(steps=20000, seed=2):
+    # the queue against a list per subject, positions are indexes into the list
+    randomizer = random.Random(seed)
+    tutorManager = tutor_bot.TutorManager()
+    model = {subject: list() for subject in tutor_bot.subjects}
+    for step in range(steps):
+        action = randomizer.random()
+        userId = randomizer.randrange(60)
+        queuedSubject = next((subject for subject, userIds in model.items() if userId in userIds), None)
+        if action < 0.45:
+            subject = randomizer.choice(tutor_bot.subjects)
+            position = tutorManager.add_to_queue(userId, None, subject)
+            if queuedSubject == None:
+                model[subject].append(userId)
+                queuedSubject = subject
+            assert position == model[queuedSubject].index(userId) + 1, 'step %s: user %s queued at %s' % (step, userId, position)
+        elif action < 0.75:
+            # leaving from anywhere in the queue
+            assert tutorManager.remove_from_queue(userId) == (queuedSubject != None), 'step %s: removing user %s' % (step, userId)
+            if queuedSubject != None:
+                model[queuedSubject].remove(userId)
+        else:
+            # served from the head, as match_queue does
+            subject = randomizer.choice(tutor_bot.subjects)
+            if model[subject]:
+                assert tutorManager.remove_from_queue(model[subject].pop(0)), 'step %s: head of %s was not queued' % (step, subject)
+        for subject, userIds in model.items():
+            assert tutorManager.queue_length(subject) == len(userIds), 'step %s: %s queue has %s users' % (step, subject, tutorManager.queue_length(subject))
+            for index, queuedUserId in enumerate(userIds):
+                position = tutorManager.queue_position(queuedUserId)
+                assert position == index + 1, 'step %s: user %s is at %s instead of %s' % (step, queuedUserId, position, index + 1)
+
+
+async def close_twice(directory):
+    simulation = load_simulation.Simulation(directory, 200, 20)
+    bot = await simulation.start_bot(load_simulation.always_open())
+    await bot.close()
+    await bot.close()
+    assert bot.store.closed, 'the store was left open'
+    try:
+        bot.store.put_user(simulation.guild.id, (1, 0, None, None, None, None))
+    except sqlite3.ProgrammingError:
+        return
+    raise AssertionError('a closed store took a write')
+
+
+def check_close():
+    # closing the bot twice writes the last changes once and leaves the store closed
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(close_twice(directory))
+
+
+async def reconcile_partial_members(directory):
+    simulation = load_simulation.Simulation(directory, 300, 20, onlineFraction=0.5)
+    # half of the students with a private channel are missing from the member list
+    students = [member for member in simulation.students if member.status != tutor_bot.discord.Status.offline]
+    for member in students[::2]:
+        simulation.guild.uncache_member(member)
+    channelIds = set(channel.id for channel in simulation.privChannelCategory.channels)
+    bot = await simulation.start_bot(load_simulation.always_open())
+    counters = bot.reconciler.progress[simulation.guild.id]
+    remaining = set(channel.id for channel in simulation.privChannelCategory.channels)
+    await bot.close()
+    assert counters['orphans'] == 0, '%s channels were deleted as orphans' % (counters['orphans'])
+    assert counters['unverified'] == len(students[::2]), '%s channels of unknown members were kept' % (counters['unverified'])
+    assert channelIds <= remaining, '%s private channels were deleted' % (len(channelIds - remaining))
+
+
+def check_reconcile_partial_members():
+    # channels of members missing from an incomplete member list are not orphans
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(reconcile_partial_members(directory))
+
+
+checks = {
+    'tutor_index': check_tutor_index,
+    'queue': check_queue,
+    'close': check_close,
+    'reconcile_partial_members': check_reconcile_partial_members,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(checks)
+    for name in names:
+        checks[name]()
+        print('%s ok' % (name))
@@ -0,0 +1,74 @@
+import time
+
+import metrics
+
+
+class Command:
+    def __init__(self, name, handler, roles=None):
+        self.name = name
+        # coroutine function called with the message and the text after the command name
+        self.handler = handler
+        # names of the roles allowed to run the command, None allows everyone
+        self.roles = roles
+        self.invocations = 0
+        self.denied = 0
+        self.failures = 0
+        # seconds each run took, exported as tutorbot_command_seconds
+        self.latency = metrics.Histogram()
+
+
+class CommandRouter:
+    # dispatches guild messages to commands by name, messages without the prefix are rejected with a single check
+
+    def __init__(self, resolveRole, prefix='!'):
+        # function(guild, role name) returning the role, used to check permissions after a command matched
+        self.resolveRole = resolveRole
+        self.prefix = prefix
+        # dict storing command name->command
+        self.commands = dict()
+
+    def add_command(self, name, handler, roles=None):
+        self.commands[name] = Command(name, handler, roles)
+
+    async def dispatch(self, message):
+        # returns whether the message was a command
+        content = message.content
+        if not content.startswith(self.prefix):
+            return False
+        parts = content[len(self.prefix):].split(None, 1)
+        if not parts:
+            return False
+        command = self.commands.get(parts[0])
+        if command == None:
+            return False
+        if not self.is_allowed(command, message.author):
+            command.denied += 1
+            return True
+        arguments = parts[1] if len(parts) > 1 else ''
+        start = time.perf_counter()
+        try:
+            await command.handler(message, arguments)
+        except Exception:
+            command.failures += 1
+            raise
+        finally:
+            command.invocations += 1
+            command.latency.observe(time.perf_counter() - start)
+        return True
+
+    def is_allowed(self, command, member):
+        if command.roles == None:
+            return True
+        for roleName in command.roles:
+            role = self.resolveRole(member.guild, roleName)
+            if role != None and role in member.roles:
+                return True
+        return False
+
+    def stats(self):
+        # dict storing command name->counters and the latency histogram
+        commandStats = dict()
+        for name, command in self.commands.items():
+            commandStats[name] = {'invocations': command.invocations, 'denied': command.denied, 'failures': command.failures,
+                                  'latency': command.latency}
+        return commandStats
@@ -0,0 +1,53 @@
+import csv
+import hashlib
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+
+exportFormats = ('csv', 'jsonl')
+exportColumns = ('user_id', 'email', 'verified_at')
+
+
+def email_key(email):
+    # key of the email->user index, the hash keeps the index small and the same address in any case maps to one user
+    return hashlib.blake2b(email.strip().lower().encode('utf-8'), digest_size=16).digest()
+
+
+def export_emails(databasePath, outputPath, guildId, exportFormat='csv', since=None):
+    # writes the emails of the guild's users to outputPath, only the users whose email changed after since if it is set, in which case
+    # cleared emails are written with an empty email. returns (rows written, latest change written or since).
+    # meant to run in a worker thread: it reads through its own connection, which WAL lets run alongside the bot's writes
+    if exportFormat not in exportFormats:
+        raise ValueError("unknown export format %s" % (exportFormat))
+    connection = sqlite3.connect(databasePath)
+    try:
+        if since == None:
+            rows = connection.execute('SELECT id, email, email_changed_at FROM users WHERE guild_id = ? AND email IS NOT NULL ORDER BY id', (guildId,))
+        else:
+            rows = connection.execute('SELECT id, email, email_changed_at FROM users WHERE guild_id = ? AND email_changed_at > ? ORDER BY email_changed_at',
+                                      (guildId, since))
+        # write to a temporary file first so a reader never sees half an export
+        temporaryPath = outputPath + '.tmp'
+        written = 0
+        latestChange = since
+        with open(temporaryPath, 'w', newline='', encoding='utf-8') as exportFile:
+            writer = None
+            if exportFormat == 'csv':
+                writer = csv.writer(exportFile)
+                writer.writerow(exportColumns)
+            for userId, email, changedAt in rows:
+                verifiedAt = ''
+                if email and changedAt != None:
+                    verifiedAt = datetime.fromtimestamp(changedAt, timezone.utc).isoformat()
+                if writer != None:
+                    writer.writerow((userId, email or '', verifiedAt))
+                else:
+                    exportFile.write(json.dumps(dict(zip(exportColumns, (userId, email or '', verifiedAt)))) + '\n')
+                written += 1
+                if changedAt != None and (latestChange == None or changedAt > latestChange):
+                    latestChange = changedAt
+        os.replace(temporaryPath, outputPath)
+        return written, latestChange
+    finally:
+        connection.close()
@@ -0,0 +1,143 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import time
+
+TRACE_VERSION = 1
+# events coming from users, everything else the bot handles is mostly the echo of its own api calls and happens again on replay
+tracedEvents = ('member_join', 'member_update', 'message', 'raw_reaction_add')
+mentionPattern = re.compile(r'<@!?(\d+)>')
+emailPattern = re.compile(r"[^@]+@[^@]+\.[^@]+")
+
+
+def open_trace(path, mode):
+    # traces ending in .gz are compressed
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def read_trace(path):
+    # yields the records of a trace, the header first
+    with open_trace(path, 'r') as traceFile:
+        for line in traceFile:
+            if line.strip():
+                yield json.loads(line)
+
+
+def status_name(status):
+    return getattr(status, 'value', str(status))
+
+
+class TraceRecorder:
+    # writes the user events the bot handles to a JSONL trace, starting with the guilds and stored users they apply to.
+    # ids go through a keyed hash whose key is not kept, message text is dropped except for commands and the shape of emails,
+    # so a trace can be replayed (see trace_replay.py) but not tied back to anyone
+
+    def __init__(self, bot, path):
+        self.bot = bot
+        self.path = path
+        self.key = os.urandom(16)
+        self.traceFile = None
+        self.start = None
+        self.recorded = 0
+
+    def anonymize(self, snowflake):
+        # the same id always maps to the same anonymous one within a trace
+        digest = hashlib.blake2b(int(snowflake).to_bytes(8, 'little'), key=self.key, digest_size=7).digest()
+        return int.from_bytes(digest, 'little')
+
+    def anonymize_email(self, email):
+        # keeps which users share an email, which the verification checks for
+        digest = hashlib.blake2b(email.strip().lower().encode('utf-8'), key=self.key, digest_size=7).hexdigest()
+        return 'user%s@example.com' % (digest)
+
+    def open(self):
+        self.traceFile = open_trace(self.path, 'w')
+        self.start = time.monotonic()
+        self.write({'version': TRACE_VERSION, 'recordedAt': time.time(), 'bot': self.anonymize(self.bot.user.id),
+                    'guilds': [self.describe_guild(guild) for guild in self.bot.guilds]})
+
+    def close(self):
+        if self.traceFile != None:
+            self.traceFile.close()
+            self.traceFile = None
+
+    def write(self, record):
+        self.traceFile.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def describe_guild(self, guild):
+        # the guild as the replay has to rebuild it, private channels are rebuilt from the stored users
+        state = self.bot.guild_state(guild)
+        privateChannelIds = set(channelId for channelId, userId in state.private_channels())
+        channels = list()
+        for channel in guild.channels:
+            if channel.id in privateChannelIds or self.bot.channelPool.is_pool_channel(channel.id):
+                continue
+            category = getattr(channel, 'category', None)
+            channels.append({'name': channel.name, 'category': None if category == None else category.name,
+                             'isCategory': hasattr(channel, 'channels')})
+        users = list()
+        for userId, user in state.userList.items():
+            users.append({'id': self.anonymize(userId), 'subjects': user.to_row(userId)[1], 'channel': user.privateChannelId != None,
+                          'email': self.anonymize_email(user.email) if user.email else None})
+        return {'id': self.anonymize(guild.id), 'roles': [role.name for role in guild.roles if role != guild.default_role],
+                'channels': channels, 'members': [self.describe_member(member) for member in guild.members], 'users': users}
+
+    def describe_member(self, member):
+        return {'id': self.anonymize(member.id), 'status': status_name(member.status),
+                'roles': [role.name for role in member.roles if role != member.guild.default_role]}
+
+    def describe_channel(self, channel):
+        # private channels are referred to by their owner, since the replay creates them under other ids
+        guild = getattr(channel, 'guild', None)
+        if guild == None:
+            return {'dm': True}
+        state = self.bot.guildStates.get(guild.id)
+        owner = None if state == None else state.find_channel_owner(channel.id)
+        if owner != None:
+            return {'owner': self.anonymize(owner)}
+        return {'name': channel.name}
+
+    def anonymize_text(self, content):
+        if content.startswith('!'):
+            # commands keep their arguments, mentions point at the anonymous ids
+            return mentionPattern.sub(lambda match: '<@%s>' % (self.anonymize(int(match.group(1)))), content)
+        if emailPattern.match(content):
+            return self.anonymize_email(content)
+        return 'x' * min(len(content), 200)
+
+    def record(self, event, args):
+        # called with the arguments of every event the bot is dispatched, before its handler runs
+        if self.traceFile == None or event not in tracedEvents:
+            return
+        record = {'t': round(time.monotonic() - self.start, 4), 'event': event}
+        if event == 'member_join':
+            record['guild'] = self.anonymize(args[0].guild.id)
+            record['member'] = self.describe_member(args[0])
+        elif event == 'member_update':
+            record['guild'] = self.anonymize(args[1].guild.id)
+            record['before'] = self.describe_member(args[0])
+            record['after'] = self.describe_member(args[1])
+        elif event == 'message':
+            message = args[0]
+            if message.author == self.bot.user:
+                return
+            record['guild'] = None if message.guild == None else self.anonymize(message.guild.id)
+            record['author'] = self.anonymize(message.author.id)
+            record['channel'] = self.describe_channel(message.channel)
+            record['content'] = self.anonymize_text(message.content)
+            record['mentions'] = [self.anonymize(member.id) for member in message.mentions]
+        elif event == 'raw_reaction_add':
+            payload = args[0]
+            state = self.bot.guildStates.get(payload.guild_id)
+            # the bot only acts on reactions of users to their own help message
+            if state == None or state.find_help_message_owner(payload.message_id) != payload.user_id:
+                return
+            record['guild'] = self.anonymize(payload.guild_id)
+            record['user'] = self.anonymize(payload.user_id)
+            record['emoji'] = str(payload.emoji)
+        self.write(record)
+        self.recorded += 1
@@ -0,0 +1,491 @@
+import asyncio
+import logging
+import time
+
+import discord
+
+import metrics
+
+# local stand-ins for the parts of discord the bot talks to, used by the benchmarks so they run without a network
+
+# route kind->(calls allowed, window in seconds) per major id, modelled on discord's documented limits
+fakeRouteLimits = {
+    'send': (5, 5.0),
+    'reaction': (1, 0.25),
+    'pin': (5, 5.0),
+    'permissions': (10, 10.0),
+    'create_channel': (10, 10.0),
+    'role': (10, 10.0),
+    'delete_channel': (5, 5.0),
+    'edit_channel': (2, 600.0),
+    'dm': (5, 5.0),
+}
+fakeDefaultLimit = (5, 5.0)
+fakeGlobalLimit = (50, 1.0)
+
+
+class FakeHTTPException(Exception):
+    def __init__(self, status, message, retry_after=None, is_global=False):
+        super().__init__('%s %s' % (status, message))
+        self.status = status
+        self.retry_after = retry_after
+        self.is_global = is_global
+
+
+class FixedWindow:
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.resetAt = 0.0
+        self.used = 0
+
+    def hit(self, now):
+        # returns 0 if the call is allowed, otherwise the seconds until the window resets
+        if now >= self.resetAt:
+            self.resetAt = now + self.window
+            self.used = 0
+        if self.used >= self.limit:
+            return self.resetAt - now
+        self.used += 1
+        return 0
+
+
+class FakeHttp:
+    # stand-in for discord's REST api that answers 429 once a route or the global limit is exceeded
+
+    def __init__(self, latency=0.005, timeScale=1.0):
+        self.latency = latency
+        # every window is divided by timeScale, see ApiScheduler.timeScale
+        self.timeScale = timeScale
+        # dict storing route->fixed window
+        self.windows = dict()
+        self.globalWindow = FixedWindow(fakeGlobalLimit[0], fakeGlobalLimit[1] / timeScale)
+        self.requests = 0
+        self.rateLimited = 0
+        # dict storing route kind->number of successful requests
+        self.routeRequests = dict()
+
+    def window(self, route):
+        window = self.windows.get(route)
+        if window == None:
+            limit, windowLength = fakeRouteLimits.get(route.split(':', 1)[0], fakeDefaultLimit)
+            window = FixedWindow(limit, windowLength / self.timeScale)
+            self.windows[route] = window
+        return window
+
+    async def request(self, route, result=None):
+        now = time.monotonic()
+        retryAfter = self.globalWindow.hit(now)
+        if retryAfter:
+            self.rateLimited += 1
+            raise FakeHTTPException(429, 'global rate limit', retryAfter, True)
+        retryAfter = self.window(route).hit(now)
+        if retryAfter:
+            self.rateLimited += 1
+            raise FakeHTTPException(429, 'rate limited on %s' % (route), retryAfter)
+        await asyncio.sleep(self.latency)
+        self.requests += 1
+        kind = route.split(':', 1)[0]
+        self.routeRequests[kind] = self.routeRequests.get(kind, 0) + 1
+        return result
+
+
+# discord's epoch in unix milliseconds, ids encode their creation time relative to it
+fakeDiscordEpoch = 1420070400000
+
+
+class FakeObject:
+    # discord models compare and hash by id
+    def __eq__(self, other):
+        return isinstance(other, FakeObject) and self.id == other.id
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeRole(FakeObject):
+    def __init__(self, fake, roleId, name, guild):
+        self.fake = fake
+        self.id = roleId
+        self.name = name
+        self.guild = guild
+        self.mention = '<@&%s>' % (roleId)
+
+    @property
+    def members(self):
+        # a scan over the guild like discord.py's Role.members
+        if self == self.guild.default_role:
+            return self.guild.members
+        return [member for member in self.guild.members if self in member.roles]
+
+
+class FakeMember(FakeObject):
+    def __init__(self, fake, memberId, name, guild, status, roles=()):
+        self.fake = fake
+        self.id = memberId
+        self.name = name
+        self.display_name = name
+        self.mention = '<@%s>' % (memberId)
+        self.guild = guild
+        self.status = status
+        self.roles = list(roles)
+        self.dm_channel = None
+        self.bot = False
+
+    def __str__(self):
+        return self.name
+
+    def snapshot(self):
+        # copy handed to on_member_update as the state before a change
+        before = FakeMember(self.fake, self.id, self.name, self.guild, self.status, self.roles)
+        before.dm_channel = self.dm_channel
+        return before
+
+    async def create_dm(self):
+        await self.fake.http.request('dm:%s' % (self.id))
+        if self.dm_channel == None:
+            self.dm_channel = FakeDMChannel(self.fake, self.fake.snowflake(), self)
+        return self.dm_channel
+
+    async def add_roles(self, *roles):
+        await self.fake.http.request('role:%s' % (self.guild.id))
+        before = self.snapshot()
+        self.roles.extend(role for role in roles if role not in self.roles)
+        self.fake.dispatch('member_update', before, self)
+
+    async def remove_roles(self, *roles):
+        await self.fake.http.request('role:%s' % (self.guild.id))
+        before = self.snapshot()
+        self.roles = [role for role in self.roles if role not in roles]
+        self.fake.dispatch('member_update', before, self)
+
+
+class FakeMessage(FakeObject):
+    def __init__(self, fake, messageId, content, author, channel, mentions=()):
+        self.fake = fake
+        self.id = messageId
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = getattr(channel, 'guild', None)
+        self.mentions = list(mentions)
+        self.reactions = list()
+        self.pinned = False
+
+    async def add_reaction(self, emoji):
+        await self.fake.http.request('reaction:%s' % (self.channel.id))
+        self.reactions.append(emoji)
+
+    async def pin(self):
+        await self.fake.http.request('pin:%s' % (self.channel.id))
+        self.pinned = True
+        self.channel.pinned.append(self)
+
+    async def edit(self, content=None):
+        await self.fake.http.request('edit_message:%s' % (self.channel.id))
+        if content != None:
+            self.content = content
+
+
+class FakeMessageable(FakeObject):
+    # keeps only the newest messages of a channel so long simulations stay small
+    keptMessages = 20
+
+    def record(self, message):
+        self.messages[message.id] = message
+        self.last_message_id = message.id
+        if len(self.messages) > self.keptMessages:
+            del self.messages[next(iter(self.messages))]
+
+    async def send(self, content):
+        await self.fake.http.request('send:%s' % (self.id))
+        message = FakeMessage(self.fake, self.fake.snowflake(), content, self.fake.user, self)
+        self.record(message)
+        return message
+
+
+class FakeDMChannel(FakeMessageable):
+    def __init__(self, fake, channelId, recipient):
+        self.fake = fake
+        self.id = channelId
+        self.recipient = recipient
+        self.guild = None
+        self.messages = dict()
+        self.last_message_id = None
+
+
+class FakeCategory(FakeObject):
+    def __init__(self, fake, channelId, name, guild):
+        self.fake = fake
+        self.id = channelId
+        self.name = name
+        self.guild = guild
+        self.channels = list()
+
+
+class FakeTextChannel(FakeMessageable):
+    def __init__(self, fake, channelId, name, guild, category=None, topic=None):
+        self.fake = fake
+        self.id = channelId
+        self.name = name
+        self.mention = '<#%s>' % (channelId)
+        self.guild = guild
+        self.category = category
+        self.topic = topic
+        # dict storing role or member id->permissions set on the channel
+        self.overwrites = dict()
+        self.messages = dict()
+        self.pinned = list()
+        self.last_message_id = None
+
+    async def set_permissions(self, target, **permissions):
+        await self.fake.http.request('permissions:%s' % (self.id))
+        self.overwrites[target.id] = permissions
+
+    async def edit(self, **fields):
+        await self.fake.http.request('edit_channel:%s' % (self.id))
+        before = FakeTextChannel(self.fake, self.id, self.name, self.guild, self.category, self.topic)
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.fake.dispatch('guild_channel_update', before, self)
+
+    async def pins(self):
+        await self.fake.http.request('pins:%s' % (self.id))
+        return list(self.pinned)
+
+    async def delete(self):
+        await self.fake.http.request('delete_channel:%s' % (self.guild.id))
+        self.guild.remove_channel(self)
+        self.fake.dispatch('guild_channel_delete', self)
+
+
+class FakeGuild(FakeObject):
+    def __init__(self, fake, guildId, name):
+        self.fake = fake
+        self.id = guildId
+        self.name = name
+        # dict storing id->member, role or channel
+        self.memberTable = dict()
+        self.roleTable = dict()
+        self.channelTable = dict()
+        # members of the guild that are not in the member list, like before chunking finishes
+        self.uncachedMemberCount = 0
+        self.default_role = self.add_role('@everyone')
+
+    @property
+    def members(self):
+        return list(self.memberTable.values())
+
+    @property
+    def member_count(self):
+        return len(self.memberTable) + self.uncachedMemberCount
+
+    @property
+    def chunked(self):
+        return self.uncachedMemberCount == 0
+
+    @property
+    def large(self):
+        return len(self.memberTable) > 250
+
+    @property
+    def roles(self):
+        return list(self.roleTable.values())
+
+    @property
+    def channels(self):
+        return list(self.channelTable.values())
+
+    @property
+    def categories(self):
+        return [channel for channel in self.channelTable.values() if isinstance(channel, FakeCategory)]
+
+    def get_member(self, memberId):
+        return self.memberTable.get(memberId)
+
+    def get_role(self, roleId):
+        return self.roleTable.get(roleId)
+
+    def get_channel(self, channelId):
+        return self.channelTable.get(channelId)
+
+    def add_role(self, name):
+        role = FakeRole(self.fake, self.fake.snowflake(), name, self)
+        self.roleTable[role.id] = role
+        return role
+
+    def add_member(self, name, status, roles=()):
+        member = FakeMember(self.fake, self.fake.snowflake(), name, self, status, roles)
+        self.memberTable[member.id] = member
+        self.fake.users[member.id] = member
+        return member
+
+    def uncache_member(self, member):
+        # the member stays in the guild but drops out of the member list
+        del self.memberTable[member.id]
+        self.uncachedMemberCount += 1
+
+    def add_category(self, name):
+        category = FakeCategory(self.fake, self.fake.snowflake(), name, self)
+        self.channelTable[category.id] = category
+        self.fake.channels[category.id] = category
+        return category
+
+    def add_text_channel(self, name, category=None, topic=None):
+        # adds a channel without going through the api, for building the starting state
+        channel = FakeTextChannel(self.fake, self.fake.snowflake(), name, self, category, topic)
+        self.channelTable[channel.id] = channel
+        self.fake.channels[channel.id] = channel
+        if category != None:
+            category.channels.append(channel)
+        return channel
+
+    def remove_channel(self, channel):
+        self.channelTable.pop(channel.id, None)
+        self.fake.channels.pop(channel.id, None)
+        if channel.category != None and channel in channel.category.channels:
+            channel.category.channels.remove(channel)
+
+    async def create_text_channel(self, name, overwrites=None, category=None, topic=None):
+        await self.fake.http.request('create_channel:%s' % (self.id))
+        channel = self.add_text_channel(name, category, topic)
+        self.fake.dispatch('guild_channel_create', channel)
+        return channel
+
+
+class FakeReactionPayload:
+    def __init__(self, message, member, emoji):
+        self.message_id = message.id
+        self.channel_id = message.channel.id
+        self.guild_id = member.guild.id
+        self.user_id = member.id
+        self.member = member
+        self.emoji = emoji
+
+
+class FakeDiscord:
+    # the guilds, users and channels of a local discord, its rest api and a gateway handing events to the client's
+    # on_* handlers as separate tasks like discord.py does, timing each handler
+
+    def __init__(self, http=None):
+        self.http = http if http != None else FakeHttp()
+        self.client = None
+        self.user = None
+        self.guilds = list()
+        # dict storing id->user or channel
+        self.users = dict()
+        self.channels = dict()
+        self.lastSnowflake = 0
+        # dict storing event->metrics.Reservoir of handler seconds
+        self.handlerLatency = dict()
+        # dict storing event->number of handlers that raised
+        self.handlerErrors = dict()
+        self.running = set()
+
+    def snowflake(self):
+        # a new id encoding the current time, strictly increasing
+        snowflake = max((int(time.time() * 1000) - fakeDiscordEpoch) << 22, self.lastSnowflake + 1)
+        self.lastSnowflake = snowflake
+        return snowflake
+
+    def add_guild(self, name):
+        guild = FakeGuild(self, self.snowflake(), name)
+        self.guilds.append(guild)
+        return guild
+
+    def add_bot_user(self, name):
+        self.user = FakeMember(self, self.snowflake(), name, None, discord.Status.online)
+        self.users[self.user.id] = self.user
+        return self.user
+
+    def dispatch(self, event, *args):
+        # the gateway is faked below discord.Client.dispatch, so traces are recorded here too
+        traceRecorder = getattr(self.client, 'traceRecorder', None)
+        if traceRecorder != None:
+            traceRecorder.record(event, args)
+        handler = getattr(self.client, 'on_' + event, None)
+        if handler == None:
+            return None
+        task = asyncio.get_running_loop().create_task(self.run_handler(event, handler, args))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+        return task
+
+    async def run_handler(self, event, handler, args):
+        start = time.perf_counter()
+        try:
+            await handler(*args)
+        except Exception:
+            self.handlerErrors[event] = self.handlerErrors.get(event, 0) + 1
+            logging.exception("%s handler failed" % (event))
+        finally:
+            if event not in self.handlerLatency:
+                self.handlerLatency[event] = metrics.Reservoir()
+            self.handlerLatency[event].observe(time.perf_counter() - start)
+
+    async def drain(self):
+        # waits until every dispatched handler, including the ones they cause, has finished
+        while self.running:
+            await asyncio.gather(*list(self.running), return_exceptions=True)
+
+    def join(self, guild, name, status=discord.Status.online):
+        member = guild.add_member(name, status)
+        self.dispatch('member_join', member)
+        return member
+
+    def set_status(self, member, status):
+        before = member.snapshot()
+        member.status = status
+        self.dispatch('member_update', before, member)
+
+    def send_message(self, author, channel, content, mentions=()):
+        # a message written by a user rather than the bot
+        message = FakeMessage(self, self.snowflake(), content, author, channel, mentions)
+        channel.record(message)
+        self.dispatch('message', message)
+        return message
+
+    def react(self, member, message, emoji):
+        self.dispatch('raw_reaction_add', FakeReactionPayload(message, member, emoji))
+
+
+class FakeClient(discord.Client):
+    # stands in for discord.Client without a connection. client state comes from self.fake, a FakeDiscord that has to be
+    # set before __init__ runs, and events arrive through its gateway
+    def __init__(self, *args, **kwargs):
+        # discord.Client.__init__ is skipped, it sets up the http session and gateway state the fake replaces
+        self.loop = asyncio.get_event_loop()
+        self.fake.client = self
+
+    @property
+    def user(self):
+        return self.fake.user
+
+    @property
+    def guilds(self):
+        return list(self.fake.guilds)
+
+    def get_user(self, userId):
+        return self.fake.users.get(userId)
+
+    def get_channel(self, channelId):
+        return self.fake.channels.get(channelId)
+
+    def get_guild(self, guildId):
+        for guild in self.fake.guilds:
+            if guild.id == guildId:
+                return guild
+        return None
+
+    def get_all_members(self):
+        for guild in self.fake.guilds:
+            yield from guild.members
+
+    def is_closed(self):
+        return False
+
+    async def close(self):
+        pass
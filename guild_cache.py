@@ -0,0 +1,94 @@
+ROLE = 'role'
+CHANNEL = 'channel'
+CATEGORY = 'category'
+
+
+class GuildCache:
+    # resolves roles, channels and categories by name through per-guild name->id tables. a table is built on first use,
+    # follows channels being created and deleted, and is dropped when roles or channels are renamed
+
+    def __init__(self):
+        # dict storing (guild id, kind)->dict of name->id
+        self.tables = dict()
+        # dict storing kind->number of lookups answered from an existing table
+        self.hits = {ROLE: 0, CHANNEL: 0, CATEGORY: 0}
+        # dict storing kind->number of lookups that had to build the table first
+        self.misses = {ROLE: 0, CHANNEL: 0, CATEGORY: 0}
+
+    def role(self, guild, name):
+        return self.resolve(guild, ROLE, name)
+
+    def channel(self, guild, name):
+        return self.resolve(guild, CHANNEL, name)
+
+    def category(self, guild, name):
+        return self.resolve(guild, CATEGORY, name)
+
+    def resolve(self, guild, kind, name):
+        table = self.tables.get((guild.id, kind))
+        if table == None:
+            self.misses[kind] += 1
+            table = self.build_table(guild, kind)
+        else:
+            self.hits[kind] += 1
+        objectId = table.get(name)
+        if objectId == None:
+            return None
+        if kind == ROLE:
+            found = guild.get_role(objectId)
+        else:
+            found = guild.get_channel(objectId)
+        if found == None:
+            # the table missed a delete event, rebuild it once
+            self.misses[kind] += 1
+            objectId = self.build_table(guild, kind).get(name)
+            if objectId == None:
+                return None
+            found = guild.get_role(objectId) if kind == ROLE else guild.get_channel(objectId)
+        return found
+
+    def build_table(self, guild, kind):
+        if kind == ROLE:
+            objects = guild.roles
+        elif kind == CATEGORY:
+            objects = guild.categories
+        else:
+            objects = guild.channels
+        # keep the first object of each name like discord.utils.get does
+        table = dict()
+        for guildObject in objects:
+            table.setdefault(guildObject.name, guildObject.id)
+        self.tables[(guild.id, kind)] = table
+        return table
+
+    def invalidate_roles(self, guild):
+        self.tables.pop((guild.id, ROLE), None)
+
+    def channel_tables(self, channel):
+        # the tables a channel belongs to, categories are channels too and are the ones holding channels
+        kinds = (CHANNEL, CATEGORY) if hasattr(channel, 'channels') else (CHANNEL,)
+        return [table for table in (self.tables.get((channel.guild.id, kind)) for kind in kinds) if table != None]
+
+    def add_channel(self, channel):
+        # a new channel comes after the existing ones, so it only takes a name nobody has
+        for table in self.channel_tables(channel):
+            table.setdefault(channel.name, channel.id)
+
+    def remove_channel(self, channel):
+        # channels sharing a name with the deleted one are not indexed, the table is rebuilt only if the deleted one was
+        for table in self.channel_tables(channel):
+            if table.get(channel.name) == channel.id:
+                self.invalidate_channels(channel.guild)
+                return
+
+    def invalidate_channels(self, guild):
+        # categories are channels too, so both tables are dropped
+        self.tables.pop((guild.id, CHANNEL), None)
+        self.tables.pop((guild.id, CATEGORY), None)
+
+    def invalidate_guild(self, guild):
+        self.invalidate_roles(guild)
+        self.invalidate_channels(guild)
+
+    def stats(self):
+        return {'hits': dict(self.hits), 'misses': dict(self.misses), 'tables': len(self.tables)}
@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from datetime import time as clock
+
+import discord
+
+import api_scheduler
+import fake_discord
+import office_hours
+import tutor_bot
+import tutor_store
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak memory is not reported there
+    resource = None
+
+# drives TutorBot against fake_discord with a large simulated guild, run through: python benchmarks.py load
+
+# roles and channels the bot looks up by name
+roleNames = ['Oracle Tutor', 'Tutor Bot Admin', 'Verified Email', 'welcome role'] + ['%s Tutor' % (roleName) for roleName in tutor_bot.subjectRoleNames]
+
+
+class SimulatedBot(tutor_bot.TutorBot, fake_discord.FakeClient):
+    def __init__(self, fake, timeScale, *args, **kwargs):
+        self.fake = fake
+        super().__init__(*args, **kwargs)
+        # run discord's rate limits timeScale times faster, matching the fake api
+        self.api = api_scheduler.ApiScheduler(timeScale=timeScale)
+
+
+class Simulation:
+    # a guild of memberCount members, tutorCount of them tutors, where onlineFraction of the members are online and have
+    # a private channel, stored as a previous run of the bot would have left it
+
+    def __init__(self, directory, memberCount, tutorCount, onlineFraction=0.1, tutorOnlineFraction=0.6, timeScale=200.0):
+        self.directory = directory
+        self.timeScale = timeScale
+        self.fake = fake_discord.FakeDiscord(fake_discord.FakeHttp(latency=0.001, timeScale=timeScale))
+        self.fake.add_bot_user('Tutor Bot')
+        self.guild = self.fake.add_guild('Oracle Tutoring')
+        self.roles = {name: self.guild.add_role(name) for name in roleNames}
+        self.privChannelCategory = self.guild.add_category('Your Private Channels')
+        self.guild.add_text_channel('welcome')
+        self.guild.add_text_channel('rules-and-procedures')
+        self.tutors = list()
+        self.students = list()
+        rows = list()
+        for i in range(memberCount):
+            roles = [self.roles['Verified Email']]
+            isTutor = i < tutorCount
+            if isTutor:
+                roles.append(self.roles['Oracle Tutor'])
+                roles.append(self.roles['%s Tutor' % (tutor_bot.subjectRoleNames[i % 8])])
+                roles.append(self.roles['%s Tutor' % (tutor_bot.subjectRoleNames[(i + 3) % 8])])
+                online = i < tutorCount * tutorOnlineFraction
+            else:
+                online = (i - tutorCount) < (memberCount - tutorCount) * onlineFraction
+            member = self.guild.add_member('member%s' % (i), discord.Status.online if online else discord.Status.offline, roles)
+            channelId = helpMessageId = None
+            if online:
+                channel = self.guild.add_text_channel('Your Private Channel', self.privChannelCategory, str(member.id))
+                helpMessage = fake_discord.FakeMessage(self.fake, self.fake.snowflake(), 'help', self.fake.user, channel)
+                channel.record(helpMessage)
+                channel.pinned.append(helpMessage)
+                channelId, helpMessageId = channel.id, helpMessage.id
+            rows.append((member.id, 0, helpMessageId, channelId, 'member%s@example.com' % (i), time.time()))
+            (self.tutors if isTutor else self.students).append(member)
+        store = tutor_store.StateStore(self.state_file_path())
+        store.put_users(self.guild.id, rows)
+        store.set_schema_version(tutor_store.SCHEMA_VERSION)
+        store.close()
+
+    def state_file_path(self):
+        return os.path.join(self.directory, 'tutor_state.db')
+
+    async def start_bot(self, officeHours):
+        # builds a bot on the stored state and runs on_ready, returns the bot once startup reconciliation is done
+        bot = SimulatedBot(self.fake, self.timeScale, tutor_bot.DAY, os.path.join(self.directory, 'user_list'),
+                           os.path.join(self.directory, 'tutor_manager'), officeHours, stateFilePath=self.state_file_path())
+        await bot.on_ready()
+        await asyncio.gather(*bot.reconciler.tasks.values())
+        await self.settle(bot)
+        return bot
+
+    async def settle(self, bot):
+        # waits until no handlers are running and the api queue has stayed empty for a moment
+        idleChecks = 0
+        while idleChecks < 3:
+            await self.fake.drain()
+            await asyncio.sleep(0.01)
+            idleChecks = idleChecks + 1 if bot.api.queued() == 0 and not self.fake.running else 0
+
+    def help_message(self, bot, member):
+        user = bot.guild_state(self.guild).userList.get(member.id)
+        if user == None or user.privateChannelId == None:
+            return None
+        channel = self.fake.channels.get(user.privateChannelId)
+        if channel == None:
+            return None
+        for message in channel.pinned:
+            if message.id == user.helpMessageId:
+                return message
+        return None
+
+
+class PhaseReport:
+    # prints what one phase of the simulation did
+    def __init__(self, name, simulation):
+        self.name = name
+        self.fake = simulation.fake
+        self.start = time.perf_counter()
+        self.requests = simulation.fake.http.requests
+        self.rateLimited = simulation.fake.http.rateLimited
+        self.fake.handlerLatency = dict()
+
+    def finish(self, details=()):
+        print('-- %s: %.2f s, %s api requests, %s answered 429' % (self.name, time.perf_counter() - self.start,
+              self.fake.http.requests - self.requests, self.fake.http.rateLimited - self.rateLimited))
+        for event, histogram in sorted(self.fake.handlerLatency.items()):
+            print_histogram('on_%s' % (event), histogram.stats(), 1000, 'ms')
+        for line in details:
+            print(line)
+
+
+def print_histogram(name, stats, scale=1, unit='s'):
+    print('   %-22s n=%-7d avg %9.2f %s  p50 %9.2f  p95 %9.2f  p99 %9.2f  max %9.2f' % (
+          name, stats['count'], stats['average'] * scale, unit, stats['p50'] * scale, stats['p95'] * scale,
+          stats['p99'] * scale, stats['max'] * scale))
+
+
+def always_open():
+    # a period ending where it starts runs past midnight into the next day
+    return office_hours.OfficeHours.daily([(clock(0, 0), clock(0, 0))])
+
+
+async def run_load(directory, memberCount, tutorCount, joinCount, reactionCount, timeScale):
+    print('%s members, %s tutors, discord rate limits sped up %sx' % (memberCount, tutorCount, timeScale))
+    start = time.perf_counter()
+    simulation = Simulation(directory, memberCount, tutorCount, timeScale=timeScale)
+    print('-- built the guild in %.2f s' % (time.perf_counter() - start))
+    fake = simulation.fake
+
+    report = PhaseReport('startup', simulation)
+    closed = office_hours.OfficeHours({})
+    bot = await simulation.start_bot(closed)
+    state = bot.guild_state(simulation.guild)
+    # the percentiles printed are of the measured values, not of the bounds of the buckets they fall in
+    for histogram in (bot.joinLatency, bot.loopLag.lag, state.matcher.queueWait, state.matcher.timeToMatch):
+        histogram.keep_samples()
+    report.finish(['   %s users and %s tutors loaded' % (len(state.userList), len(state.tutorManager.tutorList))])
+
+    report = PhaseReport('join storm of %s members' % (joinCount), simulation)
+    for i in range(joinCount):
+        fake.join(simulation.guild, 'joiner%s' % (i))
+    await simulation.settle(bot)
+    print_histogram('join latency', bot.joinLatency.stats(), 1000, 'ms')
+    report.finish(['   channel pool: %s' % (bot.channelPool.stats())])
+
+    report = PhaseReport('%s reactions at office hours opening' % (reactionCount), simulation)
+    bot.officeHours = always_open()
+    await bot.office_hours_changed(True)
+    # offline students have no channel to react in, and looking each of them up would read them all from the store
+    students = list()
+    for member in simulation.students:
+        if len(students) == reactionCount:
+            break
+        if member.status != discord.Status.offline and simulation.help_message(bot, member) != None:
+            students.append(member)
+    for i, member in enumerate(students):
+        fake.react(member, simulation.help_message(bot, member), tutor_bot.subjectEmojis[tutor_bot.subjects[i % 8]])
+    await simulation.settle(bot)
+    queued = len(state.tutorManager.queuedUsers)
+    report.finish(['   %s matched on request, %s queued' % (state.matcher.matched, queued)])
+
+    report = PhaseReport('!done churn', simulation)
+    rounds = 0
+    while state.tutorManager.queuedUsers and rounds < 100:
+        rounds += 1
+        # only the students who asked can have a tutor, going through every stored user would stall the loop being measured
+        for member in students:
+            user = state.userList[member.id]
+            for tutorId in user.assignedTutors[:1]:
+                fake.send_message(fake.users[tutorId], fake.channels[user.privateChannelId], '!done')
+        await simulation.settle(bot)
+    matcherStats = state.matcher.stats()
+    print_histogram('queue wait', matcherStats['queueWait'])
+    print_histogram('time to match', matcherStats['timeToMatch'])
+    report.finish(['   %s rounds, %s batches, %s still queued' % (rounds, matcherStats['batches'], len(state.tutorManager.queuedUsers))])
+    print('-- !stats:')
+    print(bot.describe_stats(simulation.guild))
+
+    report = PhaseReport('restart', simulation)
+    await bot.close()
+    bot = await simulation.start_bot(always_open())
+    state = bot.guild_state(simulation.guild)
+    report.finish(['   %s users and %s tutors loaded' % (len(state.userList), len(state.tutorManager.tutorList))])
+    await bot.close()
+
+    print('-- api calls by route: %s' % (dict(sorted(fake.http.routeRequests.items()))))
+    if fake.handlerErrors:
+        print('-- handler errors: %s' % (fake.handlerErrors))
+    if resource != None:
+        # kilobytes on linux
+        print('-- peak memory %.0f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def bench_load(memberCount=50000, tutorCount=500, joinCount=500, reactionCount=2000, timeScale=200.0):
+    level = logging.getLogger().level
+    logging.getLogger().setLevel(logging.WARNING)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            asyncio.run(run_load(directory, memberCount, tutorCount, joinCount, reactionCount, timeScale))
+    finally:
+        logging.getLogger().setLevel(level)
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+
+import metrics
+
+
+class MatchingEngine:
+    # the single writer that hands a guild's idle tutors to its students. requests are matched on the spot when nobody is waiting
+    # for the subject, otherwise queued, and every event that frees a tutor or opens office hours wakes one batch that drains the queue
+
+    def __init__(self, bot, state):
+        self.bot = bot
+        # the GuildState whose tutors and queue are matched
+        self.state = state
+        self.wakeup = None
+        self.task = None
+        # seconds matched students spent in the queue
+        self.queueWait = metrics.Histogram()
+        # dict storing subject->histogram of the seconds matched students of the subject spent in the queue
+        self.subjectQueueWait = dict()
+        # seconds from a student asking for a tutor until they are told who it is
+        self.timeToMatch = metrics.Histogram()
+        self.batches = 0
+        self.matched = 0
+        self.queued = 0
+
+    def start(self, loop):
+        if self.task == None:
+            self.wakeup = asyncio.Event()
+            self.task = loop.create_task(self.run())
+
+    def stop(self):
+        if self.task != None:
+            self.task.cancel()
+            self.task = None
+
+    def notify(self):
+        # called whenever a tutor may have become available
+        if self.wakeup != None:
+            self.wakeup.set()
+
+    def request(self, userId, channel, subject, queue=True):
+        # returns the tutor assigned to the user, or None when nobody is idle, in which case the user is queued if queue is set.
+        # nothing here awaits, so no other handler can take the tutor between the check and the assignment
+        manager = self.state.tutorManager
+        requestedAt = self.bot.loop.time()
+        # students already waiting for the subject go first
+        if manager.queue_length(subject) == 0:
+            tutor = manager.request_tutor(subject)
+            if tutor != None:
+                self.assign(userId, tutor)
+                return tutor
+        if queue:
+            manager.add_to_queue(userId, channel, subject, requestedAt)
+            self.queued += 1
+        return None
+
+    def assign(self, userId, tutor):
+        self.state.userList[userId].assignedTutors += (tutor.id,)
+        self.matched += 1
+
+    def match_batch(self):
+        # pairs the waiting queue with the idle tutors, returns a list of (queue entry, tutor)
+        if not self.bot.is_office_hours():
+            return []
+        matches = self.state.tutorManager.match_queue()
+        now = self.bot.loop.time()
+        for entry, tutor in matches:
+            self.assign(entry.userId, tutor)
+            self.queueWait.observe(now - entry.queuedAt)
+            if entry.subject not in self.subjectQueueWait:
+                self.subjectQueueWait[entry.subject] = metrics.Histogram()
+            self.subjectQueueWait[entry.subject].observe(now - entry.queuedAt)
+        self.batches += 1
+        return matches
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            for entry, tutor in self.match_batch():
+                task = loop.create_task(self.bot.announce_tutor(entry.userId, entry.channel, entry.subject, tutor.id, entry.queuedAt))
+                task.add_done_callback(self.log_failure)
+
+    def log_failure(self, task):
+        if not task.cancelled() and task.exception() != None:
+            logging.error("could not announce a matched tutor: %s" % (task.exception()))
+
+    def stats(self):
+        return {'matched': self.matched, 'queued': self.queued, 'batches': self.batches,
+                'queueWait': self.queueWait.stats(), 'timeToMatch': self.timeToMatch.stats()}
@@ -0,0 +1,255 @@
+import asyncio
+import functools
+import random
+import time
+
+# bucket upper bounds in seconds
+defaultBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 900.0)
+# finer bounds for event loop lag
+lagBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def sample_quantile(values, fraction):
+    # the quantile of a list of values, interpolated between the two values around it
+    if not values:
+        return 0.0
+    values = sorted(values)
+    position = fraction * (len(values) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class Reservoir:
+    # keeps a uniform sample of up to size observations, so quantiles are of the measured values rather than of bucket bounds.
+    # meant for benchmarks, the sample is sorted for every quantile
+
+    def __init__(self, size=10000, seed=0):
+        self.size = size
+        self.values = list()
+        self.randomizer = random.Random(seed)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+        if len(self.values) < self.size:
+            self.values.append(value)
+            return
+        # every observation so far ends up in the sample with the same chance
+        index = self.randomizer.randrange(self.count)
+        if index < self.size:
+            self.values[index] = value
+
+    def quantile(self, fraction):
+        return sample_quantile(self.values, fraction)
+
+    def stats(self):
+        return {'count': self.count, 'average': self.total / self.count if self.count else 0.0,
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99), 'max': self.maximum}
+
+
+class Histogram:
+    # counts observations into fixed buckets like a prometheus histogram, so memory stays constant
+
+    def __init__(self, buckets=defaultBuckets):
+        self.buckets = tuple(sorted(buckets))
+        # one count per bucket plus one for values above the last bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        # sample of the observations for exact quantiles, see keep_samples
+        self.reservoir = None
+
+    def keep_samples(self, size=10000):
+        # quantiles come from a sample of the values observed from now on, the buckets are still what is exported
+        if self.reservoir == None:
+            self.reservoir = Reservoir(size)
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+        if self.reservoir != None:
+            self.reservoir.observe(value)
+
+    def quantile(self, fraction):
+        # returns the upper bound of the bucket holding the quantile, or the maximum for the overflow bucket.
+        # bounds are 2 to 2.5 times apart, so with samples kept the quantile of the samples is returned instead
+        if self.reservoir != None and self.reservoir.values:
+            return self.reservoir.quantile(fraction)
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, bucketCount in enumerate(self.counts):
+            seen += bucketCount
+            if seen >= rank and bucketCount:
+                if index < len(self.buckets):
+                    return min(self.buckets[index], self.maximum)
+                return self.maximum
+        return self.maximum
+
+    def stats(self):
+        return {'count': self.count, 'average': self.total / self.count if self.count else 0.0,
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99), 'max': self.maximum}
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels, extra=None):
+    # labels is a tuple of (name, value) pairs
+    pairs = list(labels)
+    if extra != None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (name, escape_label(value)) for name, value in pairs))
+
+
+class Registry:
+    # collects metrics for the prometheus text format. histograms are kept here, everything else is read at scrape time by collectors
+
+    def __init__(self):
+        # dict storing (name, labels)->histogram, labels are a sorted tuple of (name, value)
+        self.histograms = dict()
+        # dict storing name->(type, help)
+        self.descriptions = dict()
+        # functions returning a list of (name, type, help, labels dict, value), value is a number or a histogram
+        self.collectors = list()
+
+    def histogram(self, name, help, buckets=defaultBuckets, **labels):
+        # returns the histogram of the name and labels, creating it on first use
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram == None:
+            histogram = self.add_histogram(name, help, Histogram(buckets), **labels)
+        return histogram
+
+    def add_histogram(self, name, help, histogram, **labels):
+        # registers a histogram that is owned elsewhere
+        self.descriptions[name] = ('histogram', help)
+        self.histograms[(name, tuple(sorted(labels.items())))] = histogram
+        return histogram
+
+    def add_collector(self, collect):
+        self.collectors.append(collect)
+
+    def samples(self):
+        # returns a dict storing name->list of (labels, value)
+        samples = dict()
+        for (name, labels), histogram in self.histograms.items():
+            samples.setdefault(name, []).append((labels, histogram))
+        for collect in self.collectors:
+            for name, kind, help, labels, value in collect():
+                self.descriptions.setdefault(name, (kind, help))
+                samples.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+        return samples
+
+    def render(self):
+        lines = list()
+        for name, samples in sorted(self.samples().items()):
+            kind, help = self.descriptions[name]
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                if isinstance(value, Histogram):
+                    cumulative = 0
+                    for bound, bucketCount in zip(value.buckets, value.counts):
+                        cumulative += bucketCount
+                        lines.append('%s_bucket%s %s' % (name, format_labels(labels, ('le', bound)), cumulative))
+                    lines.append('%s_bucket%s %s' % (name, format_labels(labels, ('le', '+Inf')), value.count))
+                    lines.append('%s_sum%s %s' % (name, format_labels(labels), value.total))
+                    lines.append('%s_count%s %s' % (name, format_labels(labels), value.count))
+                else:
+                    lines.append('%s%s %s' % (name, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+def timed(name, help, **labels):
+    # decorator for coroutine methods of objects with a metrics registry, records the seconds of each call in a histogram
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await method(self, *args, **kwargs)
+            finally:
+                self.metrics.histogram(name, help, **labels).observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class LoopLagMonitor:
+    # measures how late the event loop wakes up from a sleep, which is how long handlers hold it without awaiting
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.lag = Histogram(lagBuckets)
+        self.task = None
+
+    def start(self, loop):
+        if self.task == None:
+            self.task = loop.create_task(self.run())
+
+    def stop(self):
+        if self.task != None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag.observe(max(0.0, loop.time() - start - self.interval))
+
+
+class MetricsServer:
+    # serves the registry in the prometheus text format on GET /metrics, meant to listen on a local address only
+
+    def __init__(self, registry, host='127.0.0.1', port=9100):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        if self.server == None:
+            self.server = await asyncio.start_server(self.handle, self.host, self.port)
+
+    def stop(self):
+        if self.server != None:
+            self.server.close()
+            self.server = None
+
+    async def handle(self, reader, writer):
+        try:
+            requestLine = await asyncio.wait_for(reader.readline(), 5.0)
+            # the headers are not needed
+            while True:
+                header = await asyncio.wait_for(reader.readline(), 5.0)
+                if header in (b'\r\n', b'\n', b''):
+                    break
+            parts = requestLine.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', self.registry.render()
+            else:
+                status, body = '404 Not Found', 'not found\n'
+            body = body.encode('utf-8')
+            writer.write(('HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: %s\r\n\r\n' % (status, len(body))).encode('ascii') + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
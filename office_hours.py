@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import math
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+# days of schedule looked at when moving the cursor, a week plus the day before for periods running past midnight
+lookaheadDays = 8
+# how far a run of holidays is searched for the next opening
+maxLookaheadDays = 371
+
+
+class OfficeHours:
+    # weekly office hours in a timezone with holiday exceptions. is_open is answered from a cursor holding the current state
+    # and the time of the next opening or closing, which is only recomputed once that transition has passed
+
+    def __init__(self, weekly, timezone='UTC', holidays=()):
+        # dict storing weekday (0 is Monday)->list of (start time, end time), an end at or before the start runs past midnight
+        self.weekly = {weekday: list(periods) for weekday, periods in weekly.items()}
+        self.timezone = ZoneInfo(timezone)
+        # set of dates in the schedule's timezone on which no periods start
+        self.holidays = set(holidays)
+        # cursor: the schedule is in state isOpen from validFrom until nextTransition
+        self.isOpen = False
+        self.validFrom = math.inf
+        self.nextTransition = -math.inf
+        self.driverTask = None
+
+    @classmethod
+    def daily(cls, periods, timezone='UTC', holidays=()):
+        # the same periods every day, as the bot's officeHours list of (start time, end time) used to be
+        return cls({weekday: periods for weekday in range(7)}, timezone, holidays)
+
+    def add_holiday(self, day):
+        self.holidays.add(day)
+        self.invalidate()
+
+    def remove_holiday(self, day):
+        self.holidays.discard(day)
+        self.invalidate()
+
+    def invalidate(self):
+        self.validFrom = math.inf
+        self.nextTransition = -math.inf
+
+    def now(self):
+        return time.time()
+
+    def is_open(self, now=None):
+        if now == None:
+            now = self.now()
+        if not (self.validFrom <= now < self.nextTransition):
+            self.advance(now)
+        return self.isOpen
+
+    def next_transition(self, now=None):
+        # returns the time of the next opening or closing, or inf if there is none
+        self.is_open(now)
+        return self.nextTransition
+
+    def intervals(self, firstDay, dayCount):
+        # returns the merged (start, end) timestamps of the periods starting on dayCount days from firstDay
+        intervals = list()
+        for offset in range(dayCount):
+            day = firstDay + timedelta(days=offset)
+            if day in self.holidays:
+                continue
+            for start, end in self.weekly.get(day.weekday(), ()):
+                startTime = datetime.combine(day, start, self.timezone)
+                endTime = datetime.combine(day, end, self.timezone)
+                if end <= start:
+                    endTime = datetime.combine(day + timedelta(days=1), end, self.timezone)
+                intervals.append((startTime.timestamp(), endTime.timestamp()))
+        intervals.sort()
+        merged = list()
+        for start, end in intervals:
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def advance(self, now):
+        # moves the cursor to the period holding now, or to the gap before the next one
+        firstDay = datetime.fromtimestamp(now, self.timezone).date() - timedelta(days=1)
+        previousEnd = -math.inf
+        for dayCount in (lookaheadDays, maxLookaheadDays):
+            for start, end in self.intervals(firstDay, dayCount):
+                if end <= now:
+                    previousEnd = end
+                    continue
+                if start <= now:
+                    self.isOpen, self.validFrom, self.nextTransition = True, start, end
+                else:
+                    self.isOpen, self.validFrom, self.nextTransition = False, previousEnd, start
+                return
+        # no periods at all in the coming year
+        self.isOpen, self.validFrom, self.nextTransition = False, previousEnd, math.inf
+
+    def start(self, loop, callback):
+        # calls the coroutine function callback(isOpen) at every opening and closing
+        if self.driverTask == None:
+            self.driverTask = loop.create_task(self.run(callback))
+
+    def stop(self):
+        if self.driverTask != None:
+            self.driverTask.cancel()
+            self.driverTask = None
+
+    async def run(self, callback, maxSleep=3600.0):
+        isOpen = self.is_open()
+        while True:
+            # wake up at least every maxSleep seconds in case the system clock was changed
+            await asyncio.sleep(max(0.0, min(self.next_transition() - self.now(), maxSleep)))
+            if self.is_open() == isOpen:
+                continue
+            isOpen = self.isOpen
+            try:
+                await callback(isOpen)
+            except Exception:
+                logging.exception("office hours callback failed")
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import discord
+
+import api_scheduler
+
+
+def snowflake_timestamp(snowflake):
+    # unix time a discord id was created at
+    return ((snowflake >> 22) + discord.utils.DISCORD_EPOCH) / 1000.0
+
+
+class PruneJob:
+    def __init__(self, guild, reportChannel, channels, total, withoutTutor):
+        self.guild = guild
+        # channel progress is reported to, None if it is gone
+        self.reportChannel = reportChannel
+        # deque of (channel id, user id) still to be pruned
+        self.pending = deque(channels)
+        self.total = total
+        # only prune channels that have no assigned tutor at the time they are deleted
+        self.withoutTutor = withoutTutor
+        # channels handled by earlier runs of a resumed job count as done
+        self.done = total - len(self.pending)
+        self.deleted = 0
+        self.skipped = 0
+        self.failures = 0
+        self.finished = False
+        self.task = None
+
+    def describe(self):
+        return '%s/%s channels done, %s deleted, %s skipped, %s failed%s' % (
+               self.done, self.total, self.deleted, self.skipped, self.failures, '' if self.finished else ' (running)')
+
+
+class PruneEngine:
+    # deletes private channels in bulk with a bounded number of deletions in flight. the channels of a prune are stored
+    # before the first one is deleted, so a prune that was interrupted by a restart carries on where it stopped
+
+    def __init__(self, bot, store, concurrency=4, reportInterval=15.0):
+        self.bot = bot
+        self.store = store
+        self.concurrency = concurrency
+        # seconds between progress updates in the channel the prune was started from
+        self.reportInterval = reportInterval
+        # shared by prunes and expired timeouts so together they never have more than concurrency deletions in flight
+        self.slots = None
+        # dict storing guild id->last or current prune job
+        self.jobs = dict()
+
+    def select(self, guild, inactiveDays=None, withoutTutor=False):
+        # returns a list of (channel, user id) of the guild's private channels that match the filters
+        bot = self.bot
+        state = bot.guild_state(guild)
+        privChannelCategory = bot.guildCache.category(guild, 'Your Private Channels')
+        if privChannelCategory == None:
+            return []
+        cutoff = None if inactiveDays == None else time.time() - inactiveDays * 86400
+        selected = list()
+        for channel in privChannelCategory.channels:
+            # pooled channels and channels the bot has lost track of have no owner
+            userId = state.find_channel_owner(channel.id)
+            if userId == None:
+                continue
+            if withoutTutor and state.userList[userId].assignedTutors:
+                continue
+            # the id of the last message tells when the channel was last used without fetching its history
+            if cutoff != None and channel.last_message_id != None and snowflake_timestamp(channel.last_message_id) > cutoff:
+                continue
+            selected.append((channel, userId))
+        return selected
+
+    def is_running(self, guild):
+        job = self.jobs.get(guild.id)
+        return job != None and not job.finished
+
+    def describe(self, guild):
+        job = self.jobs.get(guild.id)
+        if job == None:
+            return 'no prune has been run'
+        return job.describe()
+
+    def start(self, guild, reportChannel, channels, withoutTutor=False):
+        pending = [(channel.id, userId) for channel, userId in channels]
+        self.store.put_prune_job(guild.id, reportChannel.id, withoutTutor, pending)
+        return self.launch(PruneJob(guild, reportChannel, pending, len(pending), withoutTutor))
+
+    def resume(self, guild):
+        # continues a prune of the guild that was interrupted, returns the job or None
+        job = self.store.load_prune_job(guild.id)
+        if job == None or self.is_running(guild):
+            return None
+        reportChannelId, total, withoutTutor = job
+        pending = self.store.load_prune_channels(guild.id)
+        logging.info ("resuming prune of %s: %s of %s channels left" % (guild.name, len(pending), total))
+        return self.launch(PruneJob(guild, guild.get_channel(reportChannelId), pending, total, bool(withoutTutor)))
+
+    def launch(self, job):
+        self.jobs[job.guild.id] = job
+        job.task = asyncio.get_running_loop().create_task(self.run(job))
+        return job
+
+    def cancel(self, guild):
+        # stops the guild's prune for good, returns whether one was running
+        if not self.is_running(guild):
+            return False
+        job = self.jobs[guild.id]
+        job.task.cancel()
+        job.finished = True
+        self.store.delete_prune_job(guild.id)
+        return True
+
+    def stop(self):
+        # stops all prunes but keeps them stored so they resume at the next start
+        for job in self.jobs.values():
+            if job.task != None:
+                job.task.cancel()
+        self.jobs = dict()
+
+    async def report(self, job, content, message=None):
+        # posts progress to the channel the prune was started from, editing the progress message once there is one
+        if job.reportChannel == None:
+            return None
+        if message == None:
+            return await self.bot.send_message(job.reportChannel, content, api_scheduler.PRIORITY_NORMAL)
+        self.bot.api.post('edit_message:%s' % (job.reportChannel.id), message.edit, content=content)
+        return message
+
+    async def run(self, job):
+        loop = asyncio.get_running_loop()
+        message = await self.report(job, "Pruning: %s" % (job.describe()))
+        workers = [loop.create_task(self.worker(job)) for i in range(self.concurrency)]
+        try:
+            running = set(workers)
+            while running:
+                finished, running = await asyncio.wait(running, timeout=self.reportInterval)
+                if running:
+                    message = await self.report(job, "Pruning: %s" % (job.describe()), message)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        job.finished = True
+        self.store.delete_prune_job(job.guild.id)
+        logging.info ("pruned %s: %s" % (job.guild.name, job.describe()))
+        await self.report(job, "Prune finished: %s" % (job.describe()))
+
+    async def worker(self, job):
+        while job.pending:
+            channelId, userId = job.pending.popleft()
+            try:
+                await self.prune_channel(job, channelId, userId)
+            except Exception:
+                # a failed deletion is not retried by this prune, the next one selects the channel again
+                job.failures += 1
+                logging.exception("could not prune channel %s" % (channelId))
+            job.done += 1
+            self.store.delete_prune_channel(channelId)
+
+    async def prune_channel(self, job, channelId, userId):
+        state = self.bot.guild_state(job.guild)
+        if state.find_channel_owner(channelId) != userId or (job.withoutTutor and state.userList[userId].assignedTutors):
+            # the channel was deleted or got a tutor after the prune started
+            job.skipped += 1
+            return
+        channel = job.guild.get_channel(channelId)
+        if channel == None:
+            # already gone on discord's side, only the reference is left to clear
+            state.clear_private_channel(userId)
+            state.save_user(userId)
+            job.skipped += 1
+            return
+        await self.delete(channel, userId)
+        job.deleted += 1
+
+    async def delete(self, channel, userId):
+        if self.slots == None:
+            self.slots = asyncio.Semaphore(self.concurrency)
+        async with self.slots:
+            await self.bot.delete_user_channel(channel, userId)
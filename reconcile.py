@@ -0,0 +1,190 @@
+import asyncio
+import logging
+
+import discord
+
+import api_scheduler
+import channel_pool
+
+
+class Reconciler:
+    # brings the stored private channel state of a guild in line with the channels that actually exist,
+    # streaming members in chunks and applying only the changes that are needed with bounded concurrency
+
+    def __init__(self, bot, chunkSize=500, concurrency=8):
+        self.bot = bot
+        self.chunkSize = chunkSize
+        self.concurrency = concurrency
+        # dict storing guild id->running reconciliation task
+        self.tasks = dict()
+        # dict storing guild id->progress counters of the last or current run
+        self.progress = dict()
+
+    def start(self, guild):
+        task = self.tasks.get(guild.id)
+        if task != None and not task.done():
+            return task
+        task = asyncio.get_running_loop().create_task(self.run(guild))
+        self.tasks[guild.id] = task
+        return task
+
+    def is_running(self, guild):
+        task = self.tasks.get(guild.id)
+        return task != None and not task.done()
+
+    def stop(self):
+        for task in self.tasks.values():
+            task.cancel()
+
+    async def run(self, guild):
+        loop = asyncio.get_running_loop()
+        startTime = loop.time()
+        counters = {'members': 0, 'total': guild.member_count or len(guild.members), 'created': 0, 'adopted': 0, 'duplicates': 0,
+                    'orphans': 0, 'unverified': 0, 'cleared': 0, 'timeouts': 0, 'failures': 0, 'done': False}
+        self.progress[guild.id] = counters
+        topicChannels = self.private_channels_by_user(guild, counters)
+        # api work is handed to a fixed number of workers, the bounded queue slows the member stream down when they fall behind
+        actions = asyncio.Queue(maxsize=self.concurrency * 4)
+        workers = [loop.create_task(self.worker(actions, counters)) for i in range(self.concurrency)]
+        try:
+            members = list(guild.members)
+            for start in range(0, len(members), self.chunkSize):
+                # read the stored users of the chunk at once rather than one by one
+                self.bot.guild_state(guild).userList.preload([member.id for member in members[start:start + self.chunkSize]])
+                for member in members[start:start + self.chunkSize]:
+                    await self.reconcile_member(guild, member, topicChannels.pop(member.id, []), actions, counters)
+                counters['members'] = min(start + self.chunkSize, len(members))
+                logging.info ("reconciling %s: %s/%s members" % (guild.name, counters['members'], counters['total']))
+                # let event handlers run between chunks
+                await asyncio.sleep(0)
+            # channels left over belong to users who are no longer members, unless the member list is only part of the guild:
+            # before chunking finishes, without the members intent or on large guilds their owners may just be missing from it
+            membersComplete = guild.chunked or (guild.member_count != None and len(members) >= guild.member_count)
+            for userId, channels in topicChannels.items():
+                for channel in channels:
+                    if userId != None and not membersComplete:
+                        counters['unverified'] += 1
+                        continue
+                    counters['orphans'] += 1
+                    await actions.put((self.delete_channel, (channel, userId)))
+            if counters['unverified']:
+                logging.info ("reconciling %s: kept %s channels of users missing from the member list, only %s of %s members are known" % (
+                              guild.name, counters['unverified'], len(members), counters['total']))
+            self.clear_missing_channels(guild, counters)
+            await actions.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+        counters['done'] = True
+        logging.info ("reconciled %s in %.1f s: %s" % (guild.name, loop.time() - startTime, self.describe(guild)))
+
+    def private_channels_by_user(self, guild, counters):
+        # dict storing user id->channels in the private channel category whose topic names that user
+        topicChannels = dict()
+        privChannelCategory = self.bot.guildCache.category(guild, 'Your Private Channels')
+        if privChannelCategory == None:
+            return topicChannels
+        for channel in privChannelCategory.channels:
+            if self.bot.channelPool.is_pool_channel(channel.id):
+                continue
+            try:
+                userId = int(channel.topic)
+            except (TypeError, ValueError):
+                # leftover of a pool channel that failed to build, anything else is left alone
+                if channel.topic == channel_pool.POOL_TOPIC:
+                    topicChannels.setdefault(None, []).append(channel)
+                continue
+            topicChannels.setdefault(userId, []).append(channel)
+        return topicChannels
+
+    async def reconcile_member(self, guild, member, channels, actions, counters):
+        bot = self.bot
+        state = bot.guild_state(guild)
+        # see if user joined during server downtime and add them to internal memory if so
+        user = state.add_user(member.id)
+        keptChannel = None
+        if user.privateChannelId != None:
+            keptChannel = guild.get_channel(user.privateChannelId)
+            if keptChannel == None:
+                # the stored channel was deleted while the bot was down
+                counters['cleared'] += 1
+                state.clear_private_channel(member.id)
+                state.save_user(member.id)
+        for channel in channels:
+            if keptChannel == None:
+                # the channel exists but the stored state lost track of it
+                keptChannel = channel
+                counters['adopted'] += 1
+                state.bind_private_channel(member.id, channel.id)
+                state.save_user(member.id)
+                await actions.put((self.adopt_channel, (channel, member.id)))
+            elif channel.id != keptChannel.id:
+                counters['duplicates'] += 1
+                await actions.put((self.delete_channel, (channel, None)))
+        # if user is offline set a timeout for them
+        if member.status == discord.Status.offline:
+            if user.privateChannelId != None and member.id not in state.userTimeouts:
+                counters['timeouts'] += 1
+                await bot.set_user_timeout(member)
+        else:
+            # user came back online while the bot was down
+            state.userTimeouts.cancel(member.id)
+            # if user is online check if they have a private channel, if not create one for them
+            if user.privateChannelId == None:
+                counters['created'] += 1
+                await actions.put((bot.create_private_channel, (member,)))
+
+    def clear_missing_channels(self, guild, counters):
+        # forget channels of users who left the guild while the bot was down
+        state = self.bot.guild_state(guild)
+        for channelId, userId in state.private_channels():
+            if guild.get_member(userId) == None and guild.get_channel(channelId) == None:
+                counters['cleared'] += 1
+                state.clear_private_channel(userId)
+                state.save_user(userId)
+
+    async def adopt_channel(self, channel, userId):
+        # find the pinned help message of an adopted channel, or post a new one
+        bot = self.bot
+        state = bot.guild_state(channel.guild)
+        pins = await bot.api.call('pins:%s' % (channel.id), channel.pins, priority=api_scheduler.PRIORITY_HOUSEKEEPING)
+        helpMessageId = None
+        for message in pins:
+            if message.author == bot.user:
+                helpMessageId = message.id
+        if helpMessageId == None:
+            helpMessageId = await bot.send_channel_instructions(channel)
+        state.set_help_message(userId, helpMessageId)
+        state.save_user(userId)
+
+    async def delete_channel(self, channel, userId):
+        bot = self.bot
+        owner = bot.guild_state(channel.guild).find_channel_owner(channel.id)
+        if owner != None and owner != userId:
+            # the channel was bound to a user after the category was scanned
+            return
+        if owner != None:
+            await bot.delete_user_channel(channel, owner)
+        else:
+            await bot.api.call('delete_channel:%s' % (channel.guild.id), channel.delete, priority=api_scheduler.PRIORITY_HOUSEKEEPING)
+
+    async def worker(self, actions, counters):
+        while True:
+            action, arguments = await actions.get()
+            try:
+                await action(*arguments)
+            except Exception:
+                counters['failures'] += 1
+                logging.exception("reconciliation step failed")
+            finally:
+                actions.task_done()
+
+    def describe(self, guild):
+        counters = self.progress.get(guild.id)
+        if counters == None:
+            return 'not started'
+        return ('%s/%s members checked, %s channels created, %s adopted, %s duplicates and %s orphans deleted, '
+                '%s channels of unknown members kept, %s stale references cleared, %s timeouts scheduled, %s failures%s') % (
+                counters['members'], counters['total'], counters['created'], counters['adopted'], counters['duplicates'],
+                counters['orphans'], counters['unverified'], counters['cleared'], counters['timeouts'], counters['failures'],
+                '' if counters['done'] else ' (running)')
@@ -0,0 +1,108 @@
+import asyncio
+import heapq
+import logging
+import time
+
+
+class DeadlineScheduler:
+    # runs a callback for each key when its wall clock deadline passes, driven by a single coroutine
+
+    def __init__(self, callback, store=None, partition=0):
+        # coroutine function called with the key of each expired deadline
+        self.callback = callback
+        # optional state store that pending deadlines are persisted to
+        self.store = store
+        # deadlines are stored under the partition (guild id), so the schedulers of several guilds can share a store
+        self.partition = partition
+        # dict storing key->deadline of pending deadlines
+        self.deadlines = dict()
+        # heap of (deadline, key), cancelled or rescheduled entries are skipped when popped
+        self.heap = list()
+        self.wakeup = None
+        self.driverTask = None
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def keys(self):
+        # the keys with a pending deadline
+        return list(self.deadlines)
+
+    def now(self):
+        # wall clock time is used so deadlines stay valid across restarts
+        return time.time()
+
+    def load(self):
+        # restore the deadlines persisted by a previous run
+        if self.store == None:
+            return
+        for key, deadline in self.store.load_deadlines(self.partition):
+            self.deadlines[key] = deadline
+            self.heap.append((deadline, key))
+        heapq.heapify(self.heap)
+
+    def schedule_at(self, key, deadline):
+        # schedules or reschedules the deadline of the key
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+        if self.store != None:
+            self.store.put_deadline(self.partition, key, deadline)
+        # wake the driver if the new deadline is now the earliest one
+        if self.wakeup != None and self.heap[0] == (deadline, key):
+            self.wakeup.set()
+
+    def schedule_in(self, key, delay):
+        self.schedule_at(key, self.now() + delay)
+
+    def cancel(self, key):
+        # returns whether the key had a pending deadline
+        if key not in self.deadlines:
+            return False
+        del self.deadlines[key]
+        if self.store != None:
+            self.store.delete_deadline(self.partition, key)
+        # drop stale entries once they outnumber the pending deadlines
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [entry for entry in self.heap if self.deadlines.get(entry[1]) == entry[0]]
+            heapq.heapify(self.heap)
+        return True
+
+    def start(self, loop):
+        if self.driverTask == None:
+            self.wakeup = asyncio.Event()
+            self.driverTask = loop.create_task(self.run())
+
+    def stop(self):
+        if self.driverTask != None:
+            self.driverTask.cancel()
+            self.driverTask = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.wakeup.clear()
+            now = self.now()
+            # fire every deadline that has passed
+            while self.heap and self.heap[0][0] <= now:
+                deadline, key = heapq.heappop(self.heap)
+                if self.deadlines.get(key) != deadline:
+                    continue
+                del self.deadlines[key]
+                if self.store != None:
+                    self.store.delete_deadline(self.partition, key)
+                loop.create_task(self.fire(key))
+            # sleep until the next deadline or until an earlier one is scheduled
+            timeout = self.heap[0][0] - now if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def fire(self, key):
+        try:
+            await self.callback(key)
+        except Exception:
+            logging.exception("deadline callback failed for %s" % (key))
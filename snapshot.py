@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+
+import metrics
+
+SNAPSHOT_PREFIX = 'tutor_state-'
+SNAPSHOT_SUFFIX = '.db'
+
+
+def backup_database(databasePath, snapshotPath):
+    # copies the database into snapshotPath through sqlite's online backup, returns the size of the snapshot in bytes.
+    # runs in a worker thread like email_export.export_emails
+    temporaryPath = snapshotPath + '.tmp'
+    source = sqlite3.connect(databasePath)
+    try:
+        destination = sqlite3.connect(temporaryPath)
+        try:
+            source.backup(destination)
+            # a snapshot is a single self-contained file
+            destination.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            destination.close()
+    finally:
+        source.close()
+    # the snapshot has to be on disk before it replaces anything, or a crash could leave an empty file under the final name
+    with open(temporaryPath, 'rb') as snapshotFile:
+        os.fsync(snapshotFile.fileno())
+    os.replace(temporaryPath, snapshotPath)
+    sync_directory(os.path.dirname(snapshotPath))
+    return os.path.getsize(snapshotPath)
+
+
+def sync_directory(directory):
+    # makes a rename durable, directories cannot be opened for syncing on windows
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    descriptor = os.open(directory or '.', os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def list_snapshots(directory):
+    # returns the paths of the snapshots in the directory, oldest first
+    if not os.path.isdir(directory):
+        return []
+    names = [name for name in os.listdir(directory) if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX)]
+    # the names hold a sortable UTC timestamp. older versions named snapshots in local time without the Z, those are older than any UTC one
+    return [os.path.join(directory, name) for name in sorted(names, key=lambda name: (name.endswith('Z' + SNAPSHOT_SUFFIX), name))]
+
+
+def snapshot_name(now):
+    # UTC does not jump with daylight saving time, and microseconds keep snapshots taken within a second apart
+    return '%s%s.%06dZ%s' % (SNAPSHOT_PREFIX, time.strftime('%Y%m%d-%H%M%S', time.gmtime(now)), int(now % 1 * 1000000), SNAPSHOT_SUFFIX)
+
+
+def restore_latest(databasePath, directory):
+    # replaces the database with the newest snapshot, the replaced files are kept next to it. returns the snapshot path or None
+    snapshots = list_snapshots(directory)
+    if not snapshots:
+        return None
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(databasePath + suffix):
+            os.replace(databasePath + suffix, databasePath + suffix + '.damaged')
+    temporaryPath = databasePath + '.tmp'
+    backup_database(snapshots[-1], temporaryPath)
+    os.replace(temporaryPath, databasePath)
+    return snapshots[-1]
+
+
+class Snapshotter:
+    # copies the state store into a directory of timestamped snapshots every interval, keeping the newest generations.
+    # changes reach the store within a second or so, snapshots bound what is lost if the database file itself is damaged
+
+    def __init__(self, databasePath, directory, interval=900.0, generations=4):
+        # with interval None snapshots are only taken on request
+        self.databasePath = databasePath
+        self.directory = directory
+        self.interval = interval
+        self.generations = generations
+        self.task = None
+        # only one snapshot is written at a time, a manual one waits for a periodic one and the other way around
+        self.lock = None
+        # seconds each snapshot took, including the rename
+        self.duration = metrics.Histogram()
+        self.taken = 0
+        self.failures = 0
+        self.lastSize = 0
+        self.lastDuration = 0.0
+        # unix time of the last snapshot, or None
+        self.lastTakenAt = None
+
+    def start(self, loop):
+        if self.task == None and self.interval != None:
+            self.task = loop.create_task(self.run())
+
+    def stop(self):
+        if self.task != None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.take()
+            except Exception:
+                # the next interval tries again
+                logging.exception("could not snapshot the state store")
+
+    async def take(self):
+        # writes a snapshot in a worker thread, returns (snapshot path, size in bytes, seconds taken)
+        if self.lock == None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            snapshotPath = os.path.join(self.directory, snapshot_name(time.time()))
+            start = time.perf_counter()
+            try:
+                size = await asyncio.get_running_loop().run_in_executor(None, backup_database, self.databasePath, snapshotPath)
+            except Exception:
+                self.failures += 1
+                raise
+            duration = time.perf_counter() - start
+            self.duration.observe(duration)
+            self.taken += 1
+            self.lastSize = size
+            self.lastDuration = duration
+            self.lastTakenAt = time.time()
+            self.remove_old_generations()
+            logging.info ("snapshot %s written, %s bytes in %.2f s" % (snapshotPath, size, duration))
+            return snapshotPath, size, duration
+
+    def remove_old_generations(self):
+        snapshots = list_snapshots(self.directory)
+        for snapshotPath in snapshots[:max(0, len(snapshots) - self.generations)]:
+            os.remove(snapshotPath)
+
+    def age(self):
+        # seconds since the last snapshot, or None
+        return None if self.lastTakenAt == None else time.time() - self.lastTakenAt
+
+    def stats(self):
+        return {'taken': self.taken, 'failures': self.failures, 'lastSize': self.lastSize, 'age': self.age(), 'duration': self.duration.stats()}
@@ -0,0 +1,288 @@
+import argparse
+import asyncio
+import json
+import logging
+import re
+import sys
+import tempfile
+
+import discord
+
+import event_trace
+import fake_discord
+import load_simulation
+import metrics
+import tutor_store
+
+# replays a trace written by event_trace.TraceRecorder into TutorBot against fake_discord, and compares the results of two
+# replays so a version that changes the state or slows a handler down is caught before it is deployed:
+#   python trace_replay.py replay trace.jsonl.gz --speed 20 --output before.json
+#   python trace_replay.py compare before.json after.json
+
+anonymousMentionPattern = re.compile(r'<@(\d+)>')
+
+
+def status_of(name):
+    try:
+        return discord.Status(name)
+    except ValueError:
+        return discord.Status.offline
+
+
+class TraceReplay(load_simulation.Simulation):
+    # rebuilds the guilds of the trace header as a fake discord with the stored users, anonymous ids become fake ones
+
+    def __init__(self, directory, tracePath, speed=10.0):
+        self.directory = directory
+        self.tracePath = tracePath
+        # trace time runs speed times faster, and so do discord's rate limits
+        self.speed = speed
+        self.timeScale = speed
+        self.fake = fake_discord.FakeDiscord(fake_discord.FakeHttp(latency=0.001, timeScale=speed))
+        self.fake.add_bot_user('Tutor Bot')
+        records = event_trace.read_trace(tracePath)
+        header = next(records)
+        self.events = list(records)
+        self.skipped = 0
+        # dict storing anonymous guild id->fake guild
+        self.guilds = dict()
+        # dict storing anonymous guild id->(dict storing anonymous id->fake member)
+        self.members = dict()
+        # dict storing fake member id->anonymous id
+        self.anonymousIds = dict()
+        store = tutor_store.StateStore(self.state_file_path())
+        for guildRecord in header['guilds']:
+            self.build_guild(store, guildRecord, header['bot'], header['recordedAt'])
+        store.set_schema_version(tutor_store.SCHEMA_VERSION)
+        store.close()
+
+    def build_guild(self, store, guildRecord, botId, recordedAt):
+        guild = self.fake.add_guild('guild%s' % (guildRecord['id']))
+        self.guilds[guildRecord['id']] = guild
+        self.members[guildRecord['id']] = dict()
+        for name in set(load_simulation.roleNames).union(guildRecord['roles']):
+            guild.add_role(name)
+        categories = dict()
+        for channelRecord in guildRecord['channels']:
+            if channelRecord['isCategory']:
+                categories[channelRecord['name']] = guild.add_category(channelRecord['name'])
+        for channelRecord in guildRecord['channels']:
+            if not channelRecord['isCategory']:
+                guild.add_text_channel(channelRecord['name'], categories.get(channelRecord['category']))
+        if 'Your Private Channels' not in categories:
+            categories['Your Private Channels'] = guild.add_category('Your Private Channels')
+        for memberRecord in guildRecord['members']:
+            if memberRecord['id'] != botId:
+                self.add_member(guildRecord['id'], memberRecord)
+        rows = list()
+        for userRecord in guildRecord['users']:
+            member = self.members[guildRecord['id']].get(userRecord['id'])
+            if member == None:
+                # users who left the guild keep their row
+                memberId = self.fake.snowflake()
+                self.anonymousIds[memberId] = userRecord['id']
+            else:
+                memberId = member.id
+            channelId = helpMessageId = None
+            if userRecord['channel']:
+                channel = guild.add_text_channel('Your Private Channel', categories['Your Private Channels'], str(memberId))
+                helpMessage = fake_discord.FakeMessage(self.fake, self.fake.snowflake(), 'help', self.fake.user, channel)
+                channel.record(helpMessage)
+                channel.pinned.append(helpMessage)
+                channelId, helpMessageId = channel.id, helpMessage.id
+            rows.append((memberId, userRecord['subjects'], helpMessageId, channelId, userRecord['email'], recordedAt))
+        store.put_users(guild.id, rows)
+
+    def roles(self, guild, names):
+        roles = list()
+        for name in names:
+            role = next((role for role in guild.roles if role.name == name), None)
+            roles.append(guild.add_role(name) if role == None else role)
+        return roles
+
+    def add_member(self, guildId, memberRecord):
+        guild = self.guilds[guildId]
+        member = guild.add_member('member%s' % (memberRecord['id']), status_of(memberRecord['status']), self.roles(guild, memberRecord['roles']))
+        self.members[guildId][memberRecord['id']] = member
+        self.anonymousIds[member.id] = memberRecord['id']
+        return member
+
+    def find_member(self, guildId, anonymousId):
+        if guildId != None:
+            return self.members.get(guildId, {}).get(anonymousId)
+        # dms have no guild, the author is in any of them
+        for members in self.members.values():
+            if anonymousId in members:
+                return members[anonymousId]
+        return None
+
+    def private_channel(self, bot, guild, member):
+        user = bot.guild_state(guild).userList.get(member.id)
+        if user == None or user.privateChannelId == None:
+            return None
+        return self.fake.channels.get(user.privateChannelId)
+
+    def apply(self, bot, record):
+        # hands one traced event to the bot, returns False if it cannot be applied to the replayed state
+        event = record['event']
+        guild = self.guilds.get(record['guild'])
+        if record['guild'] != None and guild == None:
+            return False
+        if event == 'member_join':
+            member = self.add_member(record['guild'], record['member'])
+            self.fake.dispatch('member_join', member)
+        elif event == 'member_update':
+            member = self.find_member(record['guild'], record['after']['id'])
+            if member == None:
+                return False
+            status = status_of(record['after']['status'])
+            roles = self.roles(guild, record['after']['roles'])
+            # role changes the bot made itself have already happened in the replay
+            if member.status == status and set(member.roles) == set(roles):
+                return True
+            before = member.snapshot()
+            member.status = status
+            member.roles = roles
+            self.fake.dispatch('member_update', before, member)
+        elif event == 'message':
+            author = self.find_member(record['guild'], record['author'])
+            if author == None:
+                return False
+            if record['channel'].get('dm'):
+                if author.dm_channel == None:
+                    author.dm_channel = fake_discord.FakeDMChannel(self.fake, self.fake.snowflake(), author)
+                channel = author.dm_channel
+            elif 'owner' in record['channel']:
+                owner = self.find_member(record['guild'], record['channel']['owner'])
+                channel = None if owner == None else self.private_channel(bot, guild, owner)
+            else:
+                channel = next((channel for channel in guild.channels if channel.name == record['channel']['name']), None)
+            if channel == None:
+                return False
+            mentions = [member for member in (self.find_member(record['guild'], mention) for mention in record['mentions']) if member != None]
+            content = anonymousMentionPattern.sub(lambda match: self.mention(record['guild'], int(match.group(1))), record['content'])
+            self.fake.send_message(author, channel, content, mentions)
+        elif event == 'raw_reaction_add':
+            member = self.find_member(record['guild'], record['user'])
+            channel = None if member == None else self.private_channel(bot, guild, member)
+            if channel == None:
+                return False
+            helpMessageId = bot.guild_state(guild).userList[member.id].helpMessageId
+            helpMessage = fake_discord.FakeMessage(self.fake, helpMessageId, 'help', self.fake.user, channel)
+            self.fake.react(member, helpMessage, record['emoji'])
+        return True
+
+    def mention(self, guildId, anonymousId):
+        member = self.find_member(guildId, anonymousId)
+        return '<@%s>' % (anonymousId if member == None else member.id)
+
+    async def run(self):
+        # replays the trace against a freshly started bot, returns the results to compare
+        logging.getLogger().setLevel(logging.WARNING)
+        # office hours are left open so reactions are handled as they were when the trace was recorded
+        bot = await self.start_bot(load_simulation.always_open())
+        self.fake.handlerLatency = dict()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for record in self.events:
+            delay = record['t'] / self.speed - (loop.time() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # exports write to the working directory, and nothing about them is compared
+            if record['event'] == 'message' and record['content'].startswith('!emails'):
+                continue
+            if not self.apply(bot, record):
+                self.skipped += 1
+        await self.settle(bot)
+        results = self.results(bot, loop.time() - start)
+        await bot.close()
+        return results
+
+    def results(self, bot, seconds):
+        state = dict()
+        for guildId, guild in self.guilds.items():
+            guildState = bot.guild_state(guild)
+            users = dict()
+            for userId, user in guildState.userList.items():
+                if userId in self.anonymousIds:
+                    users[str(self.anonymousIds[userId])] = {'subjects': user.to_row(userId)[1], 'channel': user.privateChannelId != None,
+                                                             'email': bool(user.email), 'tutors': len(user.assignedTutors)}
+            tutors = sorted(self.anonymousIds.get(tutorId, 0) for tutorId in guildState.tutorManager.tutorList)
+            state[str(guildId)] = {'users': users, 'tutors': tutors, 'queued': len(guildState.tutorManager.queuedUsers)}
+        return {'trace': self.tracePath, 'speed': self.speed, 'events': len(self.events), 'skipped': self.skipped, 'seconds': seconds,
+                'handlers': {'on_%s' % (event): reservoir.stats() for event, reservoir in self.fake.handlerLatency.items()},
+                # the durations themselves, up to the reservoir's size per handler, so compare works on measured values
+                'handlerSamples': {'on_%s' % (event): [round(value, 6) for value in reservoir.values] for event, reservoir in self.fake.handlerLatency.items()},
+                'handlerErrors': dict(self.fake.handlerErrors), 'apiRequests': dict(self.fake.http.routeRequests), 'state': state}
+
+
+def replay(tracePath, speed=10.0):
+    with tempfile.TemporaryDirectory() as directory:
+        return asyncio.run(TraceReplay(directory, tracePath, speed).run())
+
+
+def compare(baseline, candidate, tolerance=1.25, floor=0.001):
+    # returns the differences between two replays of the same trace: state that differs, new handler errors and handlers
+    # whose average or p95 grew by more than tolerance times and more than floor seconds. p95 is taken from the recorded durations
+    differences = list()
+    for guildId in sorted(set(baseline['state']).union(candidate['state'])):
+        before = baseline['state'].get(guildId, {'users': {}, 'tutors': [], 'queued': 0})
+        after = candidate['state'].get(guildId, {'users': {}, 'tutors': [], 'queued': 0})
+        changedUsers = [userId for userId in sorted(set(before['users']).union(after['users'])) if before['users'].get(userId) != after['users'].get(userId)]
+        for userId in changedUsers[:20]:
+            differences.append('guild %s user %s: %s -> %s' % (guildId, userId, before['users'].get(userId), after['users'].get(userId)))
+        if len(changedUsers) > 20:
+            differences.append('guild %s: %s more users differ' % (guildId, len(changedUsers) - 20))
+        if before['tutors'] != after['tutors']:
+            differences.append('guild %s: %s tutors -> %s tutors' % (guildId, len(before['tutors']), len(after['tutors'])))
+        if before['queued'] != after['queued']:
+            differences.append('guild %s: %s queued -> %s queued' % (guildId, before['queued'], after['queued']))
+    for handler, errors in sorted(candidate['handlerErrors'].items()):
+        if errors > baseline['handlerErrors'].get(handler, 0):
+            differences.append('on_%s: %s errors -> %s errors' % (handler, baseline['handlerErrors'].get(handler, 0), errors))
+    for handler, stats in sorted(candidate['handlers'].items()):
+        baselineStats = baseline['handlers'].get(handler)
+        if baselineStats == None:
+            continue
+        before = {'average': baselineStats['average'], 'p95': metrics.sample_quantile(baseline['handlerSamples'].get(handler, []), 0.95)}
+        after = {'average': stats['average'], 'p95': metrics.sample_quantile(candidate['handlerSamples'].get(handler, []), 0.95)}
+        for name in ('average', 'p95'):
+            if after[name] > before[name] * tolerance and after[name] - before[name] > floor:
+                differences.append('%s %s: %.2f ms -> %.2f ms' % (handler, name, before[name] * 1000, after[name] * 1000))
+    return differences
+
+
+def print_results(results):
+    print('-- %s events replayed at %sx in %.2f s, %s could not be applied' % (results['events'], results['speed'], results['seconds'], results['skipped']))
+    for handler, stats in sorted(results['handlers'].items()):
+        load_simulation.print_histogram(handler, stats, 1000, 'ms')
+    print('-- api calls by route: %s' % (dict(sorted(results['apiRequests'].items()))))
+    if results['handlerErrors']:
+        print('-- handler errors: %s' % (results['handlerErrors']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    replayParser = commands.add_parser('replay', help='replay a trace and print the handler timings')
+    replayParser.add_argument('trace')
+    replayParser.add_argument('--speed', type=float, default=10.0, help='how many times faster than recorded to replay')
+    replayParser.add_argument('--output', help='file to write the results to, for compare')
+    compareParser = commands.add_parser('compare', help='compare the results of two replays of the same trace')
+    compareParser.add_argument('baseline')
+    compareParser.add_argument('candidate')
+    compareParser.add_argument('--tolerance', type=float, default=1.25, help='how many times slower a handler may get')
+    arguments = parser.parse_args()
+    if arguments.command == 'replay':
+        results = replay(arguments.trace, arguments.speed)
+        print_results(results)
+        if arguments.output != None:
+            with open(arguments.output, 'w') as outputFile:
+                json.dump(results, outputFile, indent=1)
+    else:
+        with open(arguments.baseline) as baselineFile, open(arguments.candidate) as candidateFile:
+            differences = compare(json.load(baselineFile), json.load(candidateFile), arguments.tolerance)
+        for difference in differences:
+            print(difference)
+        print('%s differences' % (len(differences)) if differences else 'no differences')
+        sys.exit(1 if differences else 0)
@@ -1,9 +1,29 @@
 import discord
+import api_scheduler
 import asyncio
+import bisect
+import channel_pool
+import command_router
+import email_export
+import event_trace
+import guild_cache
+import heapq
 import logging
+import matching
+import math
+import metrics
+import office_hours
+import os
 import pickle
+import prune
 import re
-from datetime import datetime, time
+import reconcile
+import scheduler
+import snapshot
+import tutor_store
+import user_repository
+from collections import OrderedDict
+from datetime import datetime
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
 textColour = ''
@@ -14,11 +34,17 @@ HOUR = 3600
 DAY = 86400
 
 subjectEmojis = {'math': '🔰', 'cs': '🖥️', 'physics': '💡', 'chem': '🧪', 'bio': '🧬', 'engessay': '📝', 'french': '⚜️', 'other': '❓'}
+# emoji->subject of the help message reactions
+emojiSubjects = {emoji: subject for subject, emoji in subjectEmojis.items()}
 subjects = ['math', 'cs', 'physics', 'chem', 'bio', 'engessay', 'french', 'other']
 subjectRoleNames = ['Math', 'Computer Science', 'Physics', 'Chemistry', 'Biology', 'English', 'French', 'Misc']
+# roles that decide who tutors which subject
+tutorRoleNames = set(['Oracle Tutor'] + ['%s Tutor' % (roleName) for roleName in subjectRoleNames])
 
 
 class Tutor:
+    __slots__ = ('questionsAnswered', 'subjects', 'lastQuestion', 'id', 'busy')
+
     def __init__(self):
         self.questionsAnswered = 0
         self.subjects = list()
@@ -26,6 +52,48 @@ class Tutor:
         self.id = None
         self.busy = False
 
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        # pickles written before __slots__ hold the instance dict, which has the same names
+        self.__init__()
+        for name, value in state.items():
+            if name in self.__slots__:
+                setattr(self, name, value)
+
+    def to_row(self):
+        # converts the tutor into a row of the tutors table, busy status is not persisted
+        lastQuestion = None
+        if isinstance(self.lastQuestion, datetime):
+            lastQuestion = self.lastQuestion.timestamp()
+        return (self.id, self.questionsAnswered, ','.join(self.subjects), lastQuestion)
+
+    def load_row(self, row):
+        self.id, self.questionsAnswered, tutorSubjects, lastQuestion = row
+        self.subjects = [subject for subject in tutorSubjects.split(',') if subject]
+        self.lastQuestion = 0 if lastQuestion == None else datetime.fromtimestamp(lastQuestion)
+
+
+def last_question_key(lastQuestion):
+    # converts a tutor's lastQuestion into a sortable number, tutors who have never answered a question (0) sort first
+    if isinstance(lastQuestion, datetime):
+        return lastQuestion.timestamp()
+    return float(lastQuestion)
+
+
+class QueueEntry:
+    def __init__(self, userId, channel, subject, sequence, ticket, queuedAt=None):
+        self.userId = userId
+        self.channel = channel
+        self.subject = subject
+        # loop time the user was queued at
+        self.queuedAt = queuedAt
+        # order of the entry across all subjects
+        self.sequence = sequence
+        # order of the entry within its subject
+        self.ticket = ticket
+
 
 class TutorManager:
 
@@ -34,9 +102,62 @@ class TutorManager:
         self.subjectTutors = dict()
         # dict storing id->tutor
         self.tutorList = dict()
-        self.queue = list()
         for subject in subjects:
             self.subjectTutors[subject] = list()
+        self.build_idle_index()
+        self.build_queue()
+
+    def __getstate__(self):
+        # the idle index is derived from the tutor list so it is rebuilt on load instead of being stored,
+        # and queued channels do not outlive the connection so the queue is not stored either
+        state = self.__dict__.copy()
+        for key in ('idleTutors', 'tutorVersions', 'idleSequence', 'helpingTutors', 'offlineTutors', 'queue', 'subjectQueues', 'queuedUsers', 'cancelledTickets', 'subjectTickets', 'queueSequence'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.pop('queue', None)
+        self.build_idle_index()
+        self.build_queue()
+
+    def build_idle_index(self):
+        # dict storing subject->heap of (lastQuestion key, sequence, tutor id, version) for idle tutors
+        self.idleTutors = dict()
+        for subject in subjects:
+            self.idleTutors[subject] = list()
+        # dict storing id->version of the tutor's heap entries, bumped on every status change so stale entries can be skipped
+        self.tutorVersions = dict()
+        self.idleSequence = 0
+        # set of the ids of tutors handed to a student and not done yet
+        self.helpingTutors = set()
+        # set of the ids of offline tutors, who stay busy until they come back whether or not they were helping someone
+        self.offlineTutors = set()
+        for tutor in self.tutorList.values():
+            self.index_tutor(tutor)
+
+    def index_tutor(self, tutor):
+        # invalidate any existing heap entries of the tutor
+        version = self.tutorVersions.get(tutor.id, 0) + 1
+        self.tutorVersions[tutor.id] = version
+        if tutor.busy:
+            return
+        # push a fresh entry for each subject the idle tutor teaches
+        key = last_question_key(tutor.lastQuestion)
+        for subject in tutor.subjects:
+            heap = self.idleTutors.get(subject)
+            if heap == None:
+                continue
+            heapq.heappush(heap, (key, self.idleSequence, tutor.id, version))
+            self.idleSequence += 1
+            # drop stale entries once they outnumber the tutors of the subject
+            if len(heap) > 2 * len(self.subjectTutors[subject]) + 16:
+                self.compact_idle_index(subject)
+
+    def compact_idle_index(self, subject):
+        heap = [entry for entry in self.idleTutors[subject] if self.tutorVersions.get(entry[2]) == entry[3]]
+        heapq.heapify(heap)
+        self.idleTutors[subject] = heap
 
     def add_tutor(self, tutor):
         # overwrites tutor if tutor already exists, otherwise add tutor
@@ -53,34 +174,43 @@ class TutorManager:
                 # add tutor to subject
                 self.subjectTutors[subject].append(tutor.id)
             # other scenarios such as tutor remaining (un)subscribed require no changes to list
-    
+        self.index_tutor(tutor)
+
     def request_tutor(self, subject):
-        # gets a tutor for the specific subject
-        assignedTutor = None
-        if self.subjectTutors.get(subject) != None:
-            for tutor in self.subjectTutors[subject]:
-                tutor = self.tutorList[tutor]
-                if tutor.busy:
-                    continue
-                if assignedTutor == None:
-                    assignedTutor = tutor
-                elif assignedTutor.lastQuestion > tutor.lastQuestion:
-                    assignedTutor = tutor
-        if assignedTutor != None:
+        # gets the least recently used idle tutor for the specific subject
+        heap = self.idleTutors.get(subject)
+        if heap == None:
+            return None
+        while heap:
+            key, sequence, tutorId, version = heapq.heappop(heap)
+            # skip entries invalidated by a later status change
+            if self.tutorVersions.get(tutorId) != version:
+                continue
             # set assigned tutor to busy status
-            self.tutorList[assignedTutor.id].busy = True
-        return assignedTutor
+            self.hand_out(tutorId)
+            return self.tutorList[tutorId]
+        return None
 
     def request_tutor_by_id(self, tutorId):
         if self.tutorList[tutorId].busy:
             return None
         else:
-            self.tutorList[tutorId].busy = True
+            self.hand_out(tutorId)
         return tutorId
 
+    def hand_out(self, tutorId):
+        tutor = self.tutorList[tutorId]
+        tutor.busy = True
+        self.helpingTutors.add(tutorId)
+        self.index_tutor(tutor)
+
     def mark_done(self, tutorId):
-        self.tutorList[tutorId].busy = False
-        self.tutorList[tutorId].lastQuestion = datetime.now()
+        # tutors who went offline while helping are only idle again once they come back
+        tutor = self.tutorList[tutorId]
+        tutor.busy = tutorId in self.offlineTutors
+        tutor.lastQuestion = datetime.now()
+        self.helpingTutors.discard(tutorId)
+        self.index_tutor(tutor)
 
     def reset_all(self):
         for key in self.tutorList.keys():
@@ -90,256 +220,780 @@ class TutorManager:
     def is_busy(self, tutorId):
         return self.tutorList[tutorId].busy
 
+    def is_offline(self, tutorId):
+        return tutorId in self.offlineTutors
+
     def set_busy(self, tutorId):
-        self.tutorList[tutorId].busy = True
+        # the tutor went offline
+        self.offlineTutors.add(tutorId)
+        tutor = self.tutorList[tutorId]
+        tutor.busy = True
+        self.index_tutor(tutor)
 
     def set_unbusy(self, tutorId):
-        self.tutorList[tutorId].busy = False
+        # the tutor came back. tutors helping a student stay busy until they are marked done, returns whether the tutor is idle now
+        self.offlineTutors.discard(tutorId)
+        if tutorId in self.helpingTutors:
+            return False
+        tutor = self.tutorList[tutorId]
+        tutor.busy = False
+        self.index_tutor(tutor)
+        return True
 
     def get_tutor_by_id(self, tutorId):
         return self.tutorList.get(tutorId)
 
-    def add_to_queue(self, userId, channel, subject):
-        queueTuple = (userId, channel, subject)
-        if queueTuple not in self.queue:
-            self.queue.append(queueTuple)
-
-    def next_in_queue(self, tutorId):
-        tutor = self.tutorList.get(tutorId)
-        if tutor == None:
-            raise KeyError("Invalid tutor id %s" % (tutorId))
-        nextInQueue = None
-        for queuedUser in self.queue:
-            if queuedUser[2] in tutor.subjects:
-                nextInQueue = queuedUser
-                self.queue.remove(queuedUser)
-                break
-        return nextInQueue
+    def build_queue(self):
+        # dict storing subject->OrderedDict of userId->queue entry, oldest first
+        self.subjectQueues = dict()
+        # dict storing subject->sorted list of tickets cancelled from the middle of the subject queue
+        self.cancelledTickets = dict()
+        # dict storing subject->next ticket to hand out
+        self.subjectTickets = dict()
+        for subject in subjects:
+            self.subjectQueues[subject] = OrderedDict()
+            self.cancelledTickets[subject] = list()
+            self.subjectTickets[subject] = 0
+        # dict storing userId->queue entry
+        self.queuedUsers = dict()
+        self.queueSequence = 0
+
+    def add_to_queue(self, userId, channel, subject, queuedAt=None):
+        # queues the user unless they are already waiting, returns the user's position in the queue
+        if userId not in self.queuedUsers and subject in self.subjectQueues:
+            entry = QueueEntry(userId, channel, subject, self.queueSequence, self.subjectTickets[subject], queuedAt)
+            self.queueSequence += 1
+            self.subjectTickets[subject] += 1
+            self.subjectQueues[subject][userId] = entry
+            self.queuedUsers[userId] = entry
+        return self.queue_position(userId)
+
+    def remove_from_queue(self, userId):
+        # removes the user from the queue, returns whether they were queued
+        entry = self.queuedUsers.pop(userId, None)
+        if entry == None:
+            return False
+        subjectQueue = self.subjectQueues[entry.subject]
+        del subjectQueue[userId]
+        cancelled = self.cancelledTickets[entry.subject]
+        if not subjectQueue:
+            cancelled.clear()
+            return True
+        headTicket = next(iter(subjectQueue.values())).ticket
+        # remember tickets removed from behind the head so positions further back stay correct
+        if entry.ticket > headTicket:
+            bisect.insort(cancelled, entry.ticket)
+        # forget cancelled tickets the head has moved past
+        del cancelled[:bisect.bisect_left(cancelled, headTicket)]
+        return True
+
+    def queue_position(self, userId):
+        # returns the 1-based position of the user within their subject queue, or None if not queued
+        entry = self.queuedUsers.get(userId)
+        if entry == None:
+            return None
+        headTicket = next(iter(self.subjectQueues[entry.subject].values())).ticket
+        skipped = bisect.bisect_left(self.cancelledTickets[entry.subject], entry.ticket)
+        return entry.ticket - headTicket - skipped + 1
+
+    def queue_length(self, subject):
+        return len(self.subjectQueues[subject])
+
+    def match_queue(self):
+        # pairs queued users with idle tutors in one pass, returns a list of (queue entry, tutor).
+        # the oldest entry across all subjects is served first and gets the subject's least recently used idle tutor
+        matches = list()
+        # subjects with waiting users that may still have idle tutors
+        candidates = [subject for subject in subjects if self.subjectQueues[subject]]
+        while candidates:
+            subject = min(candidates, key=lambda subject: next(iter(self.subjectQueues[subject].values())).sequence)
+            tutor = self.request_tutor(subject)
+            if tutor == None:
+                candidates.remove(subject)
+                continue
+            entry = next(iter(self.subjectQueues[subject].values()))
+            self.remove_from_queue(entry.userId)
+            matches.append((entry, tutor))
+            if not self.subjectQueues[subject]:
+                candidates.remove(subject)
+        return matches
+
+
+def handler_timer(event):
+    return metrics.timed('tutorbot_handler_seconds', 'Seconds spent in discord event handlers.', event=event)
+
 
 class TutorUser:
+    # the bot keeps one of these for every member in memory, so they have no instance dict and share the subject bit table.
+    # they are weakly referenced by the user repository
+    __slots__ = ('__subscribedSubjects', 'helpMessageId', 'privateChannelId', 'assignedTutors', 'email', 'emailChangedAt', '__weakref__')
+
+    # subject->bit in the subscribed subjects bitmask, in the order of subjects
+    subjectBits = {subject: 1 << index for index, subject in enumerate(subjects)}
 
     def __init__(self):
         self.__subscribedSubjects = 0
         self.helpMessageId = None
         self.privateChannelId = None
-        self.assignedTutors = list()
+        # tuple of the ids of the tutors helping the user, the empty tuple is shared by everyone who is not being helped
+        self.assignedTutors = ()
         self.email = None
+        # unix time the email was last verified or cleared
+        self.emailChangedAt = None
 
-        self.subjects = {'math': 0x1, 'hist': 0x2, 'geo': 0x4, 'bio': 0x8, 'chem': 0x10, 'physics': 0x20, 'comp sci': 0x40}
+    def __getstate__(self):
+        return self.to_row(None)[1:]
+
+    def __setstate__(self, state):
+        self.__init__()
+        if isinstance(state, dict):
+            # pickles written before __slots__ hold the instance dict and bits of the old subject table
+            self.__subscribedSubjects = convert_legacy_subjects(state.get('_TutorUser__subscribedSubjects', 0))
+            self.helpMessageId = state.get('helpMessageId')
+            self.privateChannelId = state.get('privateChannelId')
+            self.email = state.get('email')
+        else:
+            self.load_row((None,) + tuple(state))
 
     def subscribe_to(self, subject):
         # subscribes the user to a subject using the bitmask
-        subject = self.subjects[subject]
-        if(not (self.__subscribedSubjects & subject)):
-            self.__subscribedSubjects ^= subject
+        self.__subscribedSubjects |= self.subjectBits[subject]
 
     def unsubscribe_to(self, subject):
         # unsubscribes the user to a subject using the bitmask
-        subject = self.subjects[subject]
-        if(self.__subscribedSubjects & subject):
-            self.__subscribedSubjects ^= subject
+        self.__subscribedSubjects &= ~self.subjectBits[subject]
 
     def is_subscribed(self, subject):
         # returns whether a user is subscribed to a subject or not
-        return bool(self.__subscribedSubjects & self.subjects[subject])
+        return bool(self.__subscribedSubjects & self.subjectBits[subject])
+
+    def to_row(self, userId):
+        # converts the user into a row of the users table, assigned tutors are not persisted
+        return (userId, self.__subscribedSubjects, self.helpMessageId, self.privateChannelId, self.email, self.emailChangedAt)
+
+    def load_row(self, row):
+        self.__subscribedSubjects, self.helpMessageId, self.privateChannelId, self.email, self.emailChangedAt = row[1:]
+
+
+# bit->subject of the subject table users had before it followed subjects, topics without a subject of their own become other
+legacySubjectBits = {0x1: 'math', 0x2: 'other', 0x4: 'other', 0x8: 'bio', 0x10: 'chem', 0x20: 'physics', 0x40: 'cs'}
+
+
+def convert_legacy_subjects(legacyMask):
+    # converts a subscribed subjects bitmask of the old subject table into one of TutorUser.subjectBits
+    subscribedSubjects = 0
+    for bit, subject in legacySubjectBits.items():
+        if legacyMask & bit:
+            subscribedSubjects |= TutorUser.subjectBits[subject]
+    return subscribedSubjects
+
+
+def load_tutor_manager(store, guildId):
+    tutorManager = TutorManager()
+    for row in store.load_tutors(guildId):
+        tutor = Tutor()
+        tutor.load_row(row)
+        tutorManager.add_tutor(tutor)
+    return tutorManager
+
+
+def load_pickle(filePath, default):
+    try:
+        with open(filePath, 'rb') as pickleFile:
+            return pickle.load(pickleFile)
+    except Exception:
+        return default
+
+
+def prepare_store(store, userListFilePath, tutorManagerFilePath):
+    # brings the store up to SCHEMA_VERSION, run by every bot on start and once by the launcher before it starts several processes
+    if store.is_empty():
+        migrate_pickles(store, userListFilePath, tutorManagerFilePath)
+    else:
+        if store.schema_version() < 1:
+            migrate_subject_bits(store)
+        if store.schema_version() < 3:
+            logging.info (textColour+"keyed the emails of %s users" % (store.fill_email_keys()))
+    store.set_schema_version(tutor_store.SCHEMA_VERSION)
+
+
+def migrate_pickles(store, userListFilePath, tutorManagerFilePath):
+    # copy the pickled user list and tutor manager into the state store and set the pickle files aside.
+    # they come from a single guild bot, so the rows wait in UNASSIGNED_GUILD for that guild to claim them
+    userList = load_pickle(userListFilePath, dict())
+    tutorManager = load_pickle(tutorManagerFilePath, TutorManager())
+    store.put_users(tutor_store.UNASSIGNED_GUILD, (user.to_row(userId) for userId, user in userList.items()))
+    store.put_tutors(tutor_store.UNASSIGNED_GUILD, (tutor.to_row() for tutor in tutorManager.tutorList.values()))
+    for filePath in (userListFilePath, tutorManagerFilePath):
+        if os.path.exists(filePath):
+            os.replace(filePath, filePath + '.migrated')
+            logging.info (textColour+"migrated %s into the state store" % (filePath))
+
+
+def migrate_subject_bits(store):
+    # stores written before the subject table followed subjects hold bits of the old table, and only one guild
+    rows = [row for row in store.load_users(tutor_store.UNASSIGNED_GUILD) if row[1]]
+    store.put_users(tutor_store.UNASSIGNED_GUILD, ((row[0], convert_legacy_subjects(row[1])) + tuple(row[2:]) for row in rows))
+    logging.info (textColour+"converted the subjects of %s users" % (len(rows)))
+
+
+class GuildState:
+    # the users, tutors, queue and timeouts of one guild. guilds share none of them, in memory or in the store,
+    # so each guild can be served by whichever shard and process owns it
+
+    def __init__(self, bot, guildId):
+        self.bot = bot
+        self.guildId = guildId
+        self.store = bot.store
+        # users are read from the store as they are needed
+        self.userList = user_repository.UserRepository(self.store, guildId, TutorUser, bot.userCacheSize)
+        self.build_user_indexes()
+        self.tutorManager = load_tutor_manager(self.store, guildId)
+        # private channel expiry deadlines of offline users, persisted so they survive restarts
+        self.userTimeouts = scheduler.DeadlineScheduler(self.expire_user_channel, self.store, guildId)
+        self.userTimeouts.load()
+        # ids of users whose private channel is being created
+        self.creatingChannels = set()
+        # hands idle tutors to students and drains the queue when tutors become available
+        self.matcher = matching.MatchingEngine(bot, self)
+        self.closed = False
+
+    def start(self, loop):
+        self.userList.start(loop)
+        self.userTimeouts.start(loop)
+        self.matcher.start(loop)
+        # serve whoever is still queued with the tutors that are online now
+        self.matcher.notify()
+
+    def stop(self):
+        self.userTimeouts.stop()
+        self.matcher.stop()
+
+    def close(self):
+        # the last changes are written once, the store may be closed right after
+        if self.closed:
+            return
+        self.closed = True
+        self.stop()
+        # first reset all assigned tutors, only users in memory can have any
+        for user in self.userList.held_users():
+            user.assignedTutors = ()
+        # also reset all tutors to not busy
+        self.tutorManager.reset_all()
+        # write the users changed since the last flush and the reset tutors
+        self.userList.stop()
+        self.store.put_tutors(self.guildId, (tutor.to_row() for tutor in self.tutorManager.tutorList.values()))
+
+    async def expire_user_channel(self, userId):
+        await self.bot.expire_user_channel(self, userId)
+
+    def add_user(self, userId):
+        # add user to internal list of users if not already present
+        if userId not in self.userList:
+            self.userList[userId] = TutorUser()
+            self.save_user(userId)
+        return self.userList[userId]
+
+    def build_user_indexes(self):
+        # only users with a private channel have a channel or help message, so these stay small whatever the member count
+        # dict storing private channel id->user id
+        self.channelOwners = dict()
+        # dict storing help message id->user id
+        self.helpMessageOwners = dict()
+        for userId, channelId, helpMessageId in self.store.load_channel_links(self.guildId):
+            if channelId != None:
+                self.channelOwners[channelId] = userId
+            if helpMessageId != None:
+                self.helpMessageOwners[helpMessageId] = userId
+
+    def find_channel_owner(self, channelId):
+        # returns the id of the user whose private channel this is, or None
+        return self.channelOwners.get(channelId)
+
+    def find_help_message_owner(self, messageId):
+        # returns the id of the user whose help message this is, or None
+        return self.helpMessageOwners.get(messageId)
+
+    def find_email_owner(self, email):
+        # returns the id of the user the email is verified for, or None. emails of every user do not fit in memory, the store is asked
+        emailKey = email_export.email_key(email)
+        return self.userList.find_owner('email_key', emailKey, lambda user: bool(user.email) and email_export.email_key(user.email) == emailKey)
+
+    def private_channels(self):
+        # returns a list of (private channel id, user id)
+        return list(self.channelOwners.items())
+
+    def set_email(self, userId, email):
+        # verifies or with None clears the user's email
+        user = self.userList[userId]
+        user.email = email
+        user.emailChangedAt = datetime.now().timestamp()
+
+    def bind_private_channel(self, userId, channelId, helpMessageId=None):
+        # private channels and help messages are only changed through these methods so the indexes stay in step with the users
+        self.clear_private_channel(userId)
+        self.userList[userId].privateChannelId = channelId
+        self.channelOwners[channelId] = userId
+        self.set_help_message(userId, helpMessageId)
+
+    def set_help_message(self, userId, helpMessageId):
+        user = self.userList[userId]
+        if user.helpMessageId != None and self.helpMessageOwners.get(user.helpMessageId) == userId:
+            del self.helpMessageOwners[user.helpMessageId]
+        user.helpMessageId = helpMessageId
+        if helpMessageId != None:
+            self.helpMessageOwners[helpMessageId] = userId
+
+    def clear_private_channel(self, userId):
+        user = self.userList[userId]
+        if user.privateChannelId != None and self.channelOwners.get(user.privateChannelId) == userId:
+            del self.channelOwners[user.privateChannelId]
+        user.privateChannelId = None
+        self.set_help_message(userId, None)
+
+    def save_user(self, userId):
+        # the user is written back with the next batch of changed users
+        self.userList.mark_dirty(userId)
+
+    def save_tutor(self, tutorId):
+        tutor = self.tutorManager.get_tutor_by_id(tutorId)
+        if tutor != None:
+            self.store.put_tutor(self.guildId, tutor.to_row())
+
+    def tutor_counts(self):
+        # returns (helping, idle, unavailable) tutors, unavailable tutors are offline or teach no subjects
+        helping = len(self.tutorManager.helpingTutors)
+        idle = 0
+        for tutor in self.tutorManager.tutorList.values():
+            if not tutor.busy and tutor.subjects:
+                idle += 1
+        return helping, idle, len(self.tutorManager.tutorList) - helping - idle
+
 
 class TutorBot(discord.Client):
 
-    def __init__(self, timeoutDuration, userListFilePath, tutorManagerFilePath, officeHours, doQueue=True):
-        super().__init__()
-        self.userList = dict()
-        self.userTimeoutList = dict()
-        self.tutorManager = TutorManager()
+    def __init__(self, timeoutDuration, userListFilePath, tutorManagerFilePath, officeHours, doQueue=True, stateFilePath='tutor_state.db',
+                 channelPoolLow=5, channelPoolHigh=20, metricsPort=None, processCount=1, legacyGuildId=None,
+                 snapshotInterval=15 * MINUTE, snapshotGenerations=4, tracePath=None, userCacheSize=5000, **clientOptions):
+        # clientOptions go to discord, such as shard_id and shard_count, or shard_ids with ShardedTutorBot
+        super().__init__(**clientOptions)
+        # dict storing guild id->GuildState, loaded on first use
+        self.guildStates = dict()
+        # number of processes serving slices of the shards with this store, they split the bot's global rate limit
+        self.processCount = processCount
+        # guild that claims the rows of a store written by a single guild bot, with one process the first guild loaded does
+        self.legacyGuildId = legacyGuildId
+        # users of each guild kept in memory, the rest are read from the store when needed
+        self.userCacheSize = userCacheSize
+        self.verificationTask = None
+        # set by the first close, later ones do nothing
+        self.closed = False
         self.timeoutDuration = timeoutDuration
+        # pickle files written by older versions, imported into the state store on first start
         self.userListFilePath = userListFilePath
         self.tutorManagerFilePath = tutorManagerFilePath
         self.doQueue = doQueue
-        # expects list of two-tuples representing a list of contiguous segments of time
+        # expects an OfficeHours schedule, or a list of two-tuples representing contiguous segments of UTC time on every day
+        if not isinstance(officeHours, office_hours.OfficeHours):
+            officeHours = office_hours.OfficeHours.daily(officeHours)
         self.officeHours = officeHours
-        try:
-            userListFile = open(userListFilePath, 'rb')
-            self.userList = pickle.load(userListFile)
-            userListFile.close()
-        except:
-            self.userList = dict()
-        try:
-            tutorManagerFile = open(tutorManagerFilePath, 'rb')
-            self.tutorManager = pickle.load(tutorManagerFile)
-            tutorManagerFile.close()
-        except:
-            self.tutorManager = TutorManager()
+        # name->id lookups of the roles, channels and categories of each guild
+        self.guildCache = guild_cache.GuildCache()
+        self.commandRouter = command_router.CommandRouter(self.guildCache.role)
+        # paces outbound api calls per route and runs user facing calls before housekeeping
+        self.api = api_scheduler.ApiScheduler(globalShare=1.0 / processCount)
+        self.register_commands()
+        self.store = tutor_store.StateStore(stateFilePath)
+        prepare_store(self.store, self.userListFilePath, self.tutorManagerFilePath)
+        # copies of the store in the snapshots directory next to it, with several processes only one of them should take them
+        self.snapshotter = snapshot.Snapshotter(stateFilePath, os.path.join(os.path.dirname(stateFilePath), 'snapshots'), snapshotInterval, snapshotGenerations)
+        # private channels built ahead of time for joining members
+        self.channelPool = channel_pool.ChannelPool(self.build_pool_channel, self.store, channelPoolLow, channelPoolHigh)
+        # seconds from a member joining until their private channel is usable
+        self.joinLatency = metrics.Histogram()
+        self.reconciler = reconcile.Reconciler(self)
+        # deletes private channels in bulk, shared with expired timeouts
+        self.pruner = prune.PruneEngine(self, self.store)
+        # prometheus metrics, served on metricsPort of the local host when it is set
+        self.metrics = metrics.Registry()
+        self.loopLag = metrics.LoopLagMonitor()
+        self.metricsServer = None
+        if metricsPort != None:
+            self.metricsServer = metrics.MetricsServer(self.metrics, port=metricsPort)
+        self.metrics.add_histogram('tutorbot_join_seconds', 'Seconds from a member joining until their private channel is usable.', self.joinLatency)
+        self.metrics.add_histogram('tutorbot_loop_lag_seconds', 'Seconds the event loop woke up late.', self.loopLag.lag)
+        self.metrics.add_histogram('tutorbot_snapshot_seconds', 'Seconds taken to write a snapshot of the state store.', self.snapshotter.duration)
+        self.metrics.add_collector(self.collect_metrics)
+        # records the events users cause to tracePath once the bot is ready, for replaying with trace_replay.py
+        self.traceRecorder = None
+        if tracePath != None:
+            self.traceRecorder = event_trace.TraceRecorder(self, tracePath)
+
+    def dispatch(self, event, *args, **kwargs):
+        if self.traceRecorder != None:
+            self.traceRecorder.record(event, args)
+        super().dispatch(event, *args, **kwargs)
+
+    def guild_state(self, guild):
+        # returns the state of the guild, loading it from the store the first time the guild is seen
+        state = self.guildStates.get(guild.id)
+        if state == None:
+            if self.legacyGuildId == guild.id or (self.legacyGuildId == None and self.processCount == 1):
+                claimed = self.store.claim_unassigned(guild.id)
+                if claimed:
+                    logging.info (textColour+"%s claimed %s users of the single guild store" % (guild.name, claimed))
+            state = GuildState(self, guild.id)
+            self.guildStates[guild.id] = state
+            # deadlines that passed while the bot was down would fire as soon as the driver starts,
+            # drop the ones of members who are online again before the reconciler gets to them
+            for userId in state.userTimeouts.keys():
+                member = guild.get_member(userId)
+                if member != None and member.status != discord.Status.offline:
+                    state.userTimeouts.cancel(userId)
+            self.metrics.add_histogram('tutorbot_time_to_match_seconds', 'Seconds from a student asking for a tutor until they are told who it is.',
+                                       state.matcher.timeToMatch, guild=guild.id)
+            state.start(self.loop)
+            logging.info (textColour+"%s has %s users and %s tutors" % (guild.name, len(state.userList), len(state.tutorManager.tutorList)))
+        return state
+
+    def setup_guild(self, guild):
+        state = self.guild_state(guild)
+        # build the tutor index from roles once, role changes keep it current afterwards
+        self.build_tutor_index(guild)
+        self.channelPool.load(guild)
+        self.channelPool.refill(guild)
+        # check the stored state of every member against the existing channels in the background, commands are served meanwhile
+        self.reconciler.start(guild)
+        # carry on with a prune that was interrupted by the restart
+        self.pruner.resume(guild)
+        state.matcher.notify()
 
+    @handler_timer('on_ready')
     async def on_ready(self):
         logging.info (textColour+"Logged on as %s" % (self.user))
-        # iterate through all users 
-        for user in self.get_all_members():
-            # see if user joined during server downtime and add them to internal memory if so
-            if user.id not in self.userList:
-                self.userList[user.id] = TutorUser()
-            # if user is offline set a timeout for them
-            if user.status == discord.Status.offline:
-                await self.set_user_timeout(user)
-            # if user is online check if they have a private channel, if not create one for them
-            elif user.status != discord.Status.offline:
-                if self.userList[user.id].privateChannelId == None:
-                    self.loop.create_task(self.create_private_channel(user))
+        self.loopLag.start(self.loop)
+        if self.metricsServer != None:
+            await self.metricsServer.start()
+        # the guilds of this process's shards
+        for guild in self.guilds:
+            self.setup_guild(guild)
+        self.officeHours.start(self.loop, self.office_hours_changed)
+        self.snapshotter.start(self.loop)
+        if self.processCount > 1 and self.verificationTask == None:
+            self.verificationTask = self.loop.create_task(self.apply_shared_verifications())
+        # on_ready runs again after reconnecting, the trace carries on
+        if self.traceRecorder != None and self.traceRecorder.traceFile == None:
+            self.traceRecorder.open()
 
+    def register_commands(self):
+        adminRoles = ['Tutor Bot Admin']
+        tutorRoles = ['Oracle Tutor']
+        self.commandRouter.add_command('channel', self.command_channel, adminRoles)
+        self.commandRouter.add_command('fakejoin', self.command_fakejoin, adminRoles)
+        self.commandRouter.add_command('prune', self.command_prune, adminRoles)
+        self.commandRouter.add_command('refreshtutors', self.command_refreshtutors, adminRoles)
+        self.commandRouter.add_command('done', self.command_done, tutorRoles + adminRoles)
+        self.commandRouter.add_command('invitetutor', self.command_invitetutor, tutorRoles)
+        self.commandRouter.add_command('unverify', self.command_unverify, adminRoles)
+        self.commandRouter.add_command('verify', self.command_verify)
+        self.commandRouter.add_command('emails', self.command_emails, adminRoles)
+        self.commandRouter.add_command('reconcile', self.command_reconcile, adminRoles)
+        self.commandRouter.add_command('stats', self.command_stats, adminRoles)
+        self.commandRouter.add_command('snapshot', self.command_snapshot, adminRoles)
+
+    @handler_timer('on_message')
     async def on_message(self, message):
         # return if message is self
         if message.author == self.user:
             return
         # guild specific commands:
         # check whether the channel message was sent in was in a guild
-        if type(message.author) == discord.member.Member:
-            botAdminRole = discord.utils.get(message.author.guild.roles, name='Tutor Bot Admin')
-            tutorRole = discord.utils.get(message.author.guild.roles, name='Oracle Tutor')
-            verifiedEmailRole = discord.utils.get(message.author.guild.roles, name='Verified Email')
-            # force creation of new private channel
-            if message.content.startswith("!channel") and botAdminRole in message.author.roles:
-                if message.mentions:
-                    channelUser = message.mentions[0]
-                else:
-                    channelUser = message.author
-                await self.create_private_channel(channelUser)
-            # call on_member_join function
-            if message.content == '!fakejoin' and botAdminRole in message.author.roles:
-                await self.on_member_join(message.author)
-            # delete all created private channels
-            elif message.content == "!prune" and botAdminRole in message.author.roles:
-                privChannelCategory = discord.utils.get(message.guild.categories, name='Your Private Channels')
-                for channel in privChannelCategory.channels:
-                    await self.delete_user_channel(channel, int(channel.topic))
-            # refresh tutor list
-            elif message.content == "!refreshtutors" and botAdminRole in message.author.roles:
-                server = message.author.guild
-                # check if the server is large, and request offline users if so
-                if server.large:
-                    self.request_offline_members(server)
-                # for each user check if they are a tutor
-                tutorRole = discord.utils.get(server.roles, name='Oracle Tutor')
-                for user in message.author.guild.members:
-                    if tutorRole in user.roles:
-                        # update that tutor
-                        self.loop.create_task(self.update_tutor(user))
-            elif message.content == '!done' and (tutorRole in message.author.roles or botAdminRole in message.author.roles):
-                # check if tutor who sent message is the assigned tutor
-                tutorRequestee = self.get_user(int(message.channel.topic))
-                if message.author.id not in self.userList[tutorRequestee.id].assignedTutors and botAdminRole not in message.author.roles:
-                    await message.channel.send("You are not the assigned tutor to this channel!")
-                    return
-                # revoke tutor permissions and mark them as done and check if there is a queued user with requested subjects that they tutor
-                for tutorId in self.userList[tutorRequestee.id].assignedTutors:
-                    await message.channel.set_permissions(self.get_user(tutorId), read_messages=None)
-                    self.tutorManager.mark_done(tutorId)
-                    # check if there exists user in queue with desired subject in tutor subject list
-                    queueEntry = self.tutorManager.next_in_queue(tutorId)
-                    if queueEntry != None:
-                        await self.assign_tutor(*queueEntry)
-                # mark the user as not having an assigned tutor anymore
-                self.userList[tutorRequestee.id].assignedTutors = list()
-                await message.channel.send("This question has been marked as complete.")
-            elif message.content.startswith("!invitetutor") and tutorRole in message.author.roles:
-                # check if tutor who sent message is the assigned tutor
-                tutorRequestee = self.get_user(int(message.channel.topic))
-                if message.author.id not in self.userList[tutorRequestee.id].assignedTutors:
-                    await message.channel.send("You are not the assigned tutor to this channel!")
-                    return
-                if not message.mentions:
-                    await message.channel.send("Please specify a tutor to invite!")
-                invitedTutor = message.mentions[0]
-                # check if requested tutor is currently available
-                if not self.tutorManager.is_busy(invitedTutor.id):
-                    # invite the tutor to the channel
-                    self.tutorManager.request_tutor_by_id(invitedTutor.id)
-                    self.userList[tutorRequestee.id].assignedTutors.append(invitedTutor.id)
-                    await message.channel.set_permissions(invitedTutor, read_messages=True)
-                    await message.channel.send("Hi, %s! You've been invited to join in on this discussion." % (invitedTutor.mention))
-                else:
-                    await message.channel.send("Sorry, that tutor is currently busy. Please try again at a later time.")
-            elif message.content.startswith('!unverify') and botAdminRole in message.author.roles:
-                unverifyList = list()
-                # check if message mentions is empty
-                if not message.mentions:
-                    unverifyList.append(message.author)
-                else:
-                    unverifyList = message.mentions
-                for user in unverifyList:
-                    self.userList[user.id].email = None
-            elif message.content.startswith("!verify"):
-                if verifiedEmailRole in message.author.roles:
-                    await message.channel.send('You already have an email linked to your account!')
-                else:
-                    await self.send_verification(message.author)
-            elif message.content == '!emails' and botAdminRole in message.author.roles:
-                self.dump_emails()
-
+        if message.guild != None:
+            await self.commandRouter.dispatch(message)
         # otherwise, message is in private channel or group dm
         else:
-            # check if user has verified email, if not expect it to be email verification
-            if not self.userList[message.author.id].email:
-                if re.match(r"[^@]+@[^@]+\.[^@]+", message.content):
-                    self.userList[message.author.id].email = message.content
-                    await message.channel.send('Thank you! You should now be able to use all of our services now.')
-                    await self.give_user_role(self.guilds[0].get_member(message.author.id), 'Verified Email')
-                else:
-                    await message.channel.send('Please verify your account with a valid email address!')
-
-        
+            await self.verify_email(message)
+
+    async def verify_email(self, message):
+        # a member of several guilds verifies once for all of them
+        userId = message.author.id
+        states = [self.guild_state(guild) for guild in self.guilds if guild.get_member(userId) != None]
+        unverified = [state for state in states if not state.add_user(userId).email]
+        # with several processes the member's other guilds belong to other processes, whose users are read from the store
+        elsewhere = list()
+        if self.processCount > 1:
+            ownGuildIds = set(guild.id for guild in self.guilds)
+            elsewhere = [(guildId, email) for guildId, email in self.store.load_user_emails(userId) if guildId not in ownGuildIds]
+        unverifiedElsewhere = [guildId for guildId, email in elsewhere if not email]
+        isEmail = re.match(r"[^@]+@[^@]+\.[^@]+", message.content)
+        # check if user has verified email, if not expect it to be email verification
+        if not unverified and not unverifiedElsewhere:
+            # members verified everywhere dm the bot for other reasons too, only an email gets an answer
+            if isEmail and (states or elsewhere):
+                await self.send_message(message.channel, 'You already have an email linked to your account!')
+            return
+        if not isEmail:
+            await self.send_message(message.channel, 'Please verify your account with a valid email address!')
+            return
+        emailKey = email_export.email_key(message.content)
+        if (any(state.find_email_owner(message.content) != None for state in unverified) or
+                any(self.store.find_users(guildId, 'email_key', emailKey) for guildId in unverifiedElsewhere)):
+            await self.send_message(message.channel, 'That email is already linked to another account! Please use a different email address.')
+            return
+        for state in unverified:
+            state.set_email(userId, message.content)
+            state.save_user(userId)
+        if self.processCount > 1:
+            # discord sends every dm to shard 0, so the processes serving the member's other guilds learn of it through the store
+            self.store.put_email_verification(userId, message.content, datetime.now().timestamp())
+        await self.send_message(message.channel, 'Thank you! You should now be able to use all of our services now.')
+        for state in unverified:
+            await self.give_user_role(self.get_guild(state.guildId).get_member(userId), 'Verified Email')
+
+    async def apply_shared_verifications(self):
+        # verifies the members of this process's guilds whose email was verified by the process that got their dm
+        since = datetime.now().timestamp() - DAY
+        while True:
+            await asyncio.sleep(5 * SECOND)
+            for userId, email, verifiedAt in self.store.load_email_verifications(since):
+                since = max(since, verifiedAt)
+                for guild in self.guilds:
+                    member = guild.get_member(userId)
+                    if member == None:
+                        continue
+                    state = self.guild_state(guild)
+                    if state.add_user(userId).email:
+                        continue
+                    if state.find_email_owner(email) != None:
+                        # verify_email checked the guild's stored users, someone verified the email in between
+                        logging.info (textColour+"%s was not verified in %s, the email was taken in the meantime" % (userId, guild.name))
+                        continue
+                    state.set_email(userId, email)
+                    state.save_user(userId)
+                    await self.give_user_role(member, 'Verified Email')
+            # every process starts a day back, so older verifications are not needed anymore
+            self.store.delete_email_verifications(datetime.now().timestamp() - 7 * DAY)
+
+    # force creation of new private channel
+    async def command_channel(self, message, arguments):
+        if message.mentions:
+            channelUser = message.mentions[0]
+        else:
+            channelUser = message.author
+        await self.create_private_channel(channelUser)
+
+    # call on_member_join function
+    async def command_fakejoin(self, message, arguments):
+        await self.on_member_join(message.author)
+
+    # delete created private channels in the background
+    # usage: !prune [dry] [inactive <days>] [notutor], !prune status, !prune stop
+    async def command_prune(self, message, arguments):
+        words = arguments.split()
+        if words == ['status']:
+            await self.send_message(message.channel, "Prune: %s" % (self.pruner.describe(message.guild)))
+            return
+        if words == ['stop']:
+            if self.pruner.cancel(message.guild):
+                await self.send_message(message.channel, "Prune stopped: %s" % (self.pruner.describe(message.guild)))
+            else:
+                await self.send_message(message.channel, "No prune is running.")
+            return
+        dryRun = False
+        withoutTutor = False
+        inactiveDays = None
+        while words:
+            word = words.pop(0)
+            if word == 'dry':
+                dryRun = True
+            elif word == 'notutor':
+                withoutTutor = True
+            elif word == 'inactive' and words and words[0].isdigit():
+                inactiveDays = int(words.pop(0))
+            else:
+                await self.send_message(message.channel, "Usage: !prune [dry] [inactive <days>] [notutor], !prune status or !prune stop")
+                return
+        if self.pruner.is_running(message.guild):
+            await self.send_message(message.channel, "A prune is already running: %s" % (self.pruner.describe(message.guild)))
+            return
+        channels = self.pruner.select(message.guild, inactiveDays, withoutTutor)
+        if dryRun:
+            await self.send_message(message.channel, "Dry run: %s private channels would be pruned." % (len(channels)))
+            return
+        self.pruner.start(message.guild, message.channel, channels, withoutTutor)
+
+    # refresh tutor list
+    # the tutor index follows role changes, so this only checks it against the roles and reports any drift
+    async def command_refreshtutors(self, message, arguments):
+        drifted = self.build_tutor_index(message.guild)
+        if not drifted:
+            await self.send_message(message.channel, "The tutor list matches the tutor roles of all %s tutors." % (len(self.guild_state(message.guild).tutorManager.tutorList)))
+            return
+        mentions = ', '.join('<@%s>' % (tutorId) for tutorId in drifted[:20])
+        if len(drifted) > 20:
+            mentions += ' and %s more' % (len(drifted) - 20)
+        await self.send_message(message.channel, "Fixed %s tutors whose subjects had drifted from their roles: %s" % (len(drifted), mentions))
+
+    async def command_done(self, message, arguments):
+        botAdminRole = self.guildCache.role(message.guild, 'Tutor Bot Admin')
+        state = self.guild_state(message.guild)
+        userId = state.find_channel_owner(message.channel.id)
+        if userId == None:
+            await self.send_message(message.channel, "This is not a private channel!")
+            return
+        # check if tutor who sent message is the assigned tutor
+        if message.author.id not in state.userList[userId].assignedTutors and botAdminRole not in message.author.roles:
+            await self.send_message(message.channel, "You are not the assigned tutor to this channel!")
+            return
+        # mark the user as not having an assigned tutor anymore and the tutors as done before anything is awaited
+        assignedTutors = state.userList[userId].assignedTutors
+        state.userList[userId].assignedTutors = ()
+        for tutorId in assignedTutors:
+            state.tutorManager.mark_done(tutorId)
+            state.save_tutor(tutorId)
+        # the freed tutors can take queued users with subjects they tutor
+        state.matcher.notify()
+        # revoke tutor permissions
+        for tutorId in assignedTutors:
+            await self.set_channel_permissions(message.channel, self.get_user(tutorId), read_messages=None)
+        await self.send_message(message.channel, "This question has been marked as complete.")
+
+    async def command_invitetutor(self, message, arguments):
+        state = self.guild_state(message.guild)
+        userId = state.find_channel_owner(message.channel.id)
+        if userId == None:
+            await self.send_message(message.channel, "This is not a private channel!")
+            return
+        # check if tutor who sent message is the assigned tutor
+        if message.author.id not in state.userList[userId].assignedTutors:
+            await self.send_message(message.channel, "You are not the assigned tutor to this channel!")
+            return
+        if not message.mentions:
+            await self.send_message(message.channel, "Please specify a tutor to invite!")
+            return
+        invitedTutor = message.mentions[0]
+        # check if requested tutor is currently available
+        if not state.tutorManager.is_busy(invitedTutor.id):
+            # invite the tutor to the channel
+            state.tutorManager.request_tutor_by_id(invitedTutor.id)
+            state.userList[userId].assignedTutors += (invitedTutor.id,)
+            await self.set_channel_permissions(message.channel, invitedTutor, read_messages=True)
+            await self.send_message(message.channel, "Hi, %s! You've been invited to join in on this discussion." % (invitedTutor.mention))
+        else:
+            await self.send_message(message.channel, "Sorry, that tutor is currently busy. Please try again at a later time.")
+
+    async def command_unverify(self, message, arguments):
+        unverifyList = list()
+        # check if message mentions is empty
+        if not message.mentions:
+            unverifyList.append(message.author)
+        else:
+            unverifyList = message.mentions
+        state = self.guild_state(message.guild)
+        for user in unverifyList:
+            state.add_user(user.id)
+            state.set_email(user.id, None)
+            state.save_user(user.id)
+
+    async def command_verify(self, message, arguments):
+        verifiedEmailRole = self.guildCache.role(message.guild, 'Verified Email')
+        if verifiedEmailRole in message.author.roles:
+            await self.send_message(message.channel, 'You already have an email linked to your account!')
+        else:
+            await self.send_verification(message.author)
+
+    # usage: !emails [csv|jsonl] [new], new only exports the emails changed since the last export of that format
+    async def command_emails(self, message, arguments):
+        words = arguments.split()
+        exportFormat = 'csv'
+        incremental = False
+        for word in words:
+            if word in email_export.exportFormats:
+                exportFormat = word
+            elif word == 'new':
+                incremental = True
+            else:
+                await self.send_message(message.channel, "Usage: !emails [csv|jsonl] [new]")
+                return
+        await self.send_message(message.channel, "Exported %s emails to %s." % await self.dump_emails(message.guild, exportFormat, incremental))
+
+    # report the progress of the startup reconciliation, or run it again once it has finished
+    async def command_reconcile(self, message, arguments):
+        if not self.reconciler.is_running(message.guild) and arguments == 'run':
+            self.reconciler.start(message.guild)
+            await self.send_message(message.channel, "Reconciliation started.")
+            return
+        await self.send_message(message.channel, "Reconciliation: %s" % (self.reconciler.describe(message.guild)))
+
+    # summary of the metrics served on the metrics port
+    async def command_stats(self, message, arguments):
+        await self.send_message(message.channel, self.describe_stats(message.guild))
+
+    # take a snapshot of the state store now
+    async def command_snapshot(self, message, arguments):
+        snapshotPath, size, duration = await self.snapshotter.take()
+        await self.send_message(message.channel, "Snapshot %s written, %.1f MB in %.2f s." % (os.path.basename(snapshotPath), size / 1e6, duration))
+
+    @handler_timer('on_member_join')
     async def on_member_join(self, member):
         server = member.guild
+        joinTime = self.loop.time()
+        self.guild_state(server).add_user(member.id)
+        # create new private channel for user first, it is taken from the channel pool when possible
+        #if self.userList[member.id].privateChannelId == None:
+        await self.create_private_channel(member)
+        self.joinLatency.observe(self.loop.time() - joinTime)
         # give the new user welcome role
         await self.give_user_role(member, 'welcome role')
         # send welcome message in welcome channel
-        welcomeChannel = discord.utils.get(server.channels, name='welcome')
-        rulesChannel = discord.utils.get(server.channels, name='rules-and-procedures')
+        welcomeChannel = self.guildCache.channel(server, 'welcome')
+        rulesChannel = self.guildCache.channel(server, 'rules-and-procedures')
         welcomeMessage = ('Welcome, {user}! ' +
                           'We offer free online homework help and targeted tutoring for topics in Science, Math, English, French, Computer Science, and more! ' +
                           'Please read the rules on the {rules} channel before you begin. ' +
                           'Afterwards, hop on over to the private channel created exclusively for you and our tutors! You can find it under \'Your Private Channels\'.').format(
                              rules=rulesChannel.mention, user=member.mention
                          )
-        await welcomeChannel.send(welcomeMessage)
-        # add user to internal list of users if not already present
-        if member.id not in self.userList:
-            self.userList[member.id] = TutorUser()
-        # create new private channel for user
-        #if self.userList[member.id].privateChannelId == None:
-        await self.create_private_channel(member)
+        await self.send_message(welcomeChannel, welcomeMessage, api_scheduler.PRIORITY_NORMAL)
         await self.send_verification(member)
 
     # use on_raw_reaction_add to get reactions to messages not in message cache (such as messages sent before bot startup)
+    @handler_timer('on_raw_reaction_add')
     async def on_raw_reaction_add(self, payload):
         # check if reactor is bot client, if so return
         if payload.user_id == self.user.id:
             return
-        # check if the reacted message is the user's help message
-        if payload.message_id == self.userList[payload.user_id].helpMessageId:
+        state = self.guildStates.get(payload.guild_id)
+        # check if the reacted message is the user's help message, reactions to any other message end here
+        if state != None and state.find_help_message_owner(payload.message_id) == payload.user_id:
             # select the correct text channel
             server = payload.member.guild
             textChannel = server.get_channel(payload.channel_id)
             # find the user who added the reaction
             user = server.get_member(payload.user_id)
             # check if the user has a verified email
-            verifiedEmailRole = discord.utils.get(server.roles, name='Verified Email')
+            verifiedEmailRole = self.guildCache.role(server, 'Verified Email')
             if verifiedEmailRole not in user.roles:
-                await textChannel.send("Please verify your account first with a valid email! To resend the verification, type '!verify'.")
+                await self.send_message(textChannel, "Please verify your account first with a valid email! To resend the verification, type '!verify'.")
                 return
-            emoji = str(payload.emoji)
             # find the subject selected
-            subject = None
-            for key, value in subjectEmojis.items():
-                if value == emoji:
-                    subject = key
-                    break
+            subject = emojiSubjects.get(str(payload.emoji))
             if subject == None:
-                await textChannel.send("That is not a valid subject emoji. Try again.")
+                await self.send_message(textChannel, "That is not a valid subject emoji. Try again.")
                 return
             # assign the tutor to the channel
             await self.assign_tutor(payload.user_id, textChannel, subject)
 
+    @handler_timer('on_member_update')
     async def on_member_update(self, before, after):
         logging.debug (textColour+"%s, %s" %(before.id, after.id))
-        tutorRole = discord.utils.get(before.guild.roles, name='Oracle Tutor')
+        state = self.guild_state(after.guild)
+        # keep the tutor index current when roles are added or removed
+        if before.roles != after.roles:
+            changedRoles = set(before.roles).symmetric_difference(after.roles)
+            if any(role.name in tutorRoleNames for role in changedRoles):
+                self.update_tutor(after)
+        isTutor = state.tutorManager.get_tutor_by_id(after.id) != None
         # check if user status has changed
         if before.status != after.status:
             # check if user is offline
@@ -348,184 +1002,465 @@ class TutorBot(discord.Client):
                 logging.debug (textColour+"scheduling timeout")
                 await self.set_user_timeout(before)
                 # if user is a tutor, if so mark them as busy
-                if tutorRole in after.roles:
-                    self.tutorManager.set_busy(after.id)
+                if isTutor:
+                    state.tutorManager.set_busy(after.id)
             # check if user is coming online
             elif after.status != discord.Status.offline:
-                # cancel timeout task, if exists
-                timeoutTask = self.userTimeoutList.get(before.id)
-                if timeoutTask != None:
-                    timeoutTask.cancel()
+                # cancel timeout, if exists
+                state.userTimeouts.cancel(before.id)
                 # create a private channel for user if does not exist
-                if self.userList[after.id].privateChannelId == None:
+                if state.add_user(after.id).privateChannelId == None:
                     await self.create_private_channel(after)
-                # check if user is a tutor, if so mark unbusy
-                if tutorRole in after.roles:
-                    self.tutorManager.set_unbusy(after.id)
+                # check if user is a tutor, if so mark unbusy unless they are still helping someone
+                if isTutor and state.tutorManager.set_unbusy(after.id):
+                    state.matcher.notify()
+
+    # keep the cached name lookups in step with the guild's roles and channels
+    @handler_timer('on_guild_role_create')
+    async def on_guild_role_create(self, role):
+        self.guildCache.invalidate_roles(role.guild)
+
+    @handler_timer('on_guild_role_delete')
+    async def on_guild_role_delete(self, role):
+        self.guildCache.invalidate_roles(role.guild)
+        # members lose a deleted role without member updates
+        if role.name in tutorRoleNames:
+            self.build_tutor_index(role.guild)
+
+    @handler_timer('on_guild_role_update')
+    async def on_guild_role_update(self, before, after):
+        # only renames affect the name lookups
+        if before.name != after.name:
+            self.guildCache.invalidate_roles(after.guild)
+            if before.name in tutorRoleNames or after.name in tutorRoleNames:
+                self.build_tutor_index(after.guild)
+
+    @handler_timer('on_guild_channel_create')
+    async def on_guild_channel_create(self, channel):
+        self.guildCache.add_channel(channel)
+
+    @handler_timer('on_guild_channel_delete')
+    async def on_guild_channel_delete(self, channel):
+        self.guildCache.remove_channel(channel)
+        self.channelPool.discard(channel.id)
+
+    @handler_timer('on_guild_channel_update')
+    async def on_guild_channel_update(self, before, after):
+        # topic and permission edits of private channels are frequent, only renames affect the name lookups
+        if before.name != after.name:
+            self.guildCache.invalidate_channels(after.guild)
+
+    @handler_timer('on_guild_join')
+    async def on_guild_join(self, guild):
+        self.setup_guild(guild)
+
+    @handler_timer('on_guild_remove')
+    async def on_guild_remove(self, guild):
+        self.guildCache.invalidate_guild(guild)
+        # the guild's rows stay in the store in case the bot is added back
+        state = self.guildStates.pop(guild.id, None)
+        if state != None:
+            state.close()
 
     async def close(self):
-        # first reset all assigned tutors
-        for key in self.userList.keys():
-            self.userList[key].assignedTutors = list()
-        # also reset all tutors to not busy
-        self.tutorManager.reset_all()
-        # store the user list into persistent memory
-        userListFile = open(self.userListFilePath, 'wb')
-        pickle.dump(self.userList, userListFile)
-        userListFile.close()
-        # store the tutor manager into memory as well
-        tutorManagerFile = open(self.tutorManagerFilePath, 'wb')
-        self.tutorManager = pickle.dump(self.tutorManager, tutorManagerFile)
-        tutorManagerFile.close()
+        if self.closed:
+            return
+        self.closed = True
+        # stop every background task first, so none of them writes to the store after it is closed
+        if self.verificationTask != None:
+            self.verificationTask.cancel()
+        self.loopLag.stop()
+        if self.metricsServer != None:
+            self.metricsServer.stop()
+        self.snapshotter.stop()
+        if self.traceRecorder != None:
+            self.traceRecorder.close()
+        self.officeHours.stop()
+        self.pruner.stop()
+        self.reconciler.stop()
+        self.channelPool.stop()
+        self.api.stop()
+        for state in self.guildStates.values():
+            state.stop()
+        # let the cancelled tasks unwind before their last changes are written
+        await asyncio.sleep(0)
+        for state in self.guildStates.values():
+            state.close()
+        self.store.close()
         # close connection to discord
         await super().close()
 
     async def create_private_channel(self, member):
+        # only one private channel is created per user at a time
+        state = self.guild_state(member.guild)
+        if member.id in state.creatingChannels:
+            return
+        state.creatingChannels.add(member.id)
+        try:
+            await self.setup_private_channel(state, member)
+        finally:
+            state.creatingChannels.discard(member.id)
+
+    async def setup_private_channel(self, state, member):
         server = member.guild
-        # create text channel overwrites to make the channel inaccessible to all users except for the joined user
-        permissions = {
-                server.default_role: discord.PermissionOverwrite(read_messages=False),
-                member: discord.PermissionOverwrite(read_messages=True)
-        }
+        state.add_user(member.id)
+        pooled = self.channelPool.acquire(server)
+        if pooled != None:
+            # bind a channel from the pool to the member, its instructions and help message are already posted
+            newChannel, helpMessageId = pooled
+            state.bind_private_channel(member.id, newChannel.id, helpMessageId)
+            state.save_user(member.id)
+            await self.set_channel_permissions(newChannel, member, api_scheduler.PRIORITY_USER, read_messages=True)
+            await self.api.call('edit_channel:%s' % (newChannel.id), newChannel.edit, topic="%s" % (member.id), priority=api_scheduler.PRIORITY_NORMAL)
+            await self.send_channel_welcome(newChannel, member, api_scheduler.PRIORITY_NORMAL)
+            return
         # create a new channel that only the new joined user can access 
         privChannelDescription = "%s" % (member.id)
-        privChannelCategory = discord.utils.get(server.categories, name='Your Private Channels')
-        newChannel = await server.create_text_channel("Your Private Channel", overwrites=None, category=privChannelCategory, topic=privChannelDescription)
-        await newChannel.set_permissions(member, read_messages=True)
-        await newChannel.set_permissions(server.default_role, read_messages=False)
+        privChannelCategory = self.guildCache.category(server, 'Your Private Channels')
+        newChannel = await self.api.call('create_channel:%s' % (server.id), server.create_text_channel, "Your Private Channel",
+                                         overwrites=None, category=privChannelCategory, topic=privChannelDescription,
+                                         priority=api_scheduler.PRIORITY_HOUSEKEEPING)
+        # make the channel inaccessible to all users except for the joined user
+        await self.set_channel_permissions(newChannel, member, api_scheduler.PRIORITY_HOUSEKEEPING, read_messages=True)
+        await self.set_channel_permissions(newChannel, server.default_role, api_scheduler.PRIORITY_HOUSEKEEPING, read_messages=False)
         # send a welcome message
-        await newChannel.send(('Welcome, {user}, to your very own private channel on Oracle Tutoring! ' +
-                              'Here you can access all of our educational resources with complete anonymity. '+
-                              'If this is your first time on our server, please respond to the email verification to be able to use our services.' +
-                              'Read the instructions below to ask a tutor to join this channel and help you.').format(user=member.mention))
-        await newChannel.send('On the message below you can select the specific curricular subject that would like help with. ' +
-                              'To invite a tutor that specializes in a subject, click on the corresponding button for that subject.')
+        await self.send_channel_welcome(newChannel, member, api_scheduler.PRIORITY_HOUSEKEEPING)
         # store the channel id internally
-        self.userList[member.id].privateChannelId = newChannel.id
-        # send emoji reaction message
-        helpMessageId = await self.send_help_message(newChannel)
-        self.userList[member.id].helpMessageId = helpMessageId
+        state.bind_private_channel(member.id, newChannel.id)
+        state.save_user(member.id)
+        # send instructions and emoji reaction message
+        helpMessageId = await self.send_channel_instructions(newChannel)
+        state.set_help_message(member.id, helpMessageId)
+        state.save_user(member.id)
+
+    async def build_pool_channel(self, server):
+        # builds an unbound private channel for the channel pool, returns (channel id, help message id)
+        privChannelCategory = self.guildCache.category(server, 'Your Private Channels')
+        newChannel = await self.api.call('create_channel:%s' % (server.id), server.create_text_channel, "Your Private Channel",
+                                         overwrites=None, category=privChannelCategory, topic=channel_pool.POOL_TOPIC,
+                                         priority=api_scheduler.PRIORITY_HOUSEKEEPING)
+        await self.set_channel_permissions(newChannel, server.default_role, api_scheduler.PRIORITY_HOUSEKEEPING, read_messages=False)
+        helpMessageId = await self.send_channel_instructions(newChannel)
+        return newChannel.id, helpMessageId
+
+    async def send_channel_welcome(self, channel, member, priority):
+        await self.send_message(channel, ('Welcome, {user}, to your very own private channel on Oracle Tutoring! ' +
+                                         'Here you can access all of our educational resources with complete anonymity. '+
+                                         'If this is your first time on our server, please respond to the email verification to be able to use our services.' +
+                                         'Read the instructions below to ask a tutor to join this channel and help you.').format(user=member.mention),
+                                priority)
+
+    async def send_channel_instructions(self, channel):
+        await self.send_message(channel, 'On the message below you can select the specific curricular subject that would like help with. ' +
+                                         'To invite a tutor that specializes in a subject, click on the corresponding button for that subject.',
+                                api_scheduler.PRIORITY_HOUSEKEEPING)
+        return await self.send_help_message(channel)
 
     async def send_help_message(self, channel):
-        helpMessage = await channel.send(('Math:                           {math}\n' +
-                                          'Computer Science:   {cs}\n' +
-                                          'Physics:                       {physics}\n' +
-                                          'Chemistry:                  {chem}\n' +
-                                          'Biology:                        {bio}\n' +
-                                          'Essay Help:                 {engessay}\n' +
-                                          'French:                        {french}\n' +
-                                          'Other:                          {other}\n'
-                                         ).format(**subjectEmojis))
-        # react with the subject emojis for easy access to user
-        for key, value in subjectEmojis.items():
-            try:
-                await helpMessage.add_reaction(value)
-            except:
+        helpMessage = await self.send_message(channel, ('Math:                           {math}\n' +
+                                                        'Computer Science:   {cs}\n' +
+                                                        'Physics:                       {physics}\n' +
+                                                        'Chemistry:                  {chem}\n' +
+                                                        'Biology:                        {bio}\n' +
+                                                        'Essay Help:                 {engessay}\n' +
+                                                        'French:                        {french}\n' +
+                                                        'Other:                          {other}\n'
+                                                       ).format(**subjectEmojis), api_scheduler.PRIORITY_HOUSEKEEPING)
+        # react with the subject emojis for easy access to user, the scheduler paces the reactions
+        reactions = [self.api.submit('reaction:%s' % (channel.id), helpMessage.add_reaction, value, priority=api_scheduler.PRIORITY_HOUSEKEEPING)
+                     for value in subjectEmojis.values()]
+        results = await asyncio.gather(*reactions, return_exceptions=True)
+        for key, result in zip(subjectEmojis.keys(), results):
+            if isinstance(result, Exception):
                 logging.error (textColour+"error adding %s emoji" % (key))
         # pin the message for future reference
-        await helpMessage.pin()
+        await self.api.call('pin:%s' % (channel.id), helpMessage.pin, priority=api_scheduler.PRIORITY_HOUSEKEEPING)
         return helpMessage.id
 
-    async def user_timeout(self, timeout, channel, userId):
-        while self.loop.time() < timeout:
-            await asyncio.sleep(5*MINUTE)
-        # delete reference to the task
-        del self.userTimeoutList[userId]
-        await self.delete_user_channel(channel, userId)
+    async def expire_user_channel(self, state, userId):
+        # called by the guild's timeout scheduler once an offline user's timeout has passed
+        guild = self.get_guild(state.guildId)
+        member = None if guild == None else guild.get_member(userId)
+        if member != None and member.status != discord.Status.offline:
+            # the user came back without the timeout being cancelled
+            return
+        userPrivChannelId = state.userList[userId].privateChannelId
+        if userPrivChannelId == None:
+            return
+        userPrivChannel = self.get_channel(userPrivChannelId)
+        if userPrivChannel == None:
+            # the channel was already removed, only clear the stale reference
+            state.clear_private_channel(userId)
+            state.save_user(userId)
+            return
+        await self.pruner.delete(userPrivChannel, userId)
 
     async def delete_user_channel(self, channel, userId):
-        await channel.delete()
-        # delete reference to the privateChannelId
-        self.userList[userId].privateChannelId = None
+        await self.api.call('delete_channel:%s' % (channel.guild.id), channel.delete, priority=api_scheduler.PRIORITY_HOUSEKEEPING)
+        state = self.guild_state(channel.guild)
+        state.userTimeouts.cancel(userId)
+        # delete reference to the privateChannelId and its help message
+        state.clear_private_channel(userId)
         logging.debug (textColour+"deleted private channel for user %s" % (userId))
+        # the user can no longer be helped in the deleted channel so take them out of the queue
+        state.tutorManager.remove_from_queue(userId)
         # clear all tutors assigned to deleted channel
-        for tutorId in self.userList[userId].assignedTutors:
-            self.tutorManager.mark_done(tutorId)
-        self.userList[userId].assignedTutors = list()
+        for tutorId in state.userList[userId].assignedTutors:
+            state.tutorManager.mark_done(tutorId)
+            state.save_tutor(tutorId)
+        state.userList[userId].assignedTutors = ()
+        state.save_user(userId)
+        state.matcher.notify()
 
     async def set_user_timeout(self, user):
+        state = self.guild_state(user.guild)
         # return if user already has a set timeout
-        if self.userTimeoutList.get(user.id) != None:
+        if user.id in state.userTimeouts:
             return
-        # set user timeout
-        timeout_time = self.loop.time() + self.timeoutDuration
-        # store the task if necessary to cancel in future
-        userPrivChannelId = self.userList[user.id].privateChannelId
         # check if the private channel id is valid
-        if userPrivChannelId == None:
+        if state.add_user(user.id).privateChannelId == None:
             return
-        userPrivChannel = user.guild.get_channel(userPrivChannelId)
-        # schedule the task to be run
-        self.userTimeoutList[user.id] = self.loop.create_task(self.user_timeout(timeout_time, userPrivChannel, user.id))
+        # schedule the channel to be deleted once the timeout passes
+        state.userTimeouts.schedule_in(user.id, self.timeoutDuration)
 
+    @metrics.timed('tutorbot_assign_tutor_seconds', 'Seconds spent handling tutor requests, including the replies.')
     async def assign_tutor(self, userId, channel, subject):
         # check for office hours
         if not self.is_office_hours():
-            await channel.send("Sorry, but we are not currently open. Please contact us during our office hours.")
+            await self.send_message(channel, "Sorry, but we are not currently open. Please contact us during our office hours.")
             return
+        state = self.guild_state(channel.guild)
         # check if the user already has a tutor
-        if self.userList[userId].assignedTutors:
-            await channel.send("You already have an assigned Tutor!")
+        if state.userList[userId].assignedTutors:
+            await self.send_message(channel, "You already have an assigned Tutor!")
+            return
+        # check if the user is already waiting in the queue
+        queuePosition = state.tutorManager.queue_position(userId)
+        if queuePosition != None:
+            await self.send_message(channel, "You are already in our queue! You are currently number %s in line." % (queuePosition))
             return
-        assignedTutor = self.tutorManager.request_tutor(subject)
+        requestedAt = self.loop.time()
+        assignedTutor = state.matcher.request(userId, channel, subject, self.doQueue)
         # check if there are available tutors
         if assignedTutor == None:
             # see if doing queue system
             if self.doQueue:
-                # add user to queue and display queue message
-                self.tutorManager.add_to_queue(userId, channel, subject)
-                await channel.send("Unfortunately, we do not have an available tutor at this time. Don't worry though, you've been added to our queue!")
+                # the user was added to the queue, display queue message
+                queuePosition = state.tutorManager.queue_position(userId)
+                await self.send_message(channel, "Unfortunately, we do not have an available tutor at this time. Don't worry though, you've been added to our queue! You are currently number %s in line." % (queuePosition))
             else:
-                await channel.send("Sorry, we are unable to help you with this subject because all tutors are busy at this time. Please try requesting a tutor again in 1 or 2 minutes. Thank you for your patience!")
+                await self.send_message(channel, "Sorry, we are unable to help you with this subject because all tutors are busy at this time. Please try requesting a tutor again in 1 or 2 minutes. Thank you for your patience!")
             return
-        assignedTutor = self.get_user(assignedTutor.id)
+        await self.announce_tutor(userId, channel, subject, assignedTutor.id, requestedAt)
+
+    async def announce_tutor(self, userId, channel, subject, tutorId, requestedAt):
+        # lets the assigned tutor into the channel, the assignment itself was already made by the matcher
+        assignedTutor = self.get_user(tutorId)
         tutorRequestee = self.get_user(userId)
-        # assign tutor to user
-        self.userList[userId].assignedTutors.append(assignedTutor.id)
-        await channel.set_permissions(assignedTutor, read_messages=True)
-        await channel.send("Hi %s, you have been assigned to work with %s on %s!" % (assignedTutor.mention, tutorRequestee.mention, subjectRoleNames[subjects.index(subject)]) )
-        print(subject)
+        await self.set_channel_permissions(channel, assignedTutor, read_messages=True)
+        await self.send_message(channel, "Hi %s, you have been assigned to work with %s on %s!" % (assignedTutor.mention, tutorRequestee.mention, subjectRoleNames[subjects.index(subject)]) )
+        self.guild_state(channel.guild).matcher.timeToMatch.observe(self.loop.time() - requestedAt)
+        logging.debug (textColour+"assigned tutor %s to user %s for %s" % (tutorId, userId, subject))
+
+    async def send_message(self, channel, content, priority=api_scheduler.PRIORITY_USER):
+        return await self.api.call('send:%s' % (channel.id), channel.send, content, priority=priority)
+
+    async def set_channel_permissions(self, channel, target, priority=api_scheduler.PRIORITY_USER, **permissions):
+        return await self.api.call('permissions:%s' % (channel.id), channel.set_permissions, target, priority=priority, **permissions)
 
     async def give_user_role(self, member, roleName):
-        role = discord.utils.get(member.guild.roles, name=roleName)
+        role = self.guildCache.role(member.guild, roleName)
         if role == None:
             logging.error('%s is not a valid role name!' % (roleName) )
         else:
             try:
-                await member.add_roles(role)
+                await self.api.call('role:%s' % (member.guild.id), member.add_roles, role)
             except:
                 logging.error("could not give role %s to user %s" %(roleName, member.display_name) )
 
-    async def update_tutor(self, tutor):
-        # copy existing data of tutor
-        newTutor = self.tutorManager.get_tutor_by_id(tutor.id)
+    def subject_role_ids(self, guild):
+        # dict storing role id->subject of the guild's subject tutor roles
+        subjectRoleIds = dict()
+        for i in range(len(subjects)):
+            subjectRole = self.guildCache.role(guild, '%s Tutor' % (subjectRoleNames[i]))
+            if subjectRole != None:
+                subjectRoleIds[subjectRole.id] = subjects[i]
+        return subjectRoleIds
+
+    def expected_tutor_subjects(self, member):
+        # returns the subjects the member tutors according to their roles, or None if they are not a tutor
+        tutorRole = self.guildCache.role(member.guild, 'Oracle Tutor')
+        if tutorRole == None or tutorRole not in member.roles:
+            return None
+        subjectRoleIds = self.subject_role_ids(member.guild)
+        memberSubjects = set()
+        for role in member.roles:
+            if role.id in subjectRoleIds:
+                memberSubjects.add(subjectRoleIds[role.id])
+        return [subject for subject in subjects if subject in memberSubjects]
+
+    def update_tutor(self, member):
+        # brings the member's entry in the TutorManager in line with their roles, returns whether it changed
+        state = self.guild_state(member.guild)
+        tutorSubjects = self.expected_tutor_subjects(member)
+        tutor = state.tutorManager.get_tutor_by_id(member.id)
+        if tutorSubjects == None:
+            # former tutors keep their record, so assignments in progress can still be finished, but leave every subject
+            if tutor == None or not tutor.subjects:
+                return False
+            tutorSubjects = list()
+        elif tutor != None and tutor.subjects == tutorSubjects:
+            return False
         # if tutor does not exist then initialize the tutor
-        if newTutor == None:
-            newTutor = Tutor()
-            newTutor.id = tutor.id
+        isNew = tutor == None
+        if isNew:
+            tutor = Tutor()
+            tutor.id = member.id
         # overwrite existing subject subscriptions for tutor
-        newTutor.subjects = list()
-        for i in range(len(subjects)):
-            subjectRole = discord.utils.get(tutor.guild.roles, name='%s Tutor' % (subjectRoleNames[i]))
-            if subjectRole in tutor.roles:
-                newTutor.subjects.append(subjects[i])
+        tutor.subjects = tutorSubjects
         # add tutor to TutorManager
-        self.tutorManager.add_tutor(newTutor)
+        state.tutorManager.add_tutor(tutor)
+        # offline tutors are not available
+        if isNew and member.status == discord.Status.offline:
+            state.tutorManager.set_busy(tutor.id)
+        state.save_tutor(tutor.id)
+        state.matcher.notify()
+        return True
+
+    def build_tutor_index(self, guild):
+        # checks every tutor of the guild against their roles and fixes drift, returns the ids of the tutors that had drifted
+        state = self.guild_state(guild)
+        drifted = list()
+        checked = set()
+        tutorRole = self.guildCache.role(guild, 'Oracle Tutor')
+        if tutorRole != None:
+            for member in tutorRole.members:
+                checked.add(member.id)
+                if self.update_tutor(member):
+                    drifted.append(member.id)
+                # offline tutors are not available
+                if member.status == discord.Status.offline and not state.tutorManager.is_offline(member.id):
+                    state.tutorManager.set_busy(member.id)
+        # tutors who lost the tutor role or left the guild
+        for tutor in list(state.tutorManager.tutorList.values()):
+            if tutor.id in checked or not tutor.subjects:
+                continue
+            member = guild.get_member(tutor.id)
+            if member != None:
+                if self.update_tutor(member):
+                    drifted.append(tutor.id)
+            else:
+                tutor.subjects = list()
+                state.tutorManager.add_tutor(tutor)
+                state.save_tutor(tutor.id)
+                drifted.append(tutor.id)
+        return drifted
+
+    def collect_metrics(self):
+        # metrics read at scrape time, see metrics.Registry
+        samples = list()
+        for guildId, state in self.guildStates.items():
+            for subject in subjects:
+                samples.append(('tutorbot_queue_depth', 'gauge', 'Students waiting for a tutor.', {'guild': guildId, 'subject': subject},
+                                state.tutorManager.queue_length(subject)))
+                if subject in state.matcher.subjectQueueWait:
+                    samples.append(('tutorbot_queue_wait_seconds', 'histogram', 'Seconds matched students spent in the queue.',
+                                    {'guild': guildId, 'subject': subject}, state.matcher.subjectQueueWait[subject]))
+            helping, idle, unavailable = state.tutor_counts()
+            for tutorState, count in (('helping', helping), ('idle', idle), ('unavailable', unavailable)):
+                samples.append(('tutorbot_tutors', 'gauge', 'Tutors by state.', {'guild': guildId, 'state': tutorState}, count))
+            samples.append(('tutorbot_tutor_utilization', 'gauge', 'Share of available tutors helping a student.', {'guild': guildId},
+                            helping / (helping + idle) if helping + idle else 0.0))
+            userStats = state.userList.stats()
+            samples.append(('tutorbot_users_in_memory', 'gauge', 'Users kept in memory.', {'guild': guildId}, userStats['resident'] + userStats['helping']))
+            samples.append(('tutorbot_user_loads_total', 'counter', 'Users read from the state store.', {'guild': guildId}, userStats['loads']))
+            samples.append(('tutorbot_user_evictions_total', 'counter', 'Users dropped from memory to make room.', {'guild': guildId}, userStats['evictions']))
+            samples.append(('tutorbot_user_writes_total', 'counter', 'Changed users written to the state store.', {'guild': guildId}, userStats['written']))
+        for kind, histogram in self.api.routeLatency.items():
+            samples.append(('tutorbot_api_call_seconds', 'histogram', 'Seconds of outbound discord api calls.', {'route': kind}, histogram))
+        for kind, hits in self.api.routeRateLimitHits.items():
+            samples.append(('tutorbot_api_rate_limited_total', 'counter', 'Outbound calls answered with 429.', {'route': kind}, hits))
+        samples.append(('tutorbot_api_queued', 'gauge', 'Outbound calls waiting for their rate limit.', {}, self.api.queued()))
+        samples.append(('tutorbot_snapshot_bytes', 'gauge', 'Size of the last snapshot of the state store.', {}, self.snapshotter.lastSize))
+        samples.append(('tutorbot_snapshot_failures_total', 'counter', 'Snapshots that could not be written.', {}, self.snapshotter.failures))
+        if self.snapshotter.age() != None:
+            samples.append(('tutorbot_snapshot_age_seconds', 'gauge', 'Seconds since the last snapshot of the state store.', {}, self.snapshotter.age()))
+        for name, commandStats in self.commandRouter.stats().items():
+            samples.append(('tutorbot_commands_total', 'counter', 'Commands run.', {'command': name}, commandStats['invocations']))
+            samples.append(('tutorbot_command_seconds', 'histogram', 'Seconds commands took to run.', {'command': name}, commandStats['latency']))
+        cacheStats = self.guildCache.stats()
+        for kind in sorted(cacheStats['hits']):
+            samples.append(('tutorbot_guild_cache_hits_total', 'counter', 'Role and channel lookups by name answered from a cached table.', {'kind': kind},
+                            cacheStats['hits'][kind]))
+            samples.append(('tutorbot_guild_cache_misses_total', 'counter', 'Role and channel lookups by name that built their table first.', {'kind': kind},
+                            cacheStats['misses'][kind]))
+        return samples
+
+    def describe_stats(self, guild):
+        # handlers, the api and the event loop are shared by the guilds of the process, the queue and tutors are the guild's own
+        state = self.guild_state(guild)
+        lines = list()
+        handlers = sorted((labels, histogram) for (name, labels), histogram in self.metrics.histograms.items() if name == 'tutorbot_handler_seconds')
+        lines.append('Handlers p95: ' + ', '.join('%s %.0f ms' % (dict(labels)['event'], histogram.quantile(0.95) * 1000)
+                                                 for labels, histogram in handlers if histogram.count))
+        queued = ['%s %s' % (subject, state.tutorManager.queue_length(subject)) for subject in subjects if state.tutorManager.queue_length(subject)]
+        lines.append('Queue: %s, wait p95 %.1f s, time to match p95 %.1f s' % (', '.join(queued) or 'empty', state.matcher.queueWait.quantile(0.95),
+                                                                              state.matcher.timeToMatch.quantile(0.95)))
+        helping, idle, unavailable = state.tutor_counts()
+        lines.append('Tutors: %s helping, %s idle, %s unavailable' % (helping, idle, unavailable))
+        userStats = state.userList.stats()
+        lines.append('Users: %s of %s in memory, %s loaded, %s evicted' % (userStats['resident'] + userStats['helping'], userStats['capacity'],
+                                                                           userStats['loads'], userStats['evictions']))
+        cacheStats = self.guildCache.stats()
+        lines.append('Name lookups: %s cached, %s rebuilt their table' % (sum(cacheStats['hits'].values()), sum(cacheStats['misses'].values())))
+        apiStats = self.api.stats()
+        lines.append('API: %s calls, %s rate limited, %s queued, average latency %.0f ms' % (sum(apiStats['calls'].values()), apiStats['rateLimitHits'],
+                                                                                           apiStats['queued'], apiStats['averageLatencyMs']))
+        if self.snapshotter.age() != None:
+            lines.append('Snapshots: %s taken, the last one %.1f MB in %.2f s, %.0f minutes ago' % (self.snapshotter.taken, self.snapshotter.lastSize / 1e6,
+                                                                                             self.snapshotter.lastDuration, self.snapshotter.age() / MINUTE))
+        lines.append('Event loop lag p99: %.1f ms, %s guilds in this process' % (self.loopLag.lag.quantile(0.99) * 1000, len(self.guildStates)))
+        return '\n'.join(lines)
 
     def is_office_hours(self):
         # returns whether it is office hours or not
-        isOfficeHours = False
-        for period in self.officeHours:
-            isOfficeHours = isOfficeHours or (period[0] <= datetime.now().time() <= period[1])
-        return isOfficeHours
+        return self.officeHours.is_open()
+
+    async def office_hours_changed(self, isOpen):
+        if isOpen:
+            # serve the requests queued while we were closed
+            for state in self.guildStates.values():
+                state.matcher.notify()
+            return
+        # let queued users know they keep their place until we open again
+        closingMessage = "We are closing for now. You keep your place in our queue and will be matched with a tutor once we open again."
+        nextOpening = self.officeHours.next_transition()
+        if nextOpening != math.inf:
+            openingTime = datetime.fromtimestamp(nextOpening, self.officeHours.timezone)
+            closingMessage = closingMessage[:-1] + " at %s." % (openingTime.strftime('%A %H:%M %Z'))
+        for state in self.guildStates.values():
+            for entry in list(state.tutorManager.queuedUsers.values()):
+                self.api.post('send:%s' % (entry.channel.id), entry.channel.send, closingMessage, priority=api_scheduler.PRIORITY_NORMAL)
 
     async def send_verification(self, user):
         if not user.dm_channel:
-            await user.create_dm()
-        await user.dm_channel.send("Hello! This is OracleBot from the OSN server! To get started, tell me your email address.")
-
-    def dump_emails(self):
-        emailDumpFile = open('emails', 'w+')
-        for user in self.userList.values():
-            if user.email:
-                emailDumpFile.write(user.email)
\ No newline at end of file
+            await self.api.call('dm:%s' % (user.id), user.create_dm)
+        await self.send_message(user.dm_channel, "Hello! This is OracleBot from the OSN server! To get started, tell me your email address.", api_scheduler.PRIORITY_NORMAL)
+
+    async def dump_emails(self, guild, exportFormat='csv', incremental=False):
+        # streams the emails of the guild from the state store to a file in a worker thread, returns (emails written, file path)
+        since = self.store.load_export_mark(guild.id, exportFormat) if incremental else None
+        # the export reads the store, write the latest changes first
+        self.guild_state(guild).userList.flush()
+        filePath = 'emails-%s.%s' % (guild.id, exportFormat)
+        if incremental:
+            filePath = 'emails-%s-%s.%s' % (guild.id, datetime.now().strftime('%Y%m%d-%H%M%S'), exportFormat)
+        written, changedUntil = await self.loop.run_in_executor(None, email_export.export_emails, self.store.path, filePath, guild.id, exportFormat, since)
+        if changedUntil != None:
+            self.store.put_export_mark(guild.id, exportFormat, changedUntil)
+        return written, filePath
+
+
+class ShardedTutorBot(TutorBot, discord.AutoShardedClient):
+    # runs several shards over one connection pool, pass shard_ids and shard_count to serve a slice of the shards
+    pass
@@ -0,0 +1,291 @@
+import sqlite3
+
+import email_export
+
+# version of the stored data, kept in the database's user_version
+# 1: subscribed_subjects bits follow tutor_bot.subjects
+# 2: users, tutors, deadlines and export marks belong to a guild
+# 3: users hold the key of their email, see email_export.email_key
+SCHEMA_VERSION = 3
+
+# guild id of the rows of stores written while the bot served a single guild, until a guild claims them
+UNASSIGNED_GUILD = 0
+
+
+class StateStore:
+    # persists users and tutors in a sqlite database in WAL mode, one row per record so each change is written on its own or in a small batch.
+    # every process serving a slice of the guilds opens the same store and only writes the rows of its own guilds
+
+    def __init__(self, path):
+        self.path = path
+        # autocommit mode, every statement outside of an explicit transaction is committed immediately.
+        # writers of other processes hold the lock briefly, so wait for it rather than failing
+        self.connection = sqlite3.connect(path, isolation_level=None, timeout=30.0)
+        # once closed every statement raises sqlite3.ProgrammingError: Cannot operate on a closed database
+        self.closed = False
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # with WAL, NORMAL only syncs at checkpoints, committed rows still survive a crash of the bot
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.create_tables()
+
+    def create_tables(self):
+        self.create_guild_table('users', 'CREATE TABLE IF NOT EXISTS users ('
+                                'guild_id INTEGER NOT NULL, '
+                                'id INTEGER NOT NULL, '
+                                'subscribed_subjects INTEGER NOT NULL DEFAULT 0, '
+                                'help_message_id INTEGER, '
+                                'private_channel_id INTEGER, '
+                                'email TEXT, '
+                                'email_changed_at REAL, '
+                                'email_key BLOB, '
+                                'PRIMARY KEY (guild_id, id))')
+        self.add_column('users', 'email_key', 'BLOB')
+        # users are looked up by email here, private channels and help messages are indexed in memory
+        self.connection.execute('DROP INDEX IF EXISTS users_private_channel')
+        self.connection.execute('DROP INDEX IF EXISTS users_help_message')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS users_email_key ON users (guild_id, email_key)')
+        # and by id across guilds, for dms which are not sent from any guild
+        self.connection.execute('CREATE INDEX IF NOT EXISTS users_id ON users (id)')
+        self.create_guild_table('tutors', 'CREATE TABLE IF NOT EXISTS tutors ('
+                                'guild_id INTEGER NOT NULL, '
+                                'id INTEGER NOT NULL, '
+                                'questions_answered INTEGER NOT NULL DEFAULT 0, '
+                                'subjects TEXT NOT NULL DEFAULT \'\', '
+                                'last_question REAL, '
+                                'PRIMARY KEY (guild_id, id))')
+        self.create_guild_table('deadlines', 'CREATE TABLE IF NOT EXISTS deadlines ('
+                                'guild_id INTEGER NOT NULL, '
+                                'key INTEGER NOT NULL, '
+                                'deadline REAL NOT NULL, '
+                                'PRIMARY KEY (guild_id, key))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS channel_pool ('
+                                'channel_id INTEGER PRIMARY KEY, '
+                                'guild_id INTEGER NOT NULL, '
+                                'help_message_id INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS prune_jobs ('
+                                'guild_id INTEGER PRIMARY KEY, '
+                                'report_channel_id INTEGER, '
+                                'total INTEGER NOT NULL, '
+                                'without_tutor INTEGER NOT NULL DEFAULT 0)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS prune_channels ('
+                                'channel_id INTEGER PRIMARY KEY, '
+                                'guild_id INTEGER NOT NULL, '
+                                'user_id INTEGER NOT NULL)')
+        self.create_guild_table('email_exports', 'CREATE TABLE IF NOT EXISTS email_exports ('
+                                'guild_id INTEGER NOT NULL, '
+                                'format TEXT NOT NULL, '
+                                'changed_until REAL, '
+                                'PRIMARY KEY (guild_id, format))')
+        # emails verified through a dm, discord sends every dm to one process so the others read them from here
+        self.connection.execute('CREATE TABLE IF NOT EXISTS email_verifications ('
+                                'user_id INTEGER PRIMARY KEY, '
+                                'email TEXT NOT NULL, '
+                                'verified_at REAL NOT NULL)')
+
+    def table_columns(self, table):
+        return [column[1] for column in self.connection.execute('PRAGMA table_info(%s)' % (table))]
+
+    def create_guild_table(self, table, createStatement):
+        # tables written while the bot served a single guild have no guild_id, they are rebuilt with their rows in
+        # UNASSIGNED_GUILD. columns the old table did not have yet are left empty
+        if 'guild_id' in self.table_columns(table):
+            return
+        with self.transaction(immediate=True):
+            oldColumns = self.table_columns(table)
+            if 'guild_id' in oldColumns:
+                # another process rebuilt it first
+                return
+            if not oldColumns:
+                self.connection.execute(createStatement)
+                return
+            self.connection.execute('ALTER TABLE %s RENAME TO %s_single_guild' % (table, table))
+            self.connection.execute(createStatement)
+            columns = ', '.join(column for column in oldColumns if column in self.table_columns(table))
+            self.connection.execute('INSERT INTO %s (guild_id, %s) SELECT %d, %s FROM %s_single_guild' % (table, columns, UNASSIGNED_GUILD, columns, table))
+            self.connection.execute('DROP TABLE %s_single_guild' % (table))
+
+    def add_column(self, table, column, columnType):
+        # columns added after the table was created are empty in the old rows
+        if column in self.table_columns(table):
+            return
+        with self.transaction(immediate=True):
+            if column not in self.table_columns(table):
+                self.connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, columnType))
+
+    def is_empty(self):
+        for table in ('users', 'tutors'):
+            if self.connection.execute('SELECT 1 FROM %s LIMIT 1' % (table)).fetchone() != None:
+                return False
+        return True
+
+    def schema_version(self):
+        return self.connection.execute('PRAGMA user_version').fetchone()[0]
+
+    def set_schema_version(self, version):
+        self.connection.execute('PRAGMA user_version = %d' % (version))
+
+    def claim_unassigned(self, guildId):
+        # moves the rows of UNASSIGNED_GUILD to the guild, returns the number of users claimed.
+        # rows the guild already has are kept and the unassigned ones left behind
+        with self.transaction(immediate=True):
+            claimed = self.connection.execute('UPDATE OR IGNORE users SET guild_id = ? WHERE guild_id = ?', (guildId, UNASSIGNED_GUILD)).rowcount
+            for table in ('tutors', 'deadlines', 'email_exports'):
+                self.connection.execute('UPDATE OR IGNORE %s SET guild_id = ? WHERE guild_id = ?' % (table), (guildId, UNASSIGNED_GUILD))
+        return claimed
+
+    def user_values(self, guildId, row):
+        # row is (id, subscribed_subjects, help_message_id, private_channel_id, email, email_changed_at)
+        return (guildId,) + tuple(row) + (email_export.email_key(row[4]) if row[4] else None,)
+
+    def put_user(self, guildId, row):
+        self.connection.execute('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)', self.user_values(guildId, row))
+
+    def put_users(self, guildId, rows):
+        # writes many users of the guild in a single transaction
+        with self.transaction():
+            self.connection.executemany('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (self.user_values(guildId, row) for row in rows))
+
+    def fill_email_keys(self):
+        # keys the emails of users stored before schema version 3, returns the number of users keyed
+        rows = self.connection.execute('SELECT guild_id, id, email FROM users WHERE email_key IS NULL AND email IS NOT NULL AND email != \'\'').fetchall()
+        with self.transaction():
+            self.connection.executemany('UPDATE users SET email_key = ? WHERE guild_id = ? AND id = ?',
+                                        ((email_export.email_key(email), guildId, userId) for guildId, userId, email in rows))
+        return len(rows)
+
+    def delete_user(self, guildId, userId):
+        self.connection.execute('DELETE FROM users WHERE guild_id = ? AND id = ?', (guildId, userId))
+
+    def load_users(self, guildId):
+        return self.connection.execute('SELECT id, subscribed_subjects, help_message_id, private_channel_id, email, email_changed_at FROM users '
+                                       'WHERE guild_id = ?', (guildId,))
+
+    def load_user(self, guildId, userId):
+        return self.connection.execute('SELECT id, subscribed_subjects, help_message_id, private_channel_id, email, email_changed_at FROM users '
+                                       'WHERE guild_id = ? AND id = ?', (guildId, userId)).fetchone()
+
+    def load_users_by_id(self, guildId, userIds):
+        # userIds has to stay within sqlite's limit of variables, 999 for older versions
+        return self.connection.execute('SELECT id, subscribed_subjects, help_message_id, private_channel_id, email, email_changed_at FROM users '
+                                       'WHERE guild_id = ? AND id IN (%s)' % (', '.join('?' * len(userIds))), (guildId,) + tuple(userIds)).fetchall()
+
+    def find_users(self, guildId, column, value):
+        # returns the ids of the users of the guild whose column holds value, column should be an indexed one such as email_key
+        return [row[0] for row in self.connection.execute('SELECT id FROM users WHERE guild_id = ? AND %s = ?' % (column), (guildId, value))]
+
+    def load_channel_links(self, guildId):
+        # returns (id, private_channel_id, help_message_id) of the users of the guild with a private channel or help message
+        return self.connection.execute('SELECT id, private_channel_id, help_message_id FROM users WHERE guild_id = ? AND '
+                                       '(private_channel_id IS NOT NULL OR help_message_id IS NOT NULL)', (guildId,)).fetchall()
+
+    def load_user_emails(self, userId):
+        # returns (guild_id, email) of the user in every guild of the store
+        return self.connection.execute('SELECT guild_id, email FROM users WHERE id = ? AND guild_id != ?', (userId, UNASSIGNED_GUILD)).fetchall()
+
+    def count_users(self, guildId):
+        return self.connection.execute('SELECT COUNT(*) FROM users WHERE guild_id = ?', (guildId,)).fetchone()[0]
+
+    def put_tutor(self, guildId, row):
+        # row is (id, questions_answered, subjects, last_question)
+        self.connection.execute('INSERT OR REPLACE INTO tutors VALUES (?, ?, ?, ?, ?)', (guildId,) + tuple(row))
+
+    def put_tutors(self, guildId, rows):
+        with self.transaction():
+            self.connection.executemany('INSERT OR REPLACE INTO tutors VALUES (?, ?, ?, ?, ?)', ((guildId,) + tuple(row) for row in rows))
+
+    def delete_tutor(self, guildId, tutorId):
+        self.connection.execute('DELETE FROM tutors WHERE guild_id = ? AND id = ?', (guildId, tutorId))
+
+    def load_tutors(self, guildId):
+        return self.connection.execute('SELECT id, questions_answered, subjects, last_question FROM tutors WHERE guild_id = ?', (guildId,))
+
+    def put_deadline(self, guildId, key, deadline):
+        self.connection.execute('INSERT OR REPLACE INTO deadlines VALUES (?, ?, ?)', (guildId, key, deadline))
+
+    def delete_deadline(self, guildId, key):
+        self.connection.execute('DELETE FROM deadlines WHERE guild_id = ? AND key = ?', (guildId, key))
+
+    def load_deadlines(self, guildId):
+        return self.connection.execute('SELECT key, deadline FROM deadlines WHERE guild_id = ?', (guildId,))
+
+    def put_pool_channel(self, channelId, guildId, helpMessageId):
+        self.connection.execute('INSERT OR REPLACE INTO channel_pool VALUES (?, ?, ?)', (channelId, guildId, helpMessageId))
+
+    def delete_pool_channel(self, channelId):
+        self.connection.execute('DELETE FROM channel_pool WHERE channel_id = ?', (channelId,))
+
+    def load_pool_channels(self, guildId):
+        return self.connection.execute('SELECT channel_id, help_message_id FROM channel_pool WHERE guild_id = ? ORDER BY rowid', (guildId,)).fetchall()
+
+    def put_prune_job(self, guildId, reportChannelId, withoutTutor, channels):
+        # channels is a list of (channel id, user id), a new job replaces what is left of the guild's previous one
+        with self.transaction():
+            self.connection.execute('DELETE FROM prune_channels WHERE guild_id = ?', (guildId,))
+            self.connection.execute('INSERT OR REPLACE INTO prune_jobs VALUES (?, ?, ?, ?)', (guildId, reportChannelId, len(channels), int(withoutTutor)))
+            self.connection.executemany('INSERT OR REPLACE INTO prune_channels VALUES (?, ?, ?)',
+                                        ((channelId, guildId, userId) for channelId, userId in channels))
+
+    def load_prune_job(self, guildId):
+        # returns (report channel id, total, without tutor) or None
+        return self.connection.execute('SELECT report_channel_id, total, without_tutor FROM prune_jobs WHERE guild_id = ?', (guildId,)).fetchone()
+
+    def load_prune_channels(self, guildId):
+        return self.connection.execute('SELECT channel_id, user_id FROM prune_channels WHERE guild_id = ? ORDER BY rowid', (guildId,)).fetchall()
+
+    def delete_prune_channel(self, channelId):
+        self.connection.execute('DELETE FROM prune_channels WHERE channel_id = ?', (channelId,))
+
+    def delete_prune_job(self, guildId):
+        with self.transaction():
+            self.connection.execute('DELETE FROM prune_channels WHERE guild_id = ?', (guildId,))
+            self.connection.execute('DELETE FROM prune_jobs WHERE guild_id = ?', (guildId,))
+
+    def load_export_mark(self, guildId, exportFormat):
+        # returns the latest email change covered by the guild's exports of the format, or None
+        row = self.connection.execute('SELECT changed_until FROM email_exports WHERE guild_id = ? AND format = ?', (guildId, exportFormat)).fetchone()
+        return None if row == None else row[0]
+
+    def put_export_mark(self, guildId, exportFormat, changedUntil):
+        self.connection.execute('INSERT OR REPLACE INTO email_exports VALUES (?, ?, ?)', (guildId, exportFormat, changedUntil))
+
+    def put_email_verification(self, userId, email, verifiedAt):
+        self.connection.execute('INSERT OR REPLACE INTO email_verifications VALUES (?, ?, ?)', (userId, email, verifiedAt))
+
+    def load_email_verifications(self, since):
+        # returns (user id, email, verified at) of the verifications after since, oldest first
+        return self.connection.execute('SELECT user_id, email, verified_at FROM email_verifications WHERE verified_at > ? ORDER BY verified_at',
+                                       (since,)).fetchall()
+
+    def delete_email_verifications(self, before):
+        self.connection.execute('DELETE FROM email_verifications WHERE verified_at < ?', (before,))
+
+    def transaction(self, immediate=False):
+        return StoreTransaction(self.connection, immediate)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # fold the WAL back into the database file before closing
+        self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.connection.close()
+
+
+class StoreTransaction:
+    # groups the statements run inside a with block into one commit
+
+    def __init__(self, connection, immediate=False):
+        self.connection = connection
+        # take the write lock up front, so transactions that read before writing are not interleaved with other processes
+        self.immediate = immediate
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE' if self.immediate else 'BEGIN')
+        return self.connection
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType == None:
+            self.connection.execute('COMMIT')
+        else:
+            self.connection.execute('ROLLBACK')
+        return False
@@ -1,27 +1,76 @@
 import discord
 import pickle
+import argparse
 import asyncio
+import logging
+import multiprocessing
+import snapshot
 import tutor_bot
+import tutor_store
 import datetime
-        
-# read token file
-tokenFile = open("token.txt", "r")
-token = tokenFile.read()
+from office_hours import OfficeHours
 
 # initialize bot and other variables
 timeoutDuration = tutor_bot.DAY * 1
-# office hours should be in UTC time
-officeHours = [(datetime.time(13,0), datetime.time(17,0))] # 9-13 eastern time
-client = tutor_bot.TutorBot(timeoutDuration, 'user_list', 'tutor_manager', officeHours)
+# office hours are given in eastern time so they follow daylight saving time
+officeHours = OfficeHours.daily([(datetime.time(9,0), datetime.time(13,0))], 'America/Toronto')
+stateFilePath = 'tutor_state.db'
 
-# run the bot
-loop = asyncio.get_event_loop()
-try:
-    # initialize userList from saved file if exists
-    loop.run_until_complete(client.start(token))
-except KeyboardInterrupt:
-    # close connection to Discord
-    loop.run_until_complete(client.close())
-finally:
-    # run cleanup
-    loop.close()
+
+def run_bot(shardIds=None, shardCount=None, processCount=1, processIndex=0, legacyGuildId=None, tracePath=None):
+    # read token file
+    tokenFile = open("token.txt", "r")
+    token = tokenFile.read()
+    # prometheus metrics are served on http://127.0.0.1:9100/metrics, the next ports are used by the other processes
+    options = dict(metricsPort=9100 + processIndex, stateFilePath=stateFilePath, processCount=processCount, legacyGuildId=legacyGuildId)
+    # the processes share the store, the first one snapshots it
+    if processIndex > 0:
+        options['snapshotInterval'] = None
+    # and records the trace, which holds the dms since discord sends them to shard 0
+    elif tracePath != None:
+        options['tracePath'] = tracePath
+    if shardCount == None:
+        client = tutor_bot.TutorBot(timeoutDuration, 'user_list', 'tutor_manager', officeHours, **options)
+    else:
+        client = tutor_bot.ShardedTutorBot(timeoutDuration, 'user_list', 'tutor_manager', officeHours, shard_ids=shardIds, shard_count=shardCount, **options)
+
+    # run the bot
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(client.start(token))
+    except KeyboardInterrupt:
+        # close connection to Discord
+        loop.run_until_complete(client.close())
+    finally:
+        # run cleanup
+        loop.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shards', type=int, help='number of shards, every process runs a slice of them')
+    parser.add_argument('--processes', type=int, default=1, help='number of processes sharing the state store')
+    parser.add_argument('--legacy-guild', type=int, help='guild that takes over the users of a store or pickles written by a single guild bot')
+    parser.add_argument('--trace', help='record the events users cause to this file, .gz compresses it, see trace_replay.py')
+    parser.add_argument('--restore-snapshot', action='store_true', help='replace the state store with its newest snapshot before starting')
+    arguments = parser.parse_args()
+    if arguments.restore_snapshot:
+        restored = snapshot.restore_latest(stateFilePath, 'snapshots')
+        logging.info ("restored %s" % (restored) if restored != None else "there is no snapshot to restore")
+    if arguments.processes <= 1:
+        run_bot(None if arguments.shards == None else list(range(arguments.shards)), arguments.shards, legacyGuildId=arguments.legacy_guild, tracePath=arguments.trace)
+    else:
+        # every process needs at least one shard
+        shardCount = max(arguments.shards or 0, arguments.processes)
+        # migrate the store once before the processes open it
+        store = tutor_store.StateStore(stateFilePath)
+        tutor_bot.prepare_store(store, 'user_list', 'tutor_manager')
+        store.close()
+        processes = list()
+        for processIndex in range(arguments.processes):
+            shardIds = list(range(processIndex, shardCount, arguments.processes))
+            process = multiprocessing.Process(target=run_bot, args=(shardIds, shardCount, arguments.processes, processIndex, arguments.legacy_guild, arguments.trace))
+            process.start()
+            processes.append(process)
+        for process in processes:
+            process.join()
@@ -0,0 +1,159 @@
+import weakref
+from collections import OrderedDict
+
+
+class UserRepository:
+    # the users of one guild, loaded from the store on first access. the most recently used ones stay in memory up to
+    # capacity and changed ones are written back in batches, so startup time and memory do not grow with the member count.
+    # reads like the dict of users it replaces, except that iterating reads the store
+
+    def __init__(self, store, guildId, userType, capacity=5000, flushDelay=1.0, flushBatch=500):
+        self.store = store
+        self.guildId = guildId
+        # class of the users, needs load_row and to_row
+        self.userType = userType
+        self.capacity = capacity
+        # seconds a changed user may wait before it is written, or flushBatch changed users, whichever comes first
+        self.flushDelay = flushDelay
+        self.flushBatch = flushBatch
+        # OrderedDict storing user id->user, least recently used first
+        self.resident = OrderedDict()
+        # dict storing user id->user of evicted users who have tutors assigned, which is not stored and cannot be lost
+        self.helping = dict()
+        # every user object still referenced anywhere, so a handler holding a user across an eviction keeps changing the same one
+        self.loaded = weakref.WeakValueDictionary()
+        # dict storing user id->user changed since the last flush
+        self.dirty = dict()
+        self.loop = None
+        self.flushHandle = None
+        # counters
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.written = 0
+
+    def start(self, loop):
+        # without a loop every change is written at once
+        self.loop = loop
+
+    def stop(self):
+        self.flush()
+        self.loop = None
+
+    def get(self, userId, default=None):
+        user = self.resident.get(userId)
+        if user != None:
+            self.resident.move_to_end(userId)
+            self.hits += 1
+            return user
+        user = self.loaded.get(userId)
+        if user == None:
+            row = self.store.load_user(self.guildId, userId)
+            if row == None:
+                return default
+            user = self.userType()
+            user.load_row(row)
+            self.loads += 1
+            self.loaded[userId] = user
+        else:
+            self.hits += 1
+        self.make_resident(userId, user)
+        return user
+
+    def preload(self, userIds):
+        # reads the users that are not in memory in one query, for going through many users in a row.
+        # the ids should fit in memory and in one query, see StateStore.load_users_by_id
+        missing = [userId for userId in userIds if userId not in self.resident and self.loaded.get(userId) == None]
+        if not missing:
+            return
+        for row in self.store.load_users_by_id(self.guildId, missing):
+            user = self.userType()
+            user.load_row(row)
+            self.loads += 1
+            self.loaded[row[0]] = user
+            self.make_resident(row[0], user)
+
+    def __getitem__(self, userId):
+        user = self.get(userId)
+        if user == None:
+            raise KeyError(userId)
+        return user
+
+    def __setitem__(self, userId, user):
+        # the user is stored by the next flush once it is marked dirty
+        self.loaded[userId] = user
+        self.make_resident(userId, user)
+
+    def __contains__(self, userId):
+        return self.get(userId) != None
+
+    def make_resident(self, userId, user):
+        self.helping.pop(userId, None)
+        self.resident[userId] = user
+        self.resident.move_to_end(userId)
+        while len(self.resident) > self.capacity:
+            evictedId, evicted = self.resident.popitem(last=False)
+            self.evictions += 1
+            if evicted.assignedTutors:
+                self.helping[evictedId] = evicted
+
+    def mark_dirty(self, userId):
+        self.dirty[userId] = self[userId]
+        if self.loop == None or len(self.dirty) >= self.flushBatch:
+            self.flush()
+        elif self.flushHandle == None:
+            self.flushHandle = self.loop.call_later(self.flushDelay, self.flush)
+
+    def flush(self):
+        # writes the changed users in one transaction
+        if self.flushHandle != None:
+            self.flushHandle.cancel()
+            self.flushHandle = None
+        if not self.dirty:
+            return
+        self.store.put_users(self.guildId, (user.to_row(userId) for userId, user in self.dirty.items()))
+        self.flushes += 1
+        self.written += len(self.dirty)
+        self.dirty = dict()
+
+    def find_owner(self, column, value, holds):
+        # returns the id of the user whose column holds value, or None. holds(user) answers for the changed users
+        # and the store for everyone else, so nothing has to be written first
+        for userId, user in self.dirty.items():
+            if holds(user):
+                return userId
+        for userId in self.store.find_users(self.guildId, column, value):
+            if userId not in self.dirty:
+                return userId
+        return None
+
+    def held_users(self):
+        # the users in memory, everyone else has no unstored state
+        return list(self.resident.values()) + list(self.helping.values())
+
+    def items(self):
+        # streams every user from the store. users that are not in memory are read into objects of their own and not kept,
+        # so changes to them are lost unless they are looked up again
+        self.flush()
+        for row in self.store.load_users(self.guildId):
+            user = self.loaded.get(row[0])
+            if user == None:
+                user = self.userType()
+                user.load_row(row)
+            yield row[0], user
+
+    def keys(self):
+        for userId, user in self.items():
+            yield userId
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        self.flush()
+        return self.store.count_users(self.guildId)
+
+    def stats(self):
+        return {'resident': len(self.resident), 'helping': len(self.helping), 'capacity': self.capacity, 'hits': self.hits, 'loads': self.loads,
+                'evictions': self.evictions, 'dirty': len(self.dirty), 'flushes': self.flushes, 'written': self.written}